@@ -1,18 +1,63 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import Response, ORJSONResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import requests
+from requests.adapters import HTTPAdapter
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.routing import Match
 import os
 import json
 from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
 import logging
+import threading
+import time
+import random
+import uuid
+import contextvars
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
+# Set up logging: key=value lines tagged with the correlation id of the request being
+# handled. The id is taken from the X-Correlation-ID request header or generated, echoed
+# on the response and passed on to the sponsor systems we call.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Fraction of DEBUG payload dumps that are actually written
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+CORRELATION_ID_HEADER = "X-Correlation-ID"
+correlation_id = contextvars.ContextVar("correlation_id", default="-")
+
+class CorrelationIdFilter(logging.Filter):
+    """Stamp each log record with the current correlation id."""
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="time=%(asctime)s level=%(levelname)s logger=%(name)s correlation_id=%(correlation_id)s msg=%(message)s"
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(CorrelationIdFilter())
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="CRO Stability Testing API")
+def log_payload(message, payload):
+    """
+    Log a resource, bundle or request model at DEBUG.
+
+    Nothing is serialized unless DEBUG is enabled and the dump is picked by
+    LOG_PAYLOAD_SAMPLE_RATE, so callers can pass whole bundles on hot paths.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if LOG_PAYLOAD_SAMPLE_RATE < 1.0 and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    if isinstance(payload, BaseModel):
+        payload = payload.dict(exclude_none=True)
+    logger.debug("%s: %s", message, json.dumps(payload, default=str))
+
+app = FastAPI(title="CRO Stability Testing API", default_response_class=ORJSONResponse)
 
 # CORS configuration
 app.add_middleware(
@@ -21,11 +66,167 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[CORRELATION_ID_HEADER],
 )
 
+@app.middleware("http")
+async def assign_correlation_id(request: Request, call_next):
+    """Run the request under the caller's correlation id, or a new one."""
+    request_correlation_id = request.headers.get(CORRELATION_ID_HEADER) or uuid.uuid4().hex
+    token = correlation_id.set(request_correlation_id)
+    try:
+        response = await call_next(request)
+    finally:
+        correlation_id.reset(token)
+    response.headers[CORRELATION_ID_HEADER] = request_correlation_id
+    return response
+
 # Configuration
 FHIR_SERVER_URL = os.getenv("FHIR_SERVER_URL", "http://host.docker.internal:8081/fhir")
 SPONSOR_SERVER_URL = os.getenv("SPONSOR_SERVER_URL", "http://localhost:8002")
+# Page size requested from the FHIR server when walking searchset bundles
+FHIR_PAGE_SIZE = int(os.getenv("FHIR_PAGE_SIZE", "100"))
+# Seconds the in-process organization directory is trusted before it is reloaded
+ORGANIZATION_CACHE_TTL = float(os.getenv("ORGANIZATION_CACHE_TTL", "300"))
+
+# Prometheus metrics, served in text format on GET /metrics
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent handling API requests",
+    ["method", "route", "status"]
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "API requests currently being handled",
+    ["method", "route"]
+)
+UPSTREAM_LATENCY = Histogram(
+    "fhir_request_duration_seconds", "Time until response headers for outbound FHIR calls",
+    ["upstream", "resource_type", "interaction"]
+)
+UPSTREAM_IN_PROGRESS = Gauge(
+    "fhir_requests_in_progress", "Outbound FHIR calls waiting for a response",
+    ["upstream"]
+)
+BUNDLE_ENTRIES = Histogram(
+    "fhir_bundle_entries", "Entries per FHIR Bundle page received or Bundle sent",
+    ["bundle_type", "resource_type"],
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+COALESCED_READS = Counter(
+    "fhir_coalesced_reads", "FHIR reads answered by an identical request already in flight",
+    ["resource_type"]
+)
+
+def fhir_call_labels(method, url):
+    """
+    Label an outbound call with its upstream, resource type and FHIR interaction.
+
+    Calls to our own FHIR server are "fhir", everything else (sponsor servers)
+    is "external". The resource type is the first capitalized path segment, so
+    it is found behind any base path.
+    """
+    upstream = "fhir" if url.startswith(FHIR_SERVER_URL) else "external"
+    segments = [segment for segment in urlsplit(url).path.split("/") if segment]
+    for index, segment in enumerate(segments):
+        if segment[:1].isupper():
+            resource_type, rest = segment, segments[index + 1:]
+            break
+    else:
+        # Transactions are posted to the base; paging links also point at the base
+        return upstream, "", "transaction" if method == "POST" else "search"
+    
+    if rest and rest[0].startswith("$"):
+        interaction = "operation"
+    elif "_history" in rest:
+        interaction = "vread" if len(rest) > 2 else "history"
+    elif not rest or rest[0] == "_search":
+        interaction = {"GET": "search", "POST": "search" if rest else "create", "PUT": "update", "DELETE": "delete"}.get(method, method.lower())
+    else:
+        interaction = {"GET": "read", "PUT": "update", "DELETE": "delete", "PATCH": "patch"}.get(method, method.lower())
+    return upstream, resource_type, interaction
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTP adapter that times every outbound call for the upstream metrics."""
+    
+    def send(self, request, **kwargs):
+        upstream, resource_type, interaction = fhir_call_labels(request.method, request.url)
+        in_progress = UPSTREAM_IN_PROGRESS.labels(upstream)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            UPSTREAM_LATENCY.labels(upstream, resource_type, interaction).observe(time.perf_counter() - started)
+            in_progress.dec()
+
+# Session used for every FHIR call, so connections are reused and timed
+http_session = requests.Session()
+http_session.mount("http://", InstrumentedAdapter())
+http_session.mount("https://", InstrumentedAdapter())
+
+# GETs to the FHIR server currently in flight. Threads asking for the same URL, query and
+# headers wait for the one upstream request instead of sending their own.
+inflight_fhir_reads = {}
+inflight_fhir_reads_lock = threading.Lock()
+
+def fhir_get(url, params=None, headers=None):
+    """
+    GET from the FHIR server, sharing the upstream request with identical concurrent calls.
+
+    The first thread sends the request; threads arriving while it is in flight
+    wait for it and receive the same response, or the same exception. The body
+    is read before the response is handed out, so each caller can use json()
+    on it independently.
+    """
+    key = (requests.Request("GET", url, params=params).prepare().url, tuple(sorted((headers or {}).items())))
+    with inflight_fhir_reads_lock:
+        call = inflight_fhir_reads.get(key)
+        leader = call is None
+        if leader:
+            call = {"done": threading.Event(), "response": None, "error": None}
+            inflight_fhir_reads[key] = call
+    
+    if not leader:
+        COALESCED_READS.labels(fhir_call_labels("GET", key[0])[1]).inc()
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["response"]
+    
+    try:
+        call["response"] = http_session.get(url, params=params, headers=headers)
+        return call["response"]
+    except Exception as e:
+        call["error"] = e
+        raise
+    finally:
+        with inflight_fhir_reads_lock:
+            del inflight_fhir_reads[key]
+        call["done"].set()
+
+def route_template(scope):
+    """Return the path template of the route a request will hit, to keep metric labels bounded."""
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Track in-flight requests and latency per route template."""
+    method = request.method
+    route = route_template(request.scope)
+    in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+    in_progress.inc()
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        REQUEST_LATENCY.labels(method, route, status).observe(time.perf_counter() - started)
+        in_progress.dec()
 
 # Models
 class Protocol(BaseModel):
@@ -79,6 +280,16 @@ class ShareResultRequest(BaseModel):
     finalize: Optional[bool] = False
     notes: Optional[str] = None
 
+class CompactJSONResponse(ORJSONResponse):
+    """orjson response that also leaves out null fields, for ?compact=true on list endpoints."""
+    
+    def render(self, content):
+        return super().render(jsonable_encoder(content, exclude_none=True))
+
+def list_response(content, compact=False):
+    """Return list endpoint content unchanged, or as a CompactJSONResponse when the client asked for compact output."""
+    return CompactJSONResponse(content) if compact else content
+
 # Helper functions
 def fetch_fhir_resource(resource_type, resource_id=None, params=None):
     """Fetch FHIR resources from the HAPI FHIR server."""
@@ -86,30 +297,68 @@ def fetch_fhir_resource(resource_type, resource_id=None, params=None):
     if resource_id:
         url += f"/{resource_id}"
     
-    logger.info(f"Fetching from CRO's FHIR server URL: {url}")
+    logger.debug("Fetching from CRO's FHIR server URL: %s", url)
     if params:
-        logger.info(f"With parameters: {params}")
+        logger.debug("With parameters: %s", params)
     
     try:
-        response = requests.get(url, params=params)
-        logger.info(f"FHIR server response status: {response.status_code}")
+        response = fhir_get(url, params=params)
+        logger.debug("FHIR server response status: %s", response.status_code)
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
         error_msg = f"FHIR server error: {str(e)}"
         logger.error(error_msg)
-        logger.error(f"Error occurred with URL: {url}")
+        logger.error("Error occurred with URL: %s", url)
         raise HTTPException(status_code=500, detail=error_msg)
 
+def _rebase_fhir_url(url):
+    """Point a server-generated paging link back at FHIR_SERVER_URL."""
+    base = urlsplit(FHIR_SERVER_URL)
+    link = urlsplit(url)
+    if (link.scheme, link.netloc) == (base.scheme, base.netloc):
+        return url
+    return urlunsplit((base.scheme, base.netloc, link.path, link.query, link.fragment))
+
+def iter_fhir_resources(resource_type, params=None):
+    """Yield every resource matched by a FHIR search, following Bundle.link[relation=next]."""
+    url = f"{FHIR_SERVER_URL}/{resource_type}"
+    params = {"_count": FHIR_PAGE_SIZE, **(params or {})}
+    
+    while url:
+        logger.debug("Fetching search page from CRO's FHIR server URL: %s", url)
+        try:
+            response = fhir_get(url, params=params)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            error_msg = f"FHIR server error: {str(e)}"
+            logger.error(error_msg)
+            logger.error("Error occurred with URL: %s", url)
+            raise HTTPException(status_code=500, detail=error_msg)
+        
+        bundle = response.json()
+        entries = bundle.get("entry", [])
+        BUNDLE_ENTRIES.labels("searchset", resource_type).observe(len(entries))
+        for entry in entries:
+            if entry.get("resource"):
+                yield entry["resource"]
+        
+        url = None
+        params = None
+        for link in bundle.get("link", []):
+            if link.get("relation") == "next" and link.get("url"):
+                url = _rebase_fhir_url(link["url"])
+                break
+
 def create_fhir_resource(resource_type, data):
     """Create a FHIR resource on the HAPI FHIR server."""
     url = f"{FHIR_SERVER_URL}/{resource_type}"
     
-    logger.info(f"Creating {resource_type} resource on CRO's FHIR server URL: {url}")
-    logger.info(f"Resource data: {json.dumps(data, indent=2)}")
+    logger.debug("Creating %s resource on CRO's FHIR server URL: %s", resource_type, url)
+    log_payload("Resource data", data)
     
     try:
-        response = requests.post(
+        response = http_session.post(
             url, 
             json=data,
             headers={
@@ -118,61 +367,126 @@ def create_fhir_resource(resource_type, data):
                 "Prefer": "return=representation"
             }
         )
-        logger.info(f"FHIR server response status: {response.status_code}")
+        logger.debug("FHIR server response status: %s", response.status_code)
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
         error_msg = f"FHIR server error: {str(e)}"
         logger.error(error_msg)
-        logger.error(f"Error occurred with URL: {url}")
+        logger.error("Error occurred with URL: %s", url)
         raise HTTPException(status_code=500, detail=error_msg)
 
 def update_fhir_resource(resource_type, resource_id, data):
     """Update a FHIR resource on the HAPI FHIR server."""
     url = f"{FHIR_SERVER_URL}/{resource_type}/{resource_id}"
     
-    logger.info(f"Updating {resource_type}/{resource_id} on CRO's FHIR server URL: {url}")
+    logger.debug("Updating %s/%s on CRO's FHIR server URL: %s", resource_type, resource_id, url)
     
     try:
-        response = requests.put(url, json=data)
-        logger.info(f"FHIR server response status: {response.status_code}")
+        response = http_session.put(url, json=data)
+        logger.debug("FHIR server response status: %s", response.status_code)
         response.raise_for_status()
         return response.json()
     except requests.RequestException as e:
         error_msg = f"FHIR server error: {str(e)}"
         logger.error(error_msg)
-        logger.error(f"Error occurred with URL: {url}")
+        logger.error("Error occurred with URL: %s", url)
         raise HTTPException(status_code=500, detail=error_msg)
 
 def delete_fhir_resource(resource_type, resource_id):
     """Delete a FHIR resource on the HAPI FHIR server."""
     url = f"{FHIR_SERVER_URL}/{resource_type}/{resource_id}"
     
-    logger.info(f"Deleting {resource_type}/{resource_id} from CRO's FHIR server URL: {url}")
+    logger.debug("Deleting %s/%s from CRO's FHIR server URL: %s", resource_type, resource_id, url)
     
     try:
-        response = requests.delete(url)
-        logger.info(f"FHIR server response status: {response.status_code}")
+        response = http_session.delete(url)
+        logger.debug("FHIR server response status: %s", response.status_code)
         response.raise_for_status()
         return True
     except requests.RequestException as e:
         error_msg = f"FHIR server error: {str(e)}"
         logger.error(error_msg)
-        logger.error(f"Error occurred with URL: {url}")
+        logger.error("Error occurred with URL: %s", url)
         raise HTTPException(status_code=500, detail=error_msg)
 
+class ExtensionIndex:
+    """
+    Extensions of a FHIR resource indexed by URL in a single pass.
+
+    Nested extensions are indexed together with their parent, so complex
+    extensions can be read without scanning the resource again. value()
+    returns the typed value of an extension: the string, boolean, date or
+    number, or the reference string of a valueReference.
+    """
+    
+    VALUE_KEYS = ("valueString", "valueBoolean", "valueDateTime", "valueInteger", "valueDecimal", "valueCode", "valueUri")
+    
+    def __init__(self, resource):
+        self.extensions = {}
+        self.children = {}
+        for ext in (resource or {}).get("extension", []):
+            url = ext.get("url")
+            self.extensions.setdefault(url, []).append(ext)
+            if ext.get("extension"):
+                self.children.setdefault(url, []).append(ExtensionIndex(ext))
+    
+    @classmethod
+    def typed_value(cls, ext):
+        """Return the value of a single extension, or None if it has none."""
+        if "valueReference" in ext:
+            return ext["valueReference"].get("reference")
+        for key in cls.VALUE_KEYS:
+            if key in ext:
+                return ext[key]
+        return None
+    
+    def has(self, url):
+        """Check whether any extension with this URL is present."""
+        return url in self.extensions
+    
+    def first(self, url):
+        """Return the first extension with this URL as stored, or None."""
+        matches = self.extensions.get(url)
+        return matches[0] if matches else None
+    
+    def value(self, url, default=None):
+        """Return the first value found for this URL."""
+        for ext in self.extensions.get(url, []):
+            value = self.typed_value(ext)
+            if value is not None:
+                return value
+        return default
+    
+    def values(self, url):
+        """Return every value found for this URL."""
+        values = []
+        for ext in self.extensions.get(url, []):
+            value = self.typed_value(ext)
+            if value is not None:
+                values.append(value)
+        return values
+    
+    def nested(self, url):
+        """Return the index of the nested extensions of the first extension with this URL."""
+        children = self.children.get(url)
+        return children[0] if children else ExtensionIndex(None)
+    
+    def nested_values(self, url):
+        """Return the values of every nested extension under every extension with this URL."""
+        values = []
+        for child in self.children.get(url, []):
+            for nested_url in child.extensions:
+                values.extend(child.values(nested_url))
+        return values
+
 # Convert FHIR resources to API models
 def convert_plandefinition_to_protocol(plan_definition):
     """Convert a FHIR PlanDefinition to a Protocol model."""
-    # Default sponsor name
-    sponsor = "Unknown"
+    extensions = ExtensionIndex(plan_definition)
     
     # Check for sponsor name in extensions
-    for ext in plan_definition.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor":
-            if "valueString" in ext:
-                sponsor = ext["valueString"]
-                break
+    sponsor = extensions.value("http://example.org/fhir/StructureDefinition/sponsor", "Unknown")
     
     # If no sponsor found in extension, try to get from meta
     if sponsor == "Unknown" and "meta" in plan_definition:
@@ -180,12 +494,7 @@ def convert_plandefinition_to_protocol(plan_definition):
             sponsor = plan_definition["meta"]["source"]
     
     # Get shared date
-    shared_date = datetime.now().isoformat()
-    for ext in plan_definition.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/sharedDate":
-            if "valueDateTime" in ext:
-                shared_date = ext["valueDateTime"]
-                break
+    shared_date = extensions.value("http://example.org/fhir/StructureDefinition/sharedDate", datetime.now().isoformat())
     
     # If no specific shared date, use lastUpdated from meta
     if shared_date == datetime.now().isoformat() and "meta" in plan_definition:
@@ -222,33 +531,24 @@ def convert_device_to_batch(device):
                 protocol_id = ident.get("value", "")
                 break
     
+    extensions = ExtensionIndex(device)
+    
     # If not found in identifier, try to get from extension
-    if not protocol_id and "extension" in device:
-        for ext in device["extension"]:
-            if ext.get("url") == "http://example.org/fhir/StructureDefinition/batch-protocol":
-                ref = ext.get("valueReference", {}).get("reference", "")
-                if ref and ref.startswith("PlanDefinition/"):
-                    protocol_id = ref.split("/")[1]
-                    break
+    if not protocol_id:
+        for ref in extensions.values("http://example.org/fhir/StructureDefinition/batch-protocol"):
+            if ref.startswith("PlanDefinition/"):
+                protocol_id = ref.split("/")[1]
+                break
     
     # Get manufacture date
     manufacture_date = device.get("manufactureDate", datetime.now().isoformat())
     
     # If not in the standard field, try extensions
-    if not manufacture_date and "extension" in device:
-        for ext in device["extension"]:
-            if ext.get("url") == "http://example.org/fhir/StructureDefinition/manufactureDate":
-                manufacture_date = ext.get("valueDateTime", datetime.now().isoformat())
-                break
+    if not manufacture_date:
+        manufacture_date = extensions.value("http://example.org/fhir/StructureDefinition/manufactureDate", datetime.now().isoformat())
     
     # Get quantity
-    quantity = 0
-    if "extension" in device:
-        for ext in device["extension"]:
-            if ext.get("url") == "http://example.org/fhir/StructureDefinition/quantity":
-                if "valueInteger" in ext:
-                    quantity = ext["valueInteger"]
-                    break
+    quantity = extensions.value("http://example.org/fhir/StructureDefinition/quantity", 0)
     
     # Get batch number from deviceName, lotNumber, or identifier
     batch_number = "Unknown Batch"
@@ -286,26 +586,18 @@ def convert_observation_to_test_result(observation):
             if reference.get("reference", "").startswith("ActivityDefinition/"):
                 test_definition_id = reference.get("reference", "").replace("ActivityDefinition/", "")
     
+    extensions = ExtensionIndex(observation)
+    
     # Extract protocol ID from extensions if available
     protocol_id = None
-    timepoint_id = None
-    timepoint_title = None
-    
-    for ext in observation.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/test-protocol-reference":
-            protocol_ref = ext.get("valueReference", {}).get("reference", "")
-            if protocol_ref and protocol_ref.startswith("PlanDefinition/"):
-                protocol_id = protocol_ref.replace("PlanDefinition/", "")
-        elif ext.get("url") == "http://example.org/fhir/StructureDefinition/protocol-timepoint":
-            timepoint_id = ext.get("valueString")
-        elif ext.get("url") == "http://example.org/fhir/StructureDefinition/protocol-timepoint-title":
-            timepoint_title = ext.get("valueString")
+    protocol_ref = extensions.value("http://example.org/fhir/StructureDefinition/test-protocol-reference", "")
+    if protocol_ref.startswith("PlanDefinition/"):
+        protocol_id = protocol_ref.replace("PlanDefinition/", "")
+    timepoint_id = extensions.value("http://example.org/fhir/StructureDefinition/protocol-timepoint")
+    timepoint_title = extensions.value("http://example.org/fhir/StructureDefinition/protocol-timepoint-title")
     
     # Extract share with sponsor flag
-    shared_with_sponsor = False
-    for ext in observation.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/shared-with-sponsor":
-            shared_with_sponsor = ext.get("valueBoolean", False)
+    shared_with_sponsor = extensions.value("http://example.org/fhir/StructureDefinition/shared-with-sponsor", False)
     
     value = None
     value_unit = ""
@@ -316,35 +608,20 @@ def convert_observation_to_test_result(observation):
     elif "valueString" in observation:
         value = observation["valueString"]
     
-    # Extract parameter results if available
-    parameter_results = {}
-    for ext in observation.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/parameter-results":
-            try:
-                if "valueString" in ext:
-                    parameter_results = json.loads(ext["valueString"])
-            except json.JSONDecodeError:
-                logger.warning(f"Failed to parse parameter results for observation {observation.get('id')}")
-    
-    # Extract criteria results if available
-    criteria_results = {}
-    for ext in observation.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/criteria-results":
-            try:
-                if "valueString" in ext:
-                    criteria_results = json.loads(ext["valueString"])
-            except json.JSONDecodeError:
-                logger.warning(f"Failed to parse criteria results for observation {observation.get('id')}")
-    
-    # Extract additional result details if available
-    result_details = {}
-    for ext in observation.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/result-details":
-            try:
-                if "valueString" in ext:
-                    result_details = json.loads(ext["valueString"])
-            except json.JSONDecodeError:
-                logger.warning(f"Failed to parse result details for observation {observation.get('id')}")
+    # Extract JSON-encoded parameter results, criteria results and result details if available
+    def json_extension(url, label):
+        encoded = extensions.value(url)
+        if encoded is None:
+            return {}
+        try:
+            return json.loads(encoded)
+        except json.JSONDecodeError:
+            logger.warning("Failed to parse %s for observation %s", label, observation.get('id'))
+            return {}
+    
+    parameter_results = json_extension("http://example.org/fhir/StructureDefinition/parameter-results", "parameter results")
+    criteria_results = json_extension("http://example.org/fhir/StructureDefinition/criteria-results", "criteria results")
+    result_details = json_extension("http://example.org/fhir/StructureDefinition/result-details", "result details")
     
     return TestResult(
         id=original_id,  # Use original ID
@@ -505,6 +782,45 @@ def convert_test_result_to_observation(test_result):
     return observation
 
 # Helper function to find the sponsor for a protocol
+# Organization directory: every Organization converted once, indexed by ID,
+# identifier value and name. Reloaded after ORGANIZATION_CACHE_TTL seconds and
+# dropped whenever this backend writes an Organization.
+organization_directory = {"loaded_at": None, "by_id": {}, "by_identifier": {}, "by_name": {}}
+organization_directory_lock = threading.Lock()
+
+def invalidate_organization_directory():
+    """Forget the cached organizations so the next lookup reloads them."""
+    organization_directory["loaded_at"] = None
+
+def load_organization_directory():
+    """Return the organization directory, reloading it from the FHIR server when stale."""
+    with organization_directory_lock:
+        loaded_at = organization_directory["loaded_at"]
+        if loaded_at is not None and time.monotonic() - loaded_at < ORGANIZATION_CACHE_TTL:
+            return organization_directory
+        
+        by_id, by_identifier, by_name = {}, {}, {}
+        for org in iter_fhir_resources("Organization"):
+            if not org.get("id"):
+                continue
+            organization = convert_fhir_organization_to_model(org)
+            entry = {"organization": organization, "type": organization.type, "resource": org}
+            by_id[org["id"]] = entry
+            for identifier in org.get("identifier", []):
+                if identifier.get("value"):
+                    by_identifier.setdefault(identifier["value"], []).append(entry)
+            if org.get("name"):
+                by_name.setdefault(org["name"], []).append(entry)
+        
+        organization_directory.update({
+            "loaded_at": time.monotonic(),
+            "by_id": by_id,
+            "by_identifier": by_identifier,
+            "by_name": by_name
+        })
+        logger.info("Loaded %s organizations into the directory", len(by_id))
+        return organization_directory
+
 def get_sponsor_for_protocol(protocol_id):
     """Get the sponsor organization that owns the protocol."""
     try:
@@ -512,52 +828,32 @@ def get_sponsor_for_protocol(protocol_id):
         protocol = fetch_fhir_resource("PlanDefinition", protocol_id)
         
         # Look for sponsor information in extensions
-        sponsor_id = None
-        sponsor_name = None
-        
-        for ext in protocol.get("extension", []):
-            if ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor-id":
-                sponsor_id = ext.get("valueString")
-            elif ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor":
-                sponsor_name = ext.get("valueString")
+        extensions = ExtensionIndex(protocol)
+        sponsor_id = extensions.value("http://example.org/fhir/StructureDefinition/sponsor-id")
+        sponsor_name = extensions.value("http://example.org/fhir/StructureDefinition/sponsor")
                 
-        # If we have a sponsor ID or name, try to find the corresponding organization
+        # If we have a sponsor ID or name, look up the corresponding organization
         if sponsor_id or sponsor_name:
-            # First, search by ID in our local organizations
-            organizations = fetch_fhir_resource("Organization")
+            directory = load_organization_directory()
+            candidates = []
+            if sponsor_id:
+                candidates += directory["by_identifier"].get(sponsor_id, [])
+            if sponsor_name:
+                candidates += directory["by_name"].get(sponsor_name, [])
             
-            if organizations and organizations.get("entry"):
-                for entry in organizations.get("entry", []):
-                    org = entry["resource"]
-                    
-                    # Check if this matches our sponsor
-                    org_type = None
-                    for ext in org.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-type":
-                            org_type = ext.get("valueString")
-                    
-                    if org_type == "sponsor":
-                        # Check for matching ID or name
-                        if sponsor_id:
-                            for identifier in org.get("identifier", []):
-                                if identifier.get("value") == sponsor_id:
-                                    return convert_fhir_organization_to_model(org)
-                        
-                        if sponsor_name and org.get("name") == sponsor_name:
-                            return convert_fhir_organization_to_model(org)
+            for entry in candidates:
+                if entry["type"] == "sponsor":
+                    return entry["organization"].copy()
         
         return None
     except Exception as e:
-        logger.error(f"Error finding sponsor for protocol {protocol_id}: {str(e)}")
+        logger.error("Error finding sponsor for protocol %s: %s", protocol_id, e)
         return None
 
 # Convert FHIR Organization to our model
 def convert_fhir_organization_to_model(org):
     """Convert FHIR Organization to our Organization model."""
     fhir_url = None
-    api_key = None
-    org_type = "sponsor"  # Default
-    
     # Extract URL from telecom
     for telecom in org.get("telecom", []):
         if telecom.get("system") == "url":
@@ -565,11 +861,9 @@ def convert_fhir_organization_to_model(org):
             break
     
     # Extract organization type and API key from extensions
-    for ext in org.get("extension", []):
-        if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-type":
-            org_type = ext.get("valueString")
-        elif ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-api-key":
-            api_key = ext.get("valueString")
+    extensions = ExtensionIndex(org)
+    org_type = extensions.value("http://example.org/fhir/StructureDefinition/organization-type", "sponsor")
+    api_key = extensions.value("http://example.org/fhir/StructureDefinition/organization-api-key")
     
     return Organization(
         id=org.get("id"),
@@ -650,19 +944,18 @@ async def forward_result_to_sponsor(observation, sponsor_id=None):
             ]
         }
         
-        logger.info(f"Using sponsor FHIR URL: {sponsor_fhir_url}")
-        logger.info(f"Using FHIR transaction to create Observation resource")
-        
         # Prepare headers
         headers = {
-            "Content-Type": "application/fhir+json"
+            "Content-Type": "application/fhir+json",
+            CORRELATION_ID_HEADER: correlation_id.get()
         }
         
-        logger.info(f"Forwarding result to sponsor's FHIR server: {sponsor_fhir_url}")
-        logger.info(f"Transaction bundle: {json.dumps(transaction, indent=2)}")
+        logger.info("Forwarding result to sponsor's FHIR server as a transaction: %s", sponsor_fhir_url)
+        log_payload("Transaction bundle", transaction)
+        BUNDLE_ENTRIES.labels("transaction", "").observe(len(transaction["entry"]))
         
         # Send the transaction to the FHIR server
-        response = requests.post(
+        response = http_session.post(
             sponsor_fhir_url,
             json=transaction,
             headers=headers,
@@ -672,7 +965,7 @@ async def forward_result_to_sponsor(observation, sponsor_id=None):
         
         # Parse the response to capture created resources
         response_data = response.json()
-        logger.info(f"FHIR server response: {json.dumps(response_data, indent=2)}")
+        log_payload("FHIR server response", response_data)
         
         # Return both success status and the response data
         return {
@@ -684,7 +977,7 @@ async def forward_result_to_sponsor(observation, sponsor_id=None):
         }
     except Exception as e:
         error_message = str(e)
-        logger.error(f"Error forwarding result to sponsor: {error_message}")
+        logger.error("Error forwarding result to sponsor: %s", error_message)
         return {
             "success": False,
             "error": error_message,
@@ -696,47 +989,44 @@ async def forward_result_to_sponsor(observation, sponsor_id=None):
 def read_root():
     return {"message": "Welcome to CRO Stability Testing API"}
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Expose request, upstream FHIR and bundle metrics in Prometheus text format."""
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
 # Protocol endpoints (read-only)
 @app.get("/protocols", response_model=List[Protocol])
-def get_protocols():
+def get_protocols(compact: bool = False):
     """Get all shared protocols (PlanDefinitions) with CRO access."""
-    # First, get all PlanDefinitions
-    response = fetch_fhir_resource("PlanDefinition", params={
-        "_count": 100,
-        "status": "active,draft"
-    })
-    
+    # Walk every page of PlanDefinitions
     protocols = []
-    if response and response.get("entry"):
-        for entry in response.get("entry", []):
-            plan_definition = entry["resource"]
-            
-            # Check if this has a shared tag or extension
-            shared_with_cro = False
-            
-            # Check in meta tags
-            if "meta" in plan_definition and "tag" in plan_definition["meta"]:
-                for tag in plan_definition["meta"]["tag"]:
-                    if (tag.get("system") == "http://example.org/fhir/tags" and 
-                        tag.get("code") == "shared-protocol"):
-                        shared_with_cro = True
-                        break
-            
-            # Also check in extension (either way might be used)
-            if not shared_with_cro and "extension" in plan_definition:
-                shared_with_cro = any(
-                    ext.get("url") in [
-                        "http://example.org/fhir/StructureDefinition/sharedWithCRO",
-                        "http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations"
-                    ]
-                    for ext in plan_definition.get("extension", [])
-                )
-            
-            # Include if shared
-            if shared_with_cro:
-                protocols.append(convert_plandefinition_to_protocol(plan_definition))
+    for plan_definition in iter_fhir_resources("PlanDefinition", params={
+        "status": "active,draft"
+    }):
+        # Check if this has a shared tag or extension
+        shared_with_cro = False
+        
+        # Check in meta tags
+        if "meta" in plan_definition and "tag" in plan_definition["meta"]:
+            for tag in plan_definition["meta"]["tag"]:
+                if (tag.get("system") == "http://example.org/fhir/tags" and 
+                    tag.get("code") == "shared-protocol"):
+                    shared_with_cro = True
+                    break
+        
+        # Also check in extension (either way might be used)
+        if not shared_with_cro:
+            extensions = ExtensionIndex(plan_definition)
+            shared_with_cro = (
+                extensions.has("http://example.org/fhir/StructureDefinition/sharedWithCRO") or
+                extensions.has("http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations")
+            )
+        
+        # Include if shared
+        if shared_with_cro:
+            protocols.append(convert_plandefinition_to_protocol(plan_definition))
     
-    return protocols
+    return list_response(protocols, compact)
 
 @app.get("/protocols/{protocol_id}", response_model=Protocol)
 def get_protocol(protocol_id: str):
@@ -755,13 +1045,11 @@ def get_protocol(protocol_id: str):
                 break
     
     # Also check in extension (either way might be used)
-    if not shared_with_cro and "extension" in plan_definition:
-        shared_with_cro = any(
-            ext.get("url") in [
-                "http://example.org/fhir/StructureDefinition/sharedWithCRO",
-                "http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations"
-            ]
-            for ext in plan_definition.get("extension", [])
+    if not shared_with_cro:
+        extensions = ExtensionIndex(plan_definition)
+        shared_with_cro = (
+            extensions.has("http://example.org/fhir/StructureDefinition/sharedWithCRO") or
+            extensions.has("http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations")
         )
     
     if not shared_with_cro:
@@ -770,137 +1058,124 @@ def get_protocol(protocol_id: str):
     return convert_plandefinition_to_protocol(plan_definition)
 
 @app.get("/protocols/{protocol_id}/tests")
-def get_protocol_tests(protocol_id: str):
+def get_protocol_tests(protocol_id: str, compact: bool = False):
     """Get all stability tests associated with a protocol."""
-    logger.info(f"Getting tests for protocol ID: {protocol_id}")
+    logger.info("Getting tests for protocol ID: %s", protocol_id)
     
     # First, verify protocol is shared with this CRO
     try:
         protocol = get_protocol(protocol_id)
-        logger.info(f"Successfully retrieved protocol {protocol_id} with title: {protocol.title}")
+        logger.info("Successfully retrieved protocol %s with title: %s", protocol_id, protocol.title)
     except Exception as e:
-        logger.error(f"Error retrieving protocol {protocol_id}: {str(e)}")
+        logger.error("Error retrieving protocol %s: %s", protocol_id, e)
         raise
     
     # Fetch actual stability tests (ActivityDefinitions) that reference this protocol
     try:
         # First try to fetch ActivityDefinitions with a direct reference to this protocol ID
         # Use tag-based search first for better performance
-        response = fetch_fhir_resource("ActivityDefinition", params={
+        test_definitions = list(iter_fhir_resources("ActivityDefinition", params={
             "_tag": f"protocol:{protocol_id}"
-        })
-        
-        # If no results with tag, try fetching all and filtering
-        if not response.get("entry"):
-            logger.info(f"No tests found using tag search, fetching all ActivityDefinitions")
-            response = fetch_fhir_resource("ActivityDefinition")
+        }))
         
-        logger.info(f"Fetched ActivityDefinitions, total entries: {len(response.get('entry', []))}")
+        # If no results with tag, walk every ActivityDefinition page and filter
+        if not test_definitions:
+            logger.info("No tests found using tag search, fetching all ActivityDefinitions")
+            test_definitions = iter_fhir_resources("ActivityDefinition")
+        else:
+            logger.info("Fetched ActivityDefinitions, total entries: %s", len(test_definitions))
     except Exception as e:
-        logger.error(f"Error fetching ActivityDefinitions: {str(e)}")
+        logger.error("Error fetching ActivityDefinitions: %s", e)
         raise
     
     tests = []
-    if response and response.get("entry"):
-        for entry in response.get("entry", []):
-            test_definition = entry["resource"]
-            test_id = test_definition.get("id", "unknown")
-            
-            # Check if this test references our protocol
-            protocol_reference_found = False
+    for test_definition in test_definitions:
+        test_id = test_definition.get("id", "unknown")
+        
+        # Check if this test references our protocol
+        protocol_reference_found = False
+        
+        # Method 1: Check in extension for stability-test-protocol reference
+        extensions = ExtensionIndex(test_definition)
+        if f"PlanDefinition/{protocol_id}" in extensions.values("http://example.org/fhir/StructureDefinition/stability-test-protocol"):
+            protocol_reference_found = True
+            logger.debug("Found matching test %s for protocol %s via extension", test_id, protocol_id)
+        
+        # Method 2: Check in meta.tag for direct protocol tagging
+        if not protocol_reference_found and "meta" in test_definition and "tag" in test_definition["meta"]:
+            for tag in test_definition["meta"]["tag"]:
+                if tag.get("system") == "http://example.org/fhir/tags" and tag.get("code") == f"protocol:{protocol_id}":
+                    protocol_reference_found = True
+                    logger.debug("Found matching test %s for protocol %s via meta.tag", test_id, protocol_id)
+                    break
+        
+        # Method 3: Check in useContext for protocol reference
+        if not protocol_reference_found and "useContext" in test_definition:
+            for context in test_definition["useContext"]:
+                if context.get("code", {}).get("code") == "protocol" and context.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}":
+                    protocol_reference_found = True
+                    logger.debug("Found matching test %s for protocol %s via useContext", test_id, protocol_id)
+                    break
+        
+        # Method 4: Check in identifier for protocol reference
+        if not protocol_reference_found and "identifier" in test_definition:
+            for identifier in test_definition["identifier"]:
+                if identifier.get("system") == "http://example.org/fhir/identifier/protocol" and identifier.get("value") == protocol_id:
+                    protocol_reference_found = True
+                    logger.debug("Found matching test %s for protocol %s via identifier", test_id, protocol_id)
+                    break
+        
+        if protocol_reference_found:
+            # Extract parameters from extension
+            parameters = {}
+            encoded = extensions.value("http://example.org/fhir/StructureDefinition/stability-test-parameters")
+            if encoded is not None:
+                try:
+                    parameters = json.loads(encoded)
+                except json.JSONDecodeError:
+                    logger.warning("Failed to parse test parameters for test %s", test_id)
             
-            # Method 1: Check in extension for stability-test-protocol reference
-            if "extension" in test_definition:
-                for ext in test_definition["extension"]:
-                    if ext.get("url") == "http://example.org/fhir/StructureDefinition/stability-test-protocol":
-                        ref = ext.get("valueReference", {}).get("reference", "")
-                        if ref == f"PlanDefinition/{protocol_id}":
-                            protocol_reference_found = True
-                            logger.info(f"Found matching test {test_id} for protocol {protocol_id} via extension")
-                            break
+            # Extract acceptance criteria from extension
+            criteria = {}
+            encoded = extensions.value("http://example.org/fhir/StructureDefinition/stability-test-acceptance-criteria")
+            if encoded is not None:
+                try:
+                    criteria = json.loads(encoded)
+                except json.JSONDecodeError:
+                    logger.warning("Failed to parse acceptance criteria for test %s", test_id)
             
-            # Method 2: Check in meta.tag for direct protocol tagging
-            if not protocol_reference_found and "meta" in test_definition and "tag" in test_definition["meta"]:
-                for tag in test_definition["meta"]["tag"]:
-                    if tag.get("system") == "http://example.org/fhir/tags" and tag.get("code") == f"protocol:{protocol_id}":
-                        protocol_reference_found = True
-                        logger.info(f"Found matching test {test_id} for protocol {protocol_id} via meta.tag")
-                        break
+            # Extract test type
+            test_type = "Unknown"
             
-            # Method 3: Check in useContext for protocol reference
-            if not protocol_reference_found and "useContext" in test_definition:
-                for context in test_definition["useContext"]:
-                    if context.get("code", {}).get("code") == "protocol" and context.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}":
-                        protocol_reference_found = True
-                        logger.info(f"Found matching test {test_id} for protocol {protocol_id} via useContext")
-                        break
+            # Method 1: Check in topic
+            if "topic" in test_definition and test_definition["topic"]:
+                for topic in test_definition["topic"]:
+                    if "coding" in topic and topic["coding"]:
+                        for coding in topic["coding"]:
+                            if coding.get("system") == "http://example.org/fhir/stability-test-types":
+                                test_type = coding.get("code", "Unknown")
             
-            # Method 4: Check in identifier for protocol reference
-            if not protocol_reference_found and "identifier" in test_definition:
-                for identifier in test_definition["identifier"]:
-                    if identifier.get("system") == "http://example.org/fhir/identifier/protocol" and identifier.get("value") == protocol_id:
-                        protocol_reference_found = True
-                        logger.info(f"Found matching test {test_id} for protocol {protocol_id} via identifier")
-                        break
+            # Method 2: Check in extension
+            if test_type == "Unknown":
+                test_type = extensions.value("http://example.org/fhir/StructureDefinition/test-type", "Unknown")
             
-            if protocol_reference_found:
-                # Extract parameters from extension
-                parameters = {}
-                if "extension" in test_definition:
-                    for ext in test_definition["extension"]:
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/stability-test-parameters":
-                            try:
-                                if "valueString" in ext:
-                                    parameters = json.loads(ext["valueString"])
-                            except json.JSONDecodeError:
-                                logger.warning(f"Failed to parse test parameters for test {test_id}")
-                
-                # Extract acceptance criteria from extension
-                criteria = {}
-                if "extension" in test_definition:
-                    for ext in test_definition["extension"]:
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/stability-test-acceptance-criteria":
-                            try:
-                                if "valueString" in ext:
-                                    criteria = json.loads(ext["valueString"])
-                            except json.JSONDecodeError:
-                                logger.warning(f"Failed to parse acceptance criteria for test {test_id}")
-                
-                # Extract test type
-                test_type = "Unknown"
-                
-                # Method 1: Check in topic
-                if "topic" in test_definition and test_definition["topic"]:
-                    for topic in test_definition["topic"]:
-                        if "coding" in topic and topic["coding"]:
-                            for coding in topic["coding"]:
-                                if coding.get("system") == "http://example.org/fhir/stability-test-types":
-                                    test_type = coding.get("code", "Unknown")
-                
-                # Method 2: Check in extension
-                if test_type == "Unknown" and "extension" in test_definition:
-                    for ext in test_definition["extension"]:
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/test-type":
-                            test_type = ext.get("valueString", "Unknown")
-                            break
-                
-                # Create test object
-                test = {
-                    "id": test_id,
-                    "title": test_definition.get("title", "Unknown Test"),
-                    "description": test_definition.get("description", ""),
-                    "type": test_type,
-                    "parameters": parameters,
-                    "acceptance_criteria": criteria
-                }
-                tests.append(test)
-                logger.info(f"Added test: {test_id} - {test_definition.get('title', 'Unknown Test')}")
-    
-    logger.info(f"Found {len(tests)} test definitions referencing protocol {protocol_id}")
+            # Create test object
+            test = {
+                "id": test_id,
+                "title": test_definition.get("title", "Unknown Test"),
+                "description": test_definition.get("description", ""),
+                "type": test_type,
+                "parameters": parameters,
+                "acceptance_criteria": criteria
+            }
+            tests.append(test)
+            logger.debug("Added test: %s - %s", test_id, test_definition.get('title', 'Unknown Test'))
+
+    logger.info("Found %s test definitions referencing protocol %s", len(tests), protocol_id)
     
     # If no stability tests found, fall back to protocol timepoints as before
     if not tests and protocol.action:
-        logger.info(f"No stability tests found, falling back to protocol timepoints")
+        logger.info("No stability tests found, falling back to protocol timepoints")
         
         # Track unique IDs to avoid duplicates
         used_ids = set()
@@ -919,7 +1194,7 @@ def get_protocol_tests(protocol_id: str):
             }
             tests.append(test)
             used_ids.add(condition_id)
-            logger.info(f"Added protocol test: {condition_id}")
+            logger.debug("Added protocol test: %s", condition_id)
             
             # Get nested timepoints
             if "action" in condition:
@@ -977,146 +1252,119 @@ def get_protocol_tests(protocol_id: str):
                         }
                     
                     tests.append(test)
-                    logger.info(f"Added protocol timepoint: {timepoint_id} ({timepoint_title})")
+                    logger.debug("Added protocol timepoint: %s (%s)", timepoint_id, timepoint_title)
     
-    logger.info(f"Returning total of {len(tests)} tests for protocol {protocol_id}")
-    return tests
+    logger.info("Returning total of %s tests for protocol %s", len(tests), protocol_id)
+    return list_response(tests, compact)
 
 # Batch endpoints
 @app.get("/batches", response_model=List[Batch])
-def get_batches(protocol_id: Optional[str] = None):
+def get_batches(protocol_id: Optional[str] = None, compact: bool = False):
     """Get batches shared with the CRO, optionally filtered by protocol."""
-    logger.info(f"Looking for batches{' for protocol '+protocol_id if protocol_id else ''}")
+    logger.info("Looking for batches%s", ' for protocol '+protocol_id if protocol_id else '')
     
     all_batches = []
     
     # Get all devices first (legacy compatibility)
     try:
-        response = fetch_fhir_resource("Device")
-        logger.info(f"Fetched Device resources, total entries: {len(response.get('entry', []))}")
-        
-        if response and response.get("entry"):
-            for entry in response.get("entry", []):
-                device = entry["resource"]
-                device_id = device.get("id", "unknown")
-                device_protocol_id = None
-                
-                # Extract protocol ID from extension
-                if "extension" in device:
-                    for ext in device["extension"]:
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/batch-protocol":
-                            if ext.get("valueReference", {}).get("reference", "").startswith("PlanDefinition/"):
-                                device_protocol_id = ext.get("valueReference", {}).get("reference", "").split("/")[1]
-                                logger.debug(f"Found protocol ID {device_protocol_id} in batch {device_id} extension")
-                                break
-                
-                # Extract protocol ID from identifier
-                if not device_protocol_id and "identifier" in device:
-                    for ident in device["identifier"]:
-                        if ident.get("system") == "http://example.org/fhir/identifier/protocol":
-                            device_protocol_id = ident.get("value")
-                            logger.debug(f"Found protocol ID {device_protocol_id} in batch {device_id} identifier")
-                            break
-                
-                # Check if this batch is shared with the CRO
-                shared_with_cro = False
-                
-                # Check meta tags
-                if "meta" in device and "tag" in device["meta"]:
-                    for tag in device["meta"]["tag"]:
-                        if tag.get("system") == "http://example.org/fhir/tags" and tag.get("code") == "shared-batch":
-                            shared_with_cro = True
-                            logger.debug(f"Batch {device_id} is shared via meta tags")
-                            break
-                
-                # Check extension
-                if not shared_with_cro and "extension" in device:
-                    shared_with_cro = any(
-                        ext.get("url") in [
-                            "http://example.org/fhir/StructureDefinition/shared-with-cro",
-                            "http://example.org/fhir/StructureDefinition/shared-with-organizations"
-                        ]
-                        for ext in device.get("extension", [])
-                    )
-                    if shared_with_cro:
-                        logger.debug(f"Batch {device_id} is shared via extension")
-                
-                # Include batch if shared and matches protocol filter (if provided)
+        for device in iter_fhir_resources("Device"):
+            device_id = device.get("id", "unknown")
+            device_protocol_id = None
+            extensions = ExtensionIndex(device)
+            
+            # Extract protocol ID from extension
+            for ref in extensions.values("http://example.org/fhir/StructureDefinition/batch-protocol"):
+                if ref.startswith("PlanDefinition/"):
+                    device_protocol_id = ref.split("/")[1]
+                    logger.debug("Found protocol ID %s in batch %s extension", device_protocol_id, device_id)
+                    break
+            
+            # Extract protocol ID from identifier
+            if not device_protocol_id and "identifier" in device:
+                for ident in device["identifier"]:
+                    if ident.get("system") == "http://example.org/fhir/identifier/protocol":
+                        device_protocol_id = ident.get("value")
+                        logger.debug("Found protocol ID %s in batch %s identifier", device_protocol_id, device_id)
+                        break
+            
+            # Check if this batch is shared with the CRO
+            shared_with_cro = False
+            
+            # Check meta tags
+            if "meta" in device and "tag" in device["meta"]:
+                for tag in device["meta"]["tag"]:
+                    if tag.get("system") == "http://example.org/fhir/tags" and tag.get("code") == "shared-batch":
+                        shared_with_cro = True
+                        logger.debug("Batch %s is shared via meta tags", device_id)
+                        break
+            
+            # Check extension
+            if not shared_with_cro:
+                shared_with_cro = (
+                    extensions.has("http://example.org/fhir/StructureDefinition/shared-with-cro") or
+                    extensions.has("http://example.org/fhir/StructureDefinition/shared-with-organizations")
+                )
                 if shared_with_cro:
-                    if not protocol_id or device_protocol_id == protocol_id:
-                        logger.info(f"Adding batch {device_id} to results (protocol ID: {device_protocol_id})")
-                        all_batches.append(convert_device_to_batch(device))
-                    else:
-                        logger.debug(f"Skipping batch {device_id} as it doesn't match protocol filter {protocol_id}")
+                    logger.debug("Batch %s is shared via extension", device_id)
+            
+            # Include batch if shared and matches protocol filter (if provided)
+            if shared_with_cro:
+                if not protocol_id or device_protocol_id == protocol_id:
+                    logger.debug("Adding batch %s to results (protocol ID: %s)", device_id, device_protocol_id)
+                    all_batches.append(convert_device_to_batch(device))
                 else:
-                    logger.debug(f"Skipping batch {device_id} as it's not shared with this CRO")
+                    logger.debug("Skipping batch %s as it doesn't match protocol filter %s", device_id, protocol_id)
+            else:
+                logger.debug("Skipping batch %s as it's not shared with this CRO", device_id)
     except Exception as e:
-        logger.error(f"Error fetching Device resources: {str(e)}")
+        logger.error("Error fetching Device resources: %s", e)
     
     # Now check for Medication resources (newer format)
     try:
-        medication_response = fetch_fhir_resource("Medication", params={
+        for medication in iter_fhir_resources("Medication", params={
             "_tag": "shared-batch"
-        })
-        logger.info(f"Fetched Medication resources, total entries: {len(medication_response.get('entry', []))}")
-        
-        if medication_response and medication_response.get("entry"):
-            for entry in medication_response.get("entry", []):
-                medication = entry["resource"]
-                medication_id = medication.get("id", "unknown")
+        }):
+            medication_id = medication.get("id", "unknown")
+            
+            # Extract protocol ID from identifiers
+            medication_protocol_id = None
+            if "identifier" in medication:
+                for ident in medication["identifier"]:
+                    if ident.get("system") == "http://example.org/fhir/identifier/protocol":
+                        medication_protocol_id = ident.get("value")
+                        logger.debug("Found protocol identifier %s in medication %s", medication_protocol_id, medication_id)
+                        break
+            
+            # If protocol matches, convert and add to results
+            if not protocol_id or medication_protocol_id == protocol_id:
+                logger.debug("Adding shared medication batch %s for protocol %s", medication_id, medication_protocol_id or 'unknown')
                 
-                # Extract protocol ID from identifiers
-                medication_protocol_id = None
-                if "identifier" in medication:
-                    for ident in medication["identifier"]:
-                        if ident.get("system") == "http://example.org/fhir/identifier/protocol":
-                            medication_protocol_id = ident.get("value")
-                            logger.debug(f"Found protocol identifier {medication_protocol_id} in medication {medication_id}")
-                            break
+                # Convert to Batch
+                lot_number = ""
+                if medication.get("batch") and "lotNumber" in medication["batch"]:
+                    lot_number = medication["batch"]["lotNumber"]
                 
-                # If protocol matches, convert and add to results
-                if not protocol_id or medication_protocol_id == protocol_id:
-                    logger.info(f"Adding shared medication batch {medication_id} for protocol {medication_protocol_id or 'unknown'}")
-                    
-                    # Convert to Batch
-                    lot_number = ""
-                    if medication.get("batch") and "lotNumber" in medication["batch"]:
-                        lot_number = medication["batch"]["lotNumber"]
-                    
-                    # Get manufacture date from extension
-                    manufacture_date = datetime.now().isoformat()
-                    if "extension" in medication:
-                        for ext in medication["extension"]:
-                            if ext.get("url") == "http://example.org/fhir/StructureDefinition/manufactureDate":
-                                if "valueDateTime" in ext:
-                                    manufacture_date = ext["valueDateTime"]
-                                    break
-                    
-                    # Get quantity
-                    quantity = 0
-                    if "extension" in medication:
-                        for ext in medication["extension"]:
-                            if ext.get("url") == "http://example.org/fhir/StructureDefinition/quantity":
-                                if "valueInteger" in ext:
-                                    quantity = ext["valueInteger"]
-                                    break
-                    
-                    # Create batch model
-                    batch = Batch(
-                        id=medication_id,
-                        protocol_id=medication_protocol_id or "",
-                        batch_number=lot_number or f"Batch {medication_id}",
-                        manufacture_date=manufacture_date,
-                        quantity=quantity,
-                        status="registered"
-                    )
-                    
-                    all_batches.append(batch)
+                # Get manufacture date and quantity from extensions
+                extensions = ExtensionIndex(medication)
+                manufacture_date = extensions.value("http://example.org/fhir/StructureDefinition/manufactureDate", datetime.now().isoformat())
+                quantity = extensions.value("http://example.org/fhir/StructureDefinition/quantity", 0)
+                
+                # Create batch model
+                batch = Batch(
+                    id=medication_id,
+                    protocol_id=medication_protocol_id or "",
+                    batch_number=lot_number or f"Batch {medication_id}",
+                    manufacture_date=manufacture_date,
+                    quantity=quantity,
+                    status="registered"
+                )
+                
+                all_batches.append(batch)
     except Exception as e:
-        logger.error(f"Error fetching Medication resources: {str(e)}")
+        logger.error("Error fetching Medication resources: %s", e)
     
-    logger.info(f"Returning {len(all_batches)} batches{' for protocol '+protocol_id if protocol_id else ''}")
-    return all_batches
+    logger.info("Returning %s batches%s", len(all_batches), ' for protocol '+protocol_id if protocol_id else '')
+    return list_response(all_batches, compact)
 
 @app.get("/batches/{batch_id}", response_model=Batch)
 def get_batch(batch_id: str):
@@ -1136,22 +1384,20 @@ def get_batch(batch_id: str):
                     break
         
         # Check extension
-        if not shared_with_cro and "extension" in device:
-            shared_with_cro = any(
-                ext.get("url") in [
-                    "http://example.org/fhir/StructureDefinition/shared-with-cro",
-                    "http://example.org/fhir/StructureDefinition/shared-with-organizations"
-                ]
-                for ext in device.get("extension", [])
+        if not shared_with_cro:
+            extensions = ExtensionIndex(device)
+            shared_with_cro = (
+                extensions.has("http://example.org/fhir/StructureDefinition/shared-with-cro") or
+                extensions.has("http://example.org/fhir/StructureDefinition/shared-with-organizations")
             )
         
         if shared_with_cro:
             return convert_device_to_batch(device)
         else:
-            logger.info(f"Device {batch_id} found but not shared with CRO, checking Medication resource")
+            logger.info("Device %s found but not shared with CRO, checking Medication resource", batch_id)
     except Exception as e:
         # Device not found or other error, try Medication
-        logger.info(f"Device {batch_id} not found, checking Medication resource: {str(e)}")
+        logger.info("Device %s not found, checking Medication resource: %s", batch_id, e)
     
     # If device not found or not shared, try Medication resource
     try:
@@ -1183,23 +1429,10 @@ def get_batch(batch_id: str):
                     protocol_id = ident.get("value")
                     break
         
-        # Get manufacture date from extension
-        manufacture_date = datetime.now().isoformat()
-        if "extension" in medication:
-            for ext in medication["extension"]:
-                if ext.get("url") == "http://example.org/fhir/StructureDefinition/manufactureDate":
-                    if "valueDateTime" in ext:
-                        manufacture_date = ext["valueDateTime"]
-                        break
-        
-        # Get quantity
-        quantity = 0
-        if "extension" in medication:
-            for ext in medication["extension"]:
-                if ext.get("url") == "http://example.org/fhir/StructureDefinition/quantity":
-                    if "valueInteger" in ext:
-                        quantity = ext["valueInteger"]
-                        break
+        # Get manufacture date and quantity from extensions
+        extensions = ExtensionIndex(medication)
+        manufacture_date = extensions.value("http://example.org/fhir/StructureDefinition/manufactureDate", datetime.now().isoformat())
+        quantity = extensions.value("http://example.org/fhir/StructureDefinition/quantity", 0)
         
         # Create batch model
         return Batch(
@@ -1220,11 +1453,10 @@ def get_batch(batch_id: str):
 
 # Test Results endpoints (full CRUD)
 @app.get("/results", response_model=List[TestResult])
-def get_test_results(batch_id: Optional[str] = None, test_id: Optional[str] = None):
+def get_test_results(batch_id: Optional[str] = None, test_id: Optional[str] = None, compact: bool = False):
     """Get all test results created by this CRO, with optional filters."""
     # Build query parameters
     params = {
-        "_count": 100,
         "category": "stability-test"
     }
     
@@ -1234,20 +1466,17 @@ def get_test_results(batch_id: Optional[str] = None, test_id: Optional[str] = No
     if test_id:
         params["code"] = test_id
     
-    # Query for results
-    response = fetch_fhir_resource("Observation", params=params)
-    
+    # Query for results, following every result page
     results = []
-    for entry in response.get("entry", []):
-        observation = entry["resource"]
+    for observation in iter_fhir_resources("Observation", params=params):
         results.append(convert_observation_to_test_result(observation))
     
-    return results
+    return list_response(results, compact)
 
 @app.post("/results")
 async def create_test_result(test_result: TestResult):
-    logger.info(f"Creating test result with data: {test_result.dict()}")
     """Create a new test result."""
+    log_payload("Creating test result", test_result)
     # Verify the batch exists and is shared with the CRO (if batch_id is provided)
     if test_result.batch_id:
         try:
@@ -1317,7 +1546,7 @@ async def create_test_result(test_result: TestResult):
     # If share_with_sponsor is True, forward to sponsor
     if test_result.share_with_sponsor:
         # Forward with sponsor_id to ensure it goes to the right organization
-        logger.info(f"Forwarding result to sponsor_id: {test_result.sponsor_id}")
+        logger.info("Forwarding result to sponsor_id: %s", test_result.sponsor_id)
         fhir_response = await forward_result_to_sponsor(result, sponsor_id=test_result.sponsor_id)
         
         # Store the FHIR server response in our response
@@ -1377,18 +1606,14 @@ def update_test_result(result_id: str, test_result: TestResult):
 
 # Organization endpoints
 @app.get("/organizations", response_model=List[Organization])
-def get_organizations():
+def get_organizations(compact: bool = False):
     """Get all organizations."""
     # Fetch all Organization resources
-    response = fetch_fhir_resource("Organization")
-    
     organizations = []
-    if response and response.get("entry"):
-        for entry in response.get("entry", []):
-            org = entry["resource"]
-            organizations.append(convert_fhir_organization_to_model(org))
-    
-    return organizations
+    for org in iter_fhir_resources("Organization"):
+        organizations.append(convert_fhir_organization_to_model(org))
+
+    return list_response(organizations, compact)
 
 @app.post("/organizations", response_model=Organization)
 def create_organization(organization: Organization):
@@ -1398,6 +1623,7 @@ def create_organization(organization: Organization):
     
     # Create in FHIR server
     result = create_fhir_resource("Organization", fhir_organization)
+    invalidate_organization_directory()
     
     # Return the created organization
     organization.id = result["id"]
@@ -1421,6 +1647,7 @@ def update_organization(org_id: str, organization: Organization):
     
     # Update in FHIR server
     result = update_fhir_resource("Organization", org_id, fhir_organization)
+    invalidate_organization_directory()
     
     # Return the updated organization
     organization.id = org_id
@@ -1434,8 +1661,9 @@ def delete_organization(org_id: str):
     
     # Delete from FHIR server - this might not be fully supported by all FHIR servers
     # Alternative: Set active=false
+    invalidate_organization_directory()
     try:
-        response = requests.delete(
+        response = http_session.delete(
             f"{FHIR_SERVER_URL}/Organization/{org_id}",
             headers={"Accept": "application/fhir+json"}
         )
@@ -1518,9 +1746,9 @@ def delete_test_result(result_id: str):
 
 # Sponsor integration endpoints
 @app.get("/sponsor/protocols")
-def get_sponsor_protocols():
+def get_sponsor_protocols(compact: bool = False):
     """Get protocols shared by the sponsor."""
-    return get_protocols()
+    return get_protocols(compact)
 
 @app.post("/sponsor/shared-resources")
 async def receive_shared_resources(bundle: Dict[str, Any]):
@@ -1530,12 +1758,36 @@ async def receive_shared_resources(bundle: Dict[str, Any]):
         
         if not bundle or bundle.get("resourceType") != "Bundle":
             raise HTTPException(status_code=400, detail="Invalid bundle format")
-        logger.info(f"Received bundle: {bundle}")
+        log_payload("Received bundle", bundle)
+        BUNDLE_ENTRIES.labels("share", "").observe(len(bundle.get("entry", [])))
         success_count = 0
         error_count = 0
         resource_types = {}
         
         for entry in bundle.get("entry", []):
+            # Resources the sponsor no longer shares arrive as DELETE entries
+            if entry.get("request", {}).get("method") == "DELETE":
+                resource_type, _, resource_id = entry["request"].get("url", "").partition("/")
+                if not resource_type or not resource_id:
+                    continue
+                
+                if resource_type not in resource_types:
+                    resource_types[resource_type] = {"success": 0, "error": 0}
+                
+                # Shared numeric IDs were stored with the 'id-' prefix
+                if resource_id.isdigit():
+                    resource_id = f"id-{resource_id}"
+                
+                try:
+                    delete_fhir_resource(resource_type, resource_id)
+                    success_count += 1
+                    resource_types[resource_type]["success"] += 1
+                except HTTPException as e:
+                    error_count += 1
+                    resource_types[resource_type]["error"] += 1
+                    logger.error("Failed to delete %s/%s: %s", resource_type, resource_id, e.detail)
+                continue
+            
             resource = entry.get("resource")
             if not resource:
                 continue
@@ -1555,10 +1807,10 @@ async def receive_shared_resources(bundle: Dict[str, Any]):
                 resource_id = f"id-{resource_id}"
                 resource["id"] = resource_id
                 
-            logger.info(f"Processing {resource_type}/{resource_id}")
+            logger.debug("Processing %s/%s", resource_type, resource_id)
             
             try:
-                response = requests.put(
+                response = http_session.put(
                     f"{FHIR_SERVER_URL}/{resource_type}/{resource_id}",
                     json=resource,
                     headers={
@@ -1570,22 +1822,26 @@ async def receive_shared_resources(bundle: Dict[str, Any]):
                 if response.status_code >= 200 and response.status_code < 300:
                     success_count += 1
                     resource_types[resource_type]["success"] += 1
-                    logger.info(f"Successfully created/updated {resource_type}/{resource_id}")
+                    logger.debug("Successfully created/updated %s/%s", resource_type, resource_id)
                 else:
                     error_count += 1
                     resource_types[resource_type]["error"] += 1
-                    logger.error(f"Failed to create/update {resource_type}/{resource_id}: {response.status_code}")
-                    logger.error(f"Response: {response.text}")
+                    logger.error("Failed to create/update %s/%s: %s", resource_type, resource_id, response.status_code)
+                    logger.error("Response: %s", response.text)
                     
             except Exception as e:
                 error_count += 1
                 resource_types[resource_type]["error"] += 1
-                logger.error(f"Error processing {resource_type}/{resource_id}: {str(e)}")
+                logger.error("Error processing %s/%s: %s", resource_type, resource_id, e)
                 
+        # Shared Organizations change what the directory knows
+        if "Organization" in resource_types:
+            invalidate_organization_directory()
+        
         # Log summary of resource types processed
         logger.info("Resource processing summary:")
         for rtype, counts in resource_types.items():
-            logger.info(f"{rtype}: {counts['success']} succeeded, {counts['error']} failed")
+            logger.info("%s: %s succeeded, %s failed", rtype, counts['success'], counts['error'])
                 
         return {
             "message": f"Processed {len(bundle.get('entry', []))} resources",
@@ -1595,160 +1851,130 @@ async def receive_shared_resources(bundle: Dict[str, Any]):
         }
         
     except Exception as e:
-        logger.error(f"Failed to process shared resources: {str(e)}")
+        logger.error("Failed to process shared resources: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to process shared resources: {str(e)}")
 
 @app.get("/sponsor/protocols/{protocol_id}/batches")
-def get_sponsor_protocol_batches(protocol_id: str):
+def get_sponsor_protocol_batches(protocol_id: str, compact: bool = False):
     """Get batches shared by the sponsor for a specific protocol."""
-    logger.info(f"Getting batches for sponsor protocol ID: {protocol_id}")
+    logger.info("Getting batches for sponsor protocol ID: %s", protocol_id)
     
     try:
-        # Get any shared batches
-        url = f"{FHIR_SERVER_URL}/Medication?_tag=shared-batch"
-        logger.info(f"Direct call to {url}")
-        
-        try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            response_data = response.json()
+        batches = []
+        for med in iter_fhir_resources("Medication", params={"_tag": "shared-batch"}):
+            logger.debug("Found shared batch: %s", med.get('id'))
             
-            batches = []
+            # Extract lot number
+            lot_number = ""
+            if "batch" in med and "lotNumber" in med["batch"]:
+                lot_number = med["batch"]["lotNumber"]
             
-            if response_data and "entry" in response_data:
-                for entry in response_data["entry"]:
-                    med = entry["resource"]
-                    logger.info(f"Found shared batch: {med.get('id')}")
-                    
-                    # Extract lot number
-                    lot_number = ""
-                    if "batch" in med and "lotNumber" in med["batch"]:
-                        lot_number = med["batch"]["lotNumber"]
-                    
-                    # Extract original protocol ID from identifier
-                    original_protocol_id = None
-                    if "identifier" in med:
-                        for ident in med["identifier"]:
-                            if ident.get("system") == "http://example.org/fhir/identifier/protocol":
-                                original_protocol_id = ident.get("value")
-                                break
-                    
-                    # Only include batches that match the requested protocol ID
-                    if original_protocol_id == protocol_id:
-                        # Create batch object with original protocol ID
-                        batch = Batch(
-                            id=med.get("id"),
-                            protocol_id=original_protocol_id,  # Use original protocol ID
-                            batch_number=lot_number or f"Shared Batch {med.get('id')}",
-                            manufacture_date=datetime.now().isoformat(),
-                            quantity=1,
-                            status="registered"
-                        )
-                        batches.append(batch)
-                        logger.info(f"Added batch {med.get('id')} with original protocol ID {original_protocol_id}")
-                    
-            logger.info(f"Returning {len(batches)} batches for protocol ID {protocol_id}")
-            return batches
+            # Extract original protocol ID from identifier
+            original_protocol_id = None
+            if "identifier" in med:
+                for ident in med["identifier"]:
+                    if ident.get("system") == "http://example.org/fhir/identifier/protocol":
+                        original_protocol_id = ident.get("value")
+                        break
             
-        except Exception as e:
-            logger.error(f"Error calling FHIR server: {str(e)}")
-            return []
+            # Only include batches that match the requested protocol ID
+            if original_protocol_id == protocol_id:
+                # Create batch object with original protocol ID
+                batch = Batch(
+                    id=med.get("id"),
+                    protocol_id=original_protocol_id,  # Use original protocol ID
+                    batch_number=lot_number or f"Shared Batch {med.get('id')}",
+                    manufacture_date=datetime.now().isoformat(),
+                    quantity=1,
+                    status="registered"
+                )
+                batches.append(batch)
+                logger.debug("Added batch %s with original protocol ID %s", med.get('id'), original_protocol_id)
+                
+        logger.info("Returning %s batches for protocol ID %s", len(batches), protocol_id)
+        return list_response(batches, compact)
             
     except Exception as e:
-        logger.error(f"Error in get_sponsor_protocol_batches: {str(e)}")
+        logger.error("Error in get_sponsor_protocol_batches: %s", e)
         return []
 
 @app.get("/debug/medications")
 def get_medications_debug(protocol_id: Optional[str] = None):
     """Debug endpoint to get all Medication resources, optionally filtered by protocol ID."""
     try:
-        params = {"_count": 100}
+        params = {}
         if protocol_id:
             params["identifier"] = f"http://example.org/fhir/identifier/protocol|{protocol_id}"
         
-        medication_response = fetch_fhir_resource("Medication", params=params)
-        return medication_response
+        medications = list(iter_fhir_resources("Medication", params=params))
+        return {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(medications),
+            "entry": [{"resource": medication} for medication in medications]
+        }
     except Exception as e:
-        logger.error(f"Error fetching Medication resources: {str(e)}")
+        logger.error("Error fetching Medication resources: %s", e)
         raise HTTPException(status_code=500, detail=f"Error fetching Medication resources: {str(e)}")
 
 @app.get("/debug/protocol-batches/{original_protocol_id}")
 def get_batches_by_original_protocol_id(original_protocol_id: str):
     """Debug endpoint to get all batches related to the original sponsor protocol ID."""
-    logger.info(f"Looking for batches with original sponsor protocol ID: {original_protocol_id}")
+    logger.info("Looking for batches with original sponsor protocol ID: %s", original_protocol_id)
     try:
         # Get all Medication resources with shared-batch tag
-        response = fetch_fhir_resource("Medication", params={
-            "_tag": "shared-batch"
-        })
-        
         batches = []
         
-        if response and response.get("entry"):
-            for entry in response.get("entry", []):
-                medication = entry["resource"]
-                medication_id = medication.get("id", "unknown")
-                
-                # Check if this matches the original protocol ID
-                is_match = False
+        for medication in iter_fhir_resources("Medication", params={
+            "_tag": "shared-batch"
+        }):
+            medication_id = medication.get("id", "unknown")
+            
+            # Check if this matches the original protocol ID
+            is_match = False
+            
+            # Check in identifiers
+            if "identifier" in medication:
+                for ident in medication["identifier"]:
+                    if ident.get("system") == "http://example.org/fhir/identifier/protocol":
+                        if ident.get("value") == original_protocol_id:
+                            is_match = True
+                            logger.debug("Found matching batch %s for original protocol ID %s", medication_id, original_protocol_id)
+                            break
+            
+            # Check in extension
+            extensions = ExtensionIndex(medication)
+            if not is_match:
+                for ref in extensions.values("http://example.org/fhir/StructureDefinition/batch-protocol"):
+                    if f"PlanDefinition/{original_protocol_id}" in ref or f"urn:uuid:{original_protocol_id}" in ref:
+                        is_match = True
+                        logger.debug("Found matching batch %s for original protocol ID %s via extension", medication_id, original_protocol_id)
+                        break
+            
+            if is_match:
+                # Convert to Batch
+                lot_number = ""
+                if medication.get("batch") and "lotNumber" in medication["batch"]:
+                    lot_number = medication["batch"]["lotNumber"]
                 
-                # Check in identifiers
-                if "identifier" in medication:
-                    for ident in medication["identifier"]:
-                        if ident.get("system") == "http://example.org/fhir/identifier/protocol":
-                            if ident.get("value") == original_protocol_id:
-                                is_match = True
-                                logger.info(f"Found matching batch {medication_id} for original protocol ID {original_protocol_id}")
-                                break
+                # Get manufacture date and quantity from extensions
+                manufacture_date = extensions.value("http://example.org/fhir/StructureDefinition/manufactureDate", datetime.now().isoformat())
+                quantity = extensions.value("http://example.org/fhir/StructureDefinition/quantity", 0)
                 
-                # Check in extension
-                if not is_match and "extension" in medication:
-                    for ext in medication["extension"]:
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/batch-protocol":
-                            ref = ext.get("valueReference", {}).get("reference", "")
-                            if f"PlanDefinition/{original_protocol_id}" in ref or f"urn:uuid:{original_protocol_id}" in ref:
-                                is_match = True
-                                logger.info(f"Found matching batch {medication_id} for original protocol ID {original_protocol_id} via extension")
-                                break
+                batch = Batch(
+                    id=medication_id,
+                    protocol_id=original_protocol_id,
+                    batch_number=lot_number or f"Batch {medication_id}",
+                    manufacture_date=manufacture_date,
+                    quantity=quantity,
+                    status="registered"
+                )
                 
-                if is_match:
-                    # Convert to Batch
-                    lot_number = ""
-                    if medication.get("batch") and "lotNumber" in medication["batch"]:
-                        lot_number = medication["batch"]["lotNumber"]
-                    
-                    # Get manufacture date from extension
-                    manufacture_date = datetime.now().isoformat()
-                    if "extension" in medication:
-                        for ext in medication["extension"]:
-                            if ext.get("url") == "http://example.org/fhir/StructureDefinition/manufactureDate":
-                                if "valueDateTime" in ext:
-                                    manufacture_date = ext["valueDateTime"]
-                                    break
-                    
-                    # Get quantity
-                    quantity = 0
-                    if "extension" in medication:
-                        for ext in medication["extension"]:
-                            if ext.get("url") == "http://example.org/fhir/StructureDefinition/quantity":
-                                if "valueInteger" in ext:
-                                    quantity = ext["valueInteger"]
-                                    break
-                    
-                    batch = Batch(
-                        id=medication_id,
-                        protocol_id=original_protocol_id,
-                        batch_number=lot_number or f"Batch {medication_id}",
-                        manufacture_date=manufacture_date,
-                        quantity=quantity,
-                        status="registered"
-                    )
-                    
-                    batches.append(batch)
-        
+                batches.append(batch)
+    
         return batches
     except Exception as e:
-        logger.error(f"Error fetching batches for original protocol ID {original_protocol_id}: {str(e)}")
+        logger.error("Error fetching batches for original protocol ID %s: %s", original_protocol_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
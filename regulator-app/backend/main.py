@@ -1,18 +1,25 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, ORJSONResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import requests
+from requests.adapters import HTTPAdapter
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+from starlette.routing import Match
 import os
 import json
 from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
 import logging
+import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Regulator Stability Testing API")
+app = FastAPI(title="Regulator Stability Testing API", default_response_class=ORJSONResponse)
 
 # CORS configuration
 app.add_middleware(
@@ -25,6 +32,103 @@ app.add_middleware(
 
 # Configuration
 FHIR_SERVER_URL = os.getenv("FHIR_SERVER_URL", "http://host.docker.internal:8083/fhir")
+# Page size requested from the FHIR server when walking searchset bundles
+FHIR_PAGE_SIZE = int(os.getenv("FHIR_PAGE_SIZE", "100"))
+
+# Prometheus metrics, served in text format on GET /metrics
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent handling API requests",
+    ["method", "route", "status"]
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "API requests currently being handled",
+    ["method", "route"]
+)
+UPSTREAM_LATENCY = Histogram(
+    "fhir_request_duration_seconds", "Time until response headers for outbound FHIR calls",
+    ["upstream", "resource_type", "interaction"]
+)
+UPSTREAM_IN_PROGRESS = Gauge(
+    "fhir_requests_in_progress", "Outbound FHIR calls waiting for a response",
+    ["upstream"]
+)
+BUNDLE_ENTRIES = Histogram(
+    "fhir_bundle_entries", "Entries per FHIR Bundle page received or Bundle sent",
+    ["bundle_type", "resource_type"],
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+
+def fhir_call_labels(method, url):
+    """
+    Label an outbound call with its upstream, resource type and FHIR interaction.
+
+    Calls to our own FHIR server are "fhir", everything else is "external".
+    The resource type is the first capitalized path segment, so it is found
+    behind any base path.
+    """
+    upstream = "fhir" if url.startswith(FHIR_SERVER_URL) else "external"
+    segments = [segment for segment in urlsplit(url).path.split("/") if segment]
+    for index, segment in enumerate(segments):
+        if segment[:1].isupper():
+            resource_type, rest = segment, segments[index + 1:]
+            break
+    else:
+        # Transactions are posted to the base; paging links also point at the base
+        return upstream, "", "transaction" if method == "POST" else "search"
+    
+    if rest and rest[0].startswith("$"):
+        interaction = "operation"
+    elif "_history" in rest:
+        interaction = "vread" if len(rest) > 2 else "history"
+    elif not rest or rest[0] == "_search":
+        interaction = {"GET": "search", "POST": "search" if rest else "create", "PUT": "update", "DELETE": "delete"}.get(method, method.lower())
+    else:
+        interaction = {"GET": "read", "PUT": "update", "DELETE": "delete", "PATCH": "patch"}.get(method, method.lower())
+    return upstream, resource_type, interaction
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTP adapter that times every outbound call for the upstream metrics."""
+    
+    def send(self, request, **kwargs):
+        upstream, resource_type, interaction = fhir_call_labels(request.method, request.url)
+        in_progress = UPSTREAM_IN_PROGRESS.labels(upstream)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            UPSTREAM_LATENCY.labels(upstream, resource_type, interaction).observe(time.perf_counter() - started)
+            in_progress.dec()
+
+# Session used for every FHIR call, so connections are reused and timed
+http_session = requests.Session()
+http_session.mount("http://", InstrumentedAdapter())
+http_session.mount("https://", InstrumentedAdapter())
+
+def route_template(scope):
+    """Return the path template of the route a request will hit, to keep metric labels bounded."""
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Track in-flight requests and latency per route template."""
+    method = request.method
+    route = route_template(request.scope)
+    in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+    in_progress.inc()
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        REQUEST_LATENCY.labels(method, route, status).observe(time.perf_counter() - started)
+        in_progress.dec()
 
 # Models
 class StabilityTestResult(BaseModel):
@@ -43,6 +147,16 @@ class StabilityTestResult(BaseModel):
     cro: Optional[str] = None
     comments: Optional[str] = None
 
+class CompactJSONResponse(ORJSONResponse):
+    """orjson response that also leaves out null fields, for ?compact=true on list endpoints."""
+    
+    def render(self, content):
+        return super().render(jsonable_encoder(content, exclude_none=True))
+
+def list_response(content, compact=False):
+    """Return list endpoint content unchanged, or as a CompactJSONResponse when the client asked for compact output."""
+    return CompactJSONResponse(content) if compact else content
+
 # Helper functions
 def fetch_fhir_resource(resource_type, resource_id=None, params=None):
     """Fetch FHIR resources from the HAPI FHIR server."""
@@ -55,7 +169,7 @@ def fetch_fhir_resource(resource_type, resource_id=None, params=None):
         logger.info(f"With parameters: {params}")
     
     try:
-        response = requests.get(url, params=params)
+        response = http_session.get(url, params=params)
         logger.info(f"FHIR server response status: {response.status_code}")
         response.raise_for_status()
         return response.json()
@@ -65,6 +179,44 @@ def fetch_fhir_resource(resource_type, resource_id=None, params=None):
         logger.error(f"Error occurred with URL: {url}")
         raise HTTPException(status_code=500, detail=error_msg)
 
+def _rebase_fhir_url(url):
+    """Point a server-generated paging link back at FHIR_SERVER_URL."""
+    base = urlsplit(FHIR_SERVER_URL)
+    link = urlsplit(url)
+    if (link.scheme, link.netloc) == (base.scheme, base.netloc):
+        return url
+    return urlunsplit((base.scheme, base.netloc, link.path, link.query, link.fragment))
+
+def iter_fhir_resources(resource_type, params=None):
+    """Yield every resource matched by a FHIR search, following Bundle.link[relation=next]."""
+    url = f"{FHIR_SERVER_URL}/{resource_type}"
+    params = {"_count": FHIR_PAGE_SIZE, **(params or {})}
+    
+    while url:
+        logger.info(f"Fetching search page from FHIR server URL: {url}")
+        try:
+            response = http_session.get(url, params=params)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            error_msg = f"FHIR server error: {str(e)}"
+            logger.error(error_msg)
+            logger.error(f"Error occurred with URL: {url}")
+            raise HTTPException(status_code=500, detail=error_msg)
+        
+        bundle = response.json()
+        entries = bundle.get("entry", [])
+        BUNDLE_ENTRIES.labels("searchset", resource_type).observe(len(entries))
+        for entry in entries:
+            if entry.get("resource"):
+                yield entry["resource"]
+        
+        url = None
+        params = None
+        for link in bundle.get("link", []):
+            if link.get("relation") == "next" and link.get("url"):
+                url = _rebase_fhir_url(link["url"])
+                break
+
 def create_fhir_resource(resource_type, data):
     """Create a FHIR resource on the HAPI FHIR server."""
     url = f"{FHIR_SERVER_URL}/{resource_type}"
@@ -73,7 +225,7 @@ def create_fhir_resource(resource_type, data):
     logger.info(f"Resource data: {json.dumps(data, indent=2)}")
     
     try:
-        response = requests.post(
+        response = http_session.post(
             url, 
             json=data,
             headers={
@@ -91,72 +243,133 @@ def create_fhir_resource(resource_type, data):
         logger.error(f"Error occurred with URL: {url}")
         raise HTTPException(status_code=500, detail=error_msg)
 
+class ExtensionIndex:
+    """
+    Extensions of a FHIR resource indexed by URL in a single pass.
+
+    Nested extensions are indexed together with their parent, so complex
+    extensions can be read without scanning the resource again. value()
+    returns the typed value of an extension: the string, boolean, date or
+    number, or the reference string of a valueReference.
+    """
+    
+    VALUE_KEYS = ("valueString", "valueBoolean", "valueDateTime", "valueInteger", "valueDecimal", "valueCode", "valueUri")
+    
+    def __init__(self, resource):
+        self.extensions = {}
+        self.children = {}
+        for ext in (resource or {}).get("extension", []):
+            url = ext.get("url")
+            self.extensions.setdefault(url, []).append(ext)
+            if ext.get("extension"):
+                self.children.setdefault(url, []).append(ExtensionIndex(ext))
+    
+    @classmethod
+    def typed_value(cls, ext):
+        """Return the value of a single extension, or None if it has none."""
+        if "valueReference" in ext:
+            return ext["valueReference"].get("reference")
+        for key in cls.VALUE_KEYS:
+            if key in ext:
+                return ext[key]
+        return None
+    
+    def has(self, url):
+        """Check whether any extension with this URL is present."""
+        return url in self.extensions
+    
+    def first(self, url):
+        """Return the first extension with this URL as stored, or None."""
+        matches = self.extensions.get(url)
+        return matches[0] if matches else None
+    
+    def value(self, url, default=None):
+        """Return the first value found for this URL."""
+        for ext in self.extensions.get(url, []):
+            value = self.typed_value(ext)
+            if value is not None:
+                return value
+        return default
+    
+    def values(self, url):
+        """Return every value found for this URL."""
+        values = []
+        for ext in self.extensions.get(url, []):
+            value = self.typed_value(ext)
+            if value is not None:
+                values.append(value)
+        return values
+    
+    def nested(self, url):
+        """Return the index of the nested extensions of the first extension with this URL."""
+        children = self.children.get(url)
+        return children[0] if children else ExtensionIndex(None)
+    
+    def nested_values(self, url):
+        """Return the values of every nested extension under every extension with this URL."""
+        values = []
+        for child in self.children.get(url, []):
+            for nested_url in child.extensions:
+                values.extend(child.values(nested_url))
+        return values
+
 # API Endpoints
 @app.get("/")
 def read_root():
     return {"message": "Welcome to Regulator Stability Testing API"}
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Expose request, upstream FHIR and bundle metrics in Prometheus text format."""
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
 @app.get("/stability-results")
-def get_stability_results():
+def get_stability_results(compact: bool = False):
     """Get all stability test results."""
     try:
-        # Fetch all Observation resources with stability-test category
-        response = fetch_fhir_resource("Observation", params={
-            "_count": 100,
-            "category": "stability-test"
-        })
-        
+        # Fetch every page of Observation resources with stability-test category
         results = []
-        if response and response.get("entry"):
-            for entry in response.get("entry", []):
-                observation = entry["resource"]
-                
-                # Extract test details from the observation
-                test_type = observation.get("code", {}).get("text", "Unknown")
-                timepoint = ""
-                condition = ""
-                sponsor = "Unknown"
-                cro = "Unknown"
-                
-                # Extract timepoint and condition from extensions
-                for ext in observation.get("extension", []):
-                    if ext.get("url") == "http://example.org/fhir/StructureDefinition/protocol-timepoint":
-                        timepoint = ext.get("valueString", "")
-                    elif ext.get("url") == "http://example.org/fhir/StructureDefinition/test-condition":
-                        condition = ext.get("valueString", "")
-                    elif ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor":
-                        sponsor = ext.get("valueString", "")
-                    elif ext.get("url") == "http://example.org/fhir/StructureDefinition/cro":
-                        cro = ext.get("valueString", "")
-                
-                # Get value and unit
-                value = None
-                unit = ""
-                if "valueQuantity" in observation:
-                    value = observation["valueQuantity"].get("value")
-                    unit = observation["valueQuantity"].get("unit", "")
-                
-                # Create result object
-                result = StabilityTestResult(
-                    id=observation.get("id"),
-                    protocol_id=observation.get("basedOn", [{}])[0].get("reference", "").replace("PlanDefinition/", ""),
-                    batch_id=observation.get("subject", {}).get("reference", "").replace("Device/", ""),
-                    test_type=test_type,
-                    timepoint=timepoint,
-                    condition=condition,
-                    result_value=value if value is not None else 0.0,
-                    unit=unit,
-                    acceptance_criteria="Within specification",  # This would come from the test definition
-                    status=observation.get("status", "unknown"),
-                    test_date=observation.get("effectiveDateTime", datetime.now().isoformat()),
-                    sponsor=sponsor,
-                    cro=cro,
-                    comments=observation.get("note", [{"text": ""}])[0].get("text", "")
-                )
-                
-                results.append(result)
-        
-        return results
+        for observation in iter_fhir_resources("Observation", params={
+            "category": "stability-test"
+        }):
+            # Extract test details from the observation
+            test_type = observation.get("code", {}).get("text", "Unknown")
+            
+            # Extract timepoint, condition, sponsor and CRO from extensions
+            extensions = ExtensionIndex(observation)
+            timepoint = extensions.value("http://example.org/fhir/StructureDefinition/protocol-timepoint", "")
+            condition = extensions.value("http://example.org/fhir/StructureDefinition/test-condition", "")
+            sponsor = extensions.value("http://example.org/fhir/StructureDefinition/sponsor", "Unknown")
+            cro = extensions.value("http://example.org/fhir/StructureDefinition/cro", "Unknown")
+            
+            # Get value and unit
+            value = None
+            unit = ""
+            if "valueQuantity" in observation:
+                value = observation["valueQuantity"].get("value")
+                unit = observation["valueQuantity"].get("unit", "")
+            
+            # Create result object
+            result = StabilityTestResult(
+                id=observation.get("id"),
+                protocol_id=observation.get("basedOn", [{}])[0].get("reference", "").replace("PlanDefinition/", ""),
+                batch_id=observation.get("subject", {}).get("reference", "").replace("Device/", ""),
+                test_type=test_type,
+                timepoint=timepoint,
+                condition=condition,
+                result_value=value if value is not None else 0.0,
+                unit=unit,
+                acceptance_criteria="Within specification",  # This would come from the test definition
+                status=observation.get("status", "unknown"),
+                test_date=observation.get("effectiveDateTime", datetime.now().isoformat()),
+                sponsor=sponsor,
+                cro=cro,
+                comments=observation.get("note", [{"text": ""}])[0].get("text", "")
+            )
+            
+            results.append(result)
+    
+        return list_response(results, compact)
     except Exception as e:
         logger.error(f"Error fetching stability results: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -169,21 +382,13 @@ def get_stability_result(result_id: str):
         
         # Extract test details from the observation
         test_type = observation.get("code", {}).get("text", "Unknown")
-        timepoint = ""
-        condition = ""
-        sponsor = "Unknown"
-        cro = "Unknown"
         
-        # Extract timepoint and condition from extensions
-        for ext in observation.get("extension", []):
-            if ext.get("url") == "http://example.org/fhir/StructureDefinition/protocol-timepoint":
-                timepoint = ext.get("valueString", "")
-            elif ext.get("url") == "http://example.org/fhir/StructureDefinition/test-condition":
-                condition = ext.get("valueString", "")
-            elif ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor":
-                sponsor = ext.get("valueString", "")
-            elif ext.get("url") == "http://example.org/fhir/StructureDefinition/cro":
-                cro = ext.get("valueString", "")
+        # Extract timepoint, condition, sponsor and CRO from extensions
+        extensions = ExtensionIndex(observation)
+        timepoint = extensions.value("http://example.org/fhir/StructureDefinition/protocol-timepoint", "")
+        condition = extensions.value("http://example.org/fhir/StructureDefinition/test-condition", "")
+        sponsor = extensions.value("http://example.org/fhir/StructureDefinition/sponsor", "Unknown")
+        cro = extensions.value("http://example.org/fhir/StructureDefinition/cro", "Unknown")
         
         # Get value and unit
         value = None
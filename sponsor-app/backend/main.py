@@ -1,13 +1,248 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
-import requests
+from fastapi.responses import StreamingResponse, Response, ORJSONResponse
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, ValidationError
+from typing import List, Optional, Dict, Any, AsyncIterator, Callable, Union
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit, urlencode
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.routing import Match
+import httpx
+import orjson
+import numpy as np
+import asyncio
 import os
+import time
 import json
+import copy
+import functools
+import hashlib
+import logging
+import random
+import re
+import contextvars
+from collections import OrderedDict
 from datetime import datetime
 import uuid
-app = FastAPI(title="Protocol Management API")
+
+# FHIR Server Configuration
+FHIR_SERVER_URL = os.environ.get("FHIR_SERVER_URL", "http://localhost:8082/fhir")
+# Port that this server is running on (for self-references)
+SPONSOR_SERVER_URL = os.environ.get("SPONSOR_SERVER_URL", "http://localhost:8002")
+
+# Connection pool and timeout settings for outbound FHIR/CRO calls
+FHIR_MAX_CONNECTIONS = int(os.environ.get("FHIR_MAX_CONNECTIONS", "100"))
+FHIR_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("FHIR_MAX_KEEPALIVE_CONNECTIONS", "20"))
+FHIR_KEEPALIVE_EXPIRY = float(os.environ.get("FHIR_KEEPALIVE_EXPIRY", "30"))
+FHIR_CONNECT_TIMEOUT = float(os.environ.get("FHIR_CONNECT_TIMEOUT", "5"))
+FHIR_READ_TIMEOUT = float(os.environ.get("FHIR_READ_TIMEOUT", "30"))
+FHIR_POOL_TIMEOUT = float(os.environ.get("FHIR_POOL_TIMEOUT", "10"))
+# Page size requested from the FHIR server when walking searchset bundles
+FHIR_PAGE_SIZE = int(os.environ.get("FHIR_PAGE_SIZE", "100"))
+# Searches a single request runs against the FHIR server at the same time
+SEARCH_MAX_CONCURRENCY = int(os.environ.get("SEARCH_MAX_CONCURRENCY", "4"))
+# How many organizations a protocol is pushed to at once, and how long each push may take
+SHARE_MAX_CONCURRENCY = int(os.environ.get("SHARE_MAX_CONCURRENCY", "5"))
+SHARE_TARGET_TIMEOUT = float(os.environ.get("SHARE_TARGET_TIMEOUT", "60"))
+# Seconds the in-process organization directory is trusted before it is reloaded
+ORGANIZATION_CACHE_TTL = float(os.environ.get("ORGANIZATION_CACHE_TTL", "300"))
+# Number of finished share jobs kept in memory for status queries
+SHARE_JOB_HISTORY = int(os.environ.get("SHARE_JOB_HISTORY", "100"))
+# Entries per transaction Bundle for the bulk endpoints, and how many Bundles are in flight at once
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "50"))
+BULK_MAX_CONCURRENCY = int(os.environ.get("BULK_MAX_CONCURRENCY", "4"))
+# Protocols, tests and observation/specimen definitions kept for revalidation with If-None-Match
+DEFINITION_CACHE_SIZE = int(os.environ.get("DEFINITION_CACHE_SIZE", "512"))
+# Attempts for version-checked protocol updates that keep hitting concurrent edits (412)
+UPDATE_RETRY_ATTEMPTS = max(1, int(os.environ.get("UPDATE_RETRY_ATTEMPTS", "3")))
+# Cached responses of the list endpoints (/protocols, /tests, ...) and how long they are served
+LIST_CACHE_SIZE = int(os.environ.get("LIST_CACHE_SIZE", "128"))
+LIST_CACHE_TTL = float(os.environ.get("LIST_CACHE_TTL", "30"))
+# Log level, and the fraction of DEBUG payload dumps that are actually written
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+
+# Logging: key=value lines tagged with the correlation id of the request being handled.
+# The id is taken from the X-Correlation-ID request header or generated, echoed on the
+# response and passed on to the CRO systems we call.
+CORRELATION_ID_HEADER = "X-Correlation-ID"
+correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar("correlation_id", default="-")
+
+class CorrelationIdFilter(logging.Filter):
+    """Stamp each log record with the current correlation id"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+log_handler = logging.StreamHandler()
+log_handler.addFilter(CorrelationIdFilter())
+log_handler.setFormatter(logging.Formatter(
+    "time=%(asctime)s level=%(levelname)s logger=%(name)s correlation_id=%(correlation_id)s msg=%(message)s"
+))
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(log_handler)
+logger.propagate = False
+
+def log_payload(message: str, payload: Any):
+    """
+    Log a resource, bundle or request model at DEBUG.
+
+    Nothing is serialized unless DEBUG is enabled and the dump is picked by
+    LOG_PAYLOAD_SAMPLE_RATE, so callers can pass whole bundles on hot paths.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if LOG_PAYLOAD_SAMPLE_RATE < 1.0 and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    if isinstance(payload, BaseModel):
+        payload = payload.dict(exclude_none=True)
+    logger.debug("%s: %s", message, json.dumps(payload, default=str))
+
+# Prometheus metrics, served in text format on GET /metrics
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent handling API requests",
+    ["method", "route", "status"]
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "API requests currently being handled",
+    ["method", "route"]
+)
+UPSTREAM_LATENCY = Histogram(
+    "fhir_request_duration_seconds", "Time until response headers for outbound FHIR calls",
+    ["upstream", "resource_type", "interaction"]
+)
+UPSTREAM_IN_PROGRESS = Gauge(
+    "fhir_requests_in_progress", "Outbound FHIR calls waiting for a response",
+    ["upstream"]
+)
+BUNDLE_ENTRIES = Histogram(
+    "fhir_bundle_entries", "Entries per FHIR Bundle page received or Bundle sent",
+    ["bundle_type", "resource_type"],
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+COALESCED_READS = Counter(
+    "fhir_coalesced_reads", "FHIR reads answered by an identical request already in flight",
+    ["resource_type"]
+)
+
+def fhir_call_labels(method: str, url: str) -> tuple:
+    """
+    Label an outbound call with its upstream, resource type and FHIR interaction.
+
+    Calls to our own FHIR server are "fhir", everything else (CRO servers and
+    middleware) is "external". The resource type is the first capitalized path
+    segment, so it is found behind any base path.
+    """
+    upstream = "fhir" if url.startswith(FHIR_SERVER_URL) else "external"
+    segments = [segment for segment in urlsplit(url).path.split("/") if segment]
+    for index, segment in enumerate(segments):
+        if segment[:1].isupper():
+            resource_type, rest = segment, segments[index + 1:]
+            break
+    else:
+        # Transactions are posted to the base; paging links also point at the base
+        return upstream, "", "transaction" if method == "POST" else "search"
+    
+    if rest and rest[0].startswith("$"):
+        interaction = "operation"
+    elif "_history" in rest:
+        interaction = "vread" if len(rest) > 2 else "history"
+    elif not rest or rest[0] == "_search":
+        interaction = {"GET": "search", "POST": "search" if rest else "create", "PUT": "update", "DELETE": "delete"}.get(method, method.lower())
+    else:
+        interaction = {"GET": "read", "PUT": "update", "DELETE": "delete", "PATCH": "patch"}.get(method, method.lower())
+    return upstream, resource_type, interaction
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Transport wrapper that times every outbound call for the upstream metrics"""
+    
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        upstream, resource_type, interaction = fhir_call_labels(request.method, str(request.url))
+        in_progress = UPSTREAM_IN_PROGRESS.labels(upstream)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            return await self.transport.handle_async_request(request)
+        finally:
+            UPSTREAM_LATENCY.labels(upstream, resource_type, interaction).observe(time.perf_counter() - started)
+            in_progress.dec()
+    
+    async def aclose(self):
+        await self.transport.aclose()
+
+# GETs to the FHIR server currently in flight. Concurrent callers asking for the same URL,
+# query and headers await the one upstream request instead of sending their own.
+inflight_fhir_reads: Dict[tuple, asyncio.Future] = {}
+
+async def fhir_get(url: str, params: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+    """
+    GET from the FHIR server, sharing the upstream request with identical concurrent calls
+
+    The response body is read completely before it is handed out, so every caller
+    can use json(), content and raise_for_status() on it independently. The
+    upstream request is shielded, so a caller that gives up does not cancel it
+    for the others.
+    """
+    key = (str(httpx.URL(url, params=params)), tuple(sorted((headers or {}).items())))
+    in_flight = inflight_fhir_reads.get(key)
+    if in_flight is None:
+        in_flight = asyncio.ensure_future(fhir_client.get(url, params=params, headers=headers))
+        inflight_fhir_reads[key] = in_flight
+        
+        def forget(done: asyncio.Future):
+            if inflight_fhir_reads.get(key) is done:
+                del inflight_fhir_reads[key]
+            # Mark the outcome as retrieved even if every caller went away
+            if not done.cancelled():
+                done.exception()
+        
+        in_flight.add_done_callback(forget)
+    else:
+        COALESCED_READS.labels(fhir_call_labels("GET", key[0])[1]).inc()
+    return await asyncio.shield(in_flight)
+
+def route_template(scope: Dict[str, Any]) -> str:
+    """Return the path template of the route a request will hit, to keep metric labels bounded"""
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+# Shared async HTTP client, opened and closed with the application lifespan
+fhir_client: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open one pooled keep-alive client for the lifetime of the app"""
+    global fhir_client
+    fhir_client = httpx.AsyncClient(
+        transport=InstrumentedTransport(httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=FHIR_MAX_CONNECTIONS,
+                max_keepalive_connections=FHIR_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=FHIR_KEEPALIVE_EXPIRY
+            )
+        )),
+        timeout=httpx.Timeout(
+            FHIR_READ_TIMEOUT,
+            connect=FHIR_CONNECT_TIMEOUT,
+            pool=FHIR_POOL_TIMEOUT
+        )
+    )
+    await register_custom_search_parameters()
+    try:
+        yield
+    finally:
+        await fhir_client.aclose()
+        fhir_client = None
+
+app = FastAPI(title="Protocol Management API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Configure CORS
 app.add_middleware(
@@ -16,12 +251,602 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[CORRELATION_ID_HEADER],
 )
 
-# FHIR Server Configuration
-FHIR_SERVER_URL = os.environ.get("FHIR_SERVER_URL", "http://localhost:8082/fhir")
-# Port that this server is running on (for self-references)
-SPONSOR_SERVER_URL = os.environ.get("SPONSOR_SERVER_URL", "http://localhost:8002")
+@app.middleware("http")
+async def assign_correlation_id(request: Request, call_next):
+    """Run the request under the caller's correlation id, or a new one"""
+    request_correlation_id = request.headers.get(CORRELATION_ID_HEADER) or uuid.uuid4().hex
+    token = correlation_id.set(request_correlation_id)
+    try:
+        response = await call_next(request)
+    finally:
+        correlation_id.reset(token)
+    response.headers[CORRELATION_ID_HEADER] = request_correlation_id
+    return response
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Track in-flight requests and latency per route template"""
+    method = request.method
+    route = route_template(request.scope)
+    in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+    in_progress.inc()
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        REQUEST_LATENCY.labels(method, route, status).observe(time.perf_counter() - started)
+        in_progress.dec()
+
+# Custom SearchParameters for our extensions: code -> (base resource type, extension URL)
+CUSTOM_SEARCH_PARAMETERS = {
+    "stability-test-protocol": ("ActivityDefinition", "http://example.org/fhir/StructureDefinition/stability-test-protocol"),
+    "batch-protocol": ("Medication", "http://example.org/fhir/StructureDefinition/batch-protocol"),
+    "test-definition": ("Observation", "http://example.org/fhir/StructureDefinition/test-definition"),
+    "result-organization": ("Observation", "http://example.org/fhir/StructureDefinition/result-organization"),
+}
+
+# Codes of the custom SearchParameters the FHIR server has accepted
+supported_search_parameters = set()
+
+async def register_custom_search_parameters():
+    """
+    Create or update the SearchParameters for our reference extensions.
+
+    HAPI reindexes existing resources in the background when a SearchParameter
+    is created or changed, and until that has finished a search on it silently
+    misses them. A code is therefore only added to supported_search_parameters
+    when its SearchParameter was already registered unchanged, or when there
+    are no resources of its type yet to reindex. Other codes, and any code the
+    server refuses, are filtered in Python until the next start.
+    """
+    for code, (base, extension_url) in CUSTOM_SEARCH_PARAMETERS.items():
+        search_parameter = {
+            "resourceType": "SearchParameter",
+            "id": code,
+            "url": f"http://example.org/fhir/SearchParameter/{code}",
+            "name": code,
+            "status": "active",
+            "description": f"Search {base} by the {code} extension reference",
+            "code": code,
+            "base": [base],
+            "type": "reference",
+            "expression": f"{base}.extension('{extension_url}').value.as(Reference)"
+        }
+        try:
+            existing = await fhir_get(
+                f"{FHIR_SERVER_URL}/SearchParameter/{code}",
+                headers={"Accept": "application/fhir+json"}
+            )
+            unchanged = existing.status_code == 200 and all(
+                existing.json().get(key) == search_parameter[key]
+                for key in ("url", "code", "base", "type", "expression", "status")
+            )
+            if not unchanged:
+                response = await fhir_client.put(
+                    f"{FHIR_SERVER_URL}/SearchParameter/{code}",
+                    json=search_parameter,
+                    headers={
+                        "Content-Type": "application/fhir+json",
+                        "Accept": "application/fhir+json"
+                    }
+                )
+                response.raise_for_status()
+                
+                count_response = await fhir_get(
+                    f"{FHIR_SERVER_URL}/{base}",
+                    params={"_summary": "count"},
+                    headers={"Accept": "application/fhir+json"}
+                )
+                count_response.raise_for_status()
+                if count_response.json().get("total", 0):
+                    logger.info(
+                        "SearchParameter %s was registered; existing %s resources are being reindexed, filtering in Python until the next start",
+                        code, base
+                    )
+                    continue
+            supported_search_parameters.add(code)
+        except httpx.HTTPError as e:
+            logger.warning("Could not register SearchParameter %s, filtering in Python instead: %s", code, e)
+
+class ExtensionIndex:
+    """
+    Extensions of a FHIR resource indexed by URL in a single pass.
+
+    Nested extensions are indexed together with their parent, so complex
+    extensions can be read without scanning the resource again. value()
+    returns the typed value of an extension: the string, boolean, date or
+    number, or the reference string of a valueReference.
+    """
+    
+    VALUE_KEYS = ("valueString", "valueBoolean", "valueDateTime", "valueInteger", "valueDecimal", "valueCode", "valueUri")
+    
+    def __init__(self, resource: Optional[Dict[str, Any]]):
+        self.extensions: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        self.children: Dict[Optional[str], List["ExtensionIndex"]] = {}
+        for ext in (resource or {}).get("extension", []):
+            url = ext.get("url")
+            self.extensions.setdefault(url, []).append(ext)
+            if ext.get("extension"):
+                self.children.setdefault(url, []).append(ExtensionIndex(ext))
+    
+    @classmethod
+    def typed_value(cls, ext: Dict[str, Any]) -> Any:
+        """Return the value of a single extension, or None if it has none"""
+        if "valueReference" in ext:
+            return ext["valueReference"].get("reference")
+        for key in cls.VALUE_KEYS:
+            if key in ext:
+                return ext[key]
+        return None
+    
+    def has(self, url: str) -> bool:
+        """Check whether any extension with this URL is present"""
+        return url in self.extensions
+    
+    def first(self, url: str) -> Optional[Dict[str, Any]]:
+        """Return the first extension with this URL as stored, or None"""
+        matches = self.extensions.get(url)
+        return matches[0] if matches else None
+    
+    def value(self, url: str, default: Any = None) -> Any:
+        """Return the first value found for this URL"""
+        for ext in self.extensions.get(url, []):
+            value = self.typed_value(ext)
+            if value is not None:
+                return value
+        return default
+    
+    def values(self, url: str) -> List[Any]:
+        """Return every value found for this URL"""
+        values = []
+        for ext in self.extensions.get(url, []):
+            value = self.typed_value(ext)
+            if value is not None:
+                values.append(value)
+        return values
+    
+    def nested(self, url: str) -> "ExtensionIndex":
+        """Return the index of the nested extensions of the first extension with this URL"""
+        children = self.children.get(url)
+        return children[0] if children else ExtensionIndex(None)
+    
+    def nested_values(self, url: str) -> List[Any]:
+        """Return the values of every nested extension under every extension with this URL"""
+        values = []
+        for child in self.children.get(url, []):
+            for nested_url in child.extensions:
+                values.extend(child.values(nested_url))
+        return values
+
+def has_extension_reference(resource: Dict[str, Any], extension_url: str, reference: str) -> bool:
+    """Check whether a resource carries a reference extension pointing at the given reference"""
+    return reference in ExtensionIndex(resource).values(extension_url)
+
+# FHIR search helpers
+def _rebase_fhir_url(url: str) -> str:
+    """Point a server-generated paging link back at FHIR_SERVER_URL"""
+    base = urlsplit(FHIR_SERVER_URL)
+    link = urlsplit(url)
+    if (link.scheme, link.netloc) == (base.scheme, base.netloc):
+        return url
+    return urlunsplit((base.scheme, base.netloc, link.path, link.query, link.fragment))
+
+async def iter_fhir_search(resource_type: str, params: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield every entry of a FHIR search, one page at a time.
+
+    Follows Bundle.link[relation=next] until the server stops returning one,
+    so callers see the whole result set without holding it all in memory.
+    """
+    next_url = f"{FHIR_SERVER_URL}/{resource_type}"
+    next_params = {"_count": FHIR_PAGE_SIZE, **(params or {})}
+    while next_url:
+        response = await fhir_get(
+            next_url,
+            params=next_params,
+            headers={"Accept": "application/fhir+json"}
+        )
+        response.raise_for_status()
+        bundle = response.json()
+        entries = bundle.get("entry") or []
+        BUNDLE_ENTRIES.labels("searchset", resource_type).observe(len(entries))
+        for entry in entries:
+            yield entry
+        
+        next_url = None
+        next_params = None
+        for link in bundle.get("link", []):
+            if link.get("relation") == "next" and link.get("url"):
+                next_url = _rebase_fhir_url(link["url"])
+                break
+
+class CompactJSONResponse(ORJSONResponse):
+    """orjson response that also leaves out null fields, for ?compact=true on list endpoints"""
+    def render(self, content: Any) -> bytes:
+        return super().render(jsonable_encoder(content, exclude_none=True))
+
+def list_response(content: Any, compact: bool = False) -> Any:
+    """Return list endpoint content unchanged, or as a CompactJSONResponse when the client asked for compact output"""
+    return CompactJSONResponse(content) if compact else content
+
+async def stream_search_bundle(entries: AsyncIterator[Dict[str, Any]], compact: bool = False) -> StreamingResponse:
+    """
+    Stream entries to the client as a searchset Bundle while pages arrive.
+
+    The first entry is pulled before the response starts so that errors on
+    the initial FHIR request still surface as a normal HTTP error. Once the
+    200 has been sent, an error on a later page is logged and the Bundle is
+    closed with an OperationOutcome entry (search.mode "outcome") so clients
+    can tell it is incomplete; the response is then marked truncated so it
+    is not cached. Entries are encoded with orjson; compact also leaves out
+    null fields.
+    """
+    try:
+        first_entry = await entries.__anext__()
+    except StopAsyncIteration:
+        first_entry = None
+    
+    def encode(entry: Dict[str, Any]) -> bytes:
+        return orjson.dumps(jsonable_encoder(entry, exclude_none=True) if compact else entry)
+    
+    async def body():
+        yield b'{"resourceType":"Bundle","type":"searchset","entry":['
+        count = 0
+        if first_entry is not None:
+            yield encode(first_entry)
+            count = 1
+            try:
+                async for entry in entries:
+                    yield b"," + encode(entry)
+                    count += 1
+            except Exception as e:
+                logger.error("Search results truncated after %s entries: %s", count, e)
+                response.truncated = True
+                yield b"," + encode({
+                    "resource": {
+                        "resourceType": "OperationOutcome",
+                        "issue": [{
+                            "severity": "error",
+                            "code": "incomplete",
+                            "diagnostics": f"Search results are incomplete, the FHIR server failed after {count} entries: {e}"
+                        }]
+                    },
+                    "search": {"mode": "outcome"}
+                })
+        yield b'],"total":%d}' % count
+    
+    response = StreamingResponse(body(), media_type="application/json")
+    response.truncated = False
+    return response
+
+# Read-through cache for the list endpoints the dashboard polls. Responses are keyed by
+# route and query parameters, expire after LIST_CACHE_TTL seconds and are evicted by our
+# own write handlers. The generation of a route is bumped on every eviction so a response
+# that was being read while a write happened is not stored.
+list_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+list_cache_generations: Dict[str, int] = {}
+
+def passthrough_response(content: bytes, content_type: str, status_code: int = 200) -> Response:
+    """Send upstream FHIR JSON to the client byte for byte, without parsing or re-encoding it"""
+    return Response(content=content, status_code=status_code, media_type=content_type)
+
+def evict_list_cache(route: str, **params):
+    """
+    Drop cached responses of a list route after one of our writes
+
+    Without params every cached variant of the route goes. With params only the
+    unfiltered response and the ones filtered on those values go, so
+    evict_list_cache("/tests", protocol_id="1") keeps /tests?protocol_id=2.
+    """
+    list_cache_generations[route] = list_cache_generations.get(route, 0) + 1
+    for key in [key for key in list_cache if key[0] == route]:
+        query = dict(key[1])
+        if all(query.get(name) in (None, value) for name, value in params.items()):
+            del list_cache[key]
+
+def cached_list_response(route: str):
+    """
+    Serve a streaming list endpoint from list_cache when possible
+
+    On a miss the response still streams to the client and its body is stored
+    once it has been sent completely. Fallback payloads returned as plain dicts
+    (e.g. an empty Bundle on errors) are never cached.
+    """
+    def decorator(endpoint: Callable) -> Callable:
+        @functools.wraps(endpoint)
+        async def wrapper(**params):
+            key = (route, tuple(sorted((name, value) for name, value in params.items() if value is not None)))
+            cached = list_cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                list_cache.move_to_end(key)
+                return Response(cached[1], media_type=cached[2])
+            
+            generation = list_cache_generations.get(route, 0)
+            response = await endpoint(**params)
+            if not isinstance(response, StreamingResponse):
+                return response
+            
+            body_iterator = response.body_iterator
+            
+            async def record_body():
+                chunks = []
+                async for chunk in body_iterator:
+                    chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode())
+                    yield chunk
+                if not getattr(response, "truncated", False) and list_cache_generations.get(route, 0) == generation:
+                    list_cache[key] = (time.monotonic() + LIST_CACHE_TTL, b"".join(chunks), response.media_type)
+                    list_cache.move_to_end(key)
+                    while len(list_cache) > LIST_CACHE_SIZE:
+                        list_cache.popitem(last=False)
+            
+            response.body_iterator = record_body()
+            return response
+        return wrapper
+    return decorator
+
+async def iter_extension_search(resource_type: str, references: Dict[str, str], params: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield entries whose custom reference extensions match the given references.
+
+    references maps a CUSTOM_SEARCH_PARAMETERS code to the expected reference.
+    Codes the FHIR server supports are sent as search parameters so HAPI does
+    the filtering; the rest are checked in Python while the pages stream past.
+    """
+    def matches(codes):
+        return lambda resource: all(
+            has_extension_reference(resource, CUSTOM_SEARCH_PARAMETERS[code][1], references[code])
+            for code in codes
+        )
+    
+    server_codes = [code for code in references if code in supported_search_parameters]
+    local_codes = [code for code in references if code not in supported_search_parameters]
+    
+    if server_codes:
+        search_params = {**(params or {}), **{code: references[code] for code in server_codes}}
+        yielded = False
+        try:
+            async for entry in filter_entries(iter_fhir_search(resource_type, search_params), matches(local_codes)):
+                yielded = True
+                yield entry
+            return
+        except httpx.HTTPStatusError as e:
+            # An unknown search parameter is rejected before the first page. This can be
+            # a registry that has not refreshed yet or a malformed reference, so only
+            # this search falls back and the next one asks the server again
+            if yielded or e.response.status_code != 400:
+                raise
+            logger.warning("FHIR server rejected %s, filtering this search in Python instead", server_codes)
+    
+    async for entry in filter_entries(iter_fhir_search(resource_type, params), matches(list(references))):
+        yield entry
+
+async def filter_entries(entries: AsyncIterator[Dict[str, Any]], predicate: Callable[[Dict[str, Any]], bool]) -> AsyncIterator[Dict[str, Any]]:
+    """Yield only the entries whose resource matches the predicate"""
+    async for entry in entries:
+        if predicate(entry.get("resource", {})):
+            yield entry
+
+async def read_resources_by_id(resource_type: str, resource_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Load several resources of one type with _id searches instead of one read each.
+
+    Returns a dict keyed by resource ID; IDs the server does not know are
+    simply absent from the result.
+    """
+    resources = {}
+    unique_ids = list(dict.fromkeys(resource_ids))
+    for start in range(0, len(unique_ids), FHIR_PAGE_SIZE):
+        chunk = unique_ids[start:start + FHIR_PAGE_SIZE]
+        async for entry in iter_fhir_search(resource_type, {"_id": ",".join(chunk)}):
+            resource = entry.get("resource", {})
+            if resource.get("id"):
+                resources[resource["id"]] = resource
+    return resources
+
+# Definitional resources (protocols, tests and observation/specimen definitions) cached
+# by reference with their ETag. Every read is revalidated with If-None-Match, so a 304
+# is answered from memory; our own writes drop the entry.
+definition_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def invalidate_definition(reference: str):
+    """Drop a cached definitional resource, given as "Type/id" or a transaction request URL"""
+    resource_type, _, resource_id = reference.split("?")[0].partition("/")
+    definition_cache.pop(f"{resource_type}/{resource_id.split('/')[0]}", None)
+
+async def read_definition_raw(resource_type: str, resource_id: str) -> tuple:
+    """
+    Read a definitional resource as (JSON bytes, content type), revalidating the cached copy with its ETag
+
+    Raises httpx.HTTPStatusError like a plain read when the server answers with
+    an error.
+    """
+    reference = f"{resource_type}/{resource_id}"
+    cached = definition_cache.get(reference)
+    headers = {"Accept": "application/fhir+json"}
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    
+    response = await fhir_get(f"{FHIR_SERVER_URL}/{reference}", headers=headers)
+    if response.status_code == 304 and cached:
+        definition_cache.move_to_end(reference)
+        return cached[1], cached[2]
+    if response.status_code in (404, 410):
+        definition_cache.pop(reference, None)
+    response.raise_for_status()
+    
+    content_type = response.headers.get("content-type", "application/fhir+json")
+    etag = response.headers.get("ETag")
+    if etag:
+        definition_cache[reference] = (etag, response.content, content_type)
+        definition_cache.move_to_end(reference)
+        while len(definition_cache) > DEFINITION_CACHE_SIZE:
+            definition_cache.popitem(last=False)
+    return response.content, content_type
+
+async def read_definition(resource_type: str, resource_id: str) -> Dict[str, Any]:
+    """
+    Read a definitional resource through the cache
+
+    The cache keeps the raw JSON bytes, so every caller gets its own parsed
+    copy and can mutate it freely.
+    """
+    content, _ = await read_definition_raw(resource_type, resource_id)
+    return json.loads(content)
+
+async def update_definition(resource_type: str, resource_id: str, mutate: Callable[[Dict[str, Any]], None]) -> Dict[str, Any]:
+    """
+    Read a definitional resource, apply mutate to it and write it back with If-Match
+
+    When the resource was changed by someone else in between, the server answers
+    412 and the read, mutation and write are repeated, up to UPDATE_RETRY_ATTEMPTS
+    times in total. Returns the updated resource; raises HTTPException 409 when
+    every attempt conflicted and httpx errors for anything else.
+    """
+    reference = f"{resource_type}/{resource_id}"
+    for attempt in range(1, UPDATE_RETRY_ATTEMPTS + 1):
+        resource = await read_definition(resource_type, resource_id)
+        headers = {
+            "Content-Type": "application/fhir+json",
+            "Accept": "application/fhir+json"
+        }
+        version_id = resource.get("meta", {}).get("versionId")
+        if version_id:
+            headers["If-Match"] = f'W/"{version_id}"'
+        mutate(resource)
+        
+        invalidate_definition(reference)
+        response = await fhir_client.put(f"{FHIR_SERVER_URL}/{reference}", json=resource, headers=headers)
+        if response.status_code != 412:
+            response.raise_for_status()
+            return response.json()
+        if attempt < UPDATE_RETRY_ATTEMPTS:
+            logger.info("%s was modified concurrently, reapplying update (attempt %s of %s)", reference, attempt, UPDATE_RETRY_ATTEMPTS)
+    
+    raise HTTPException(status_code=409, detail=f"{reference} kept changing while it was being updated, please retry")
+
+async def submit_fhir_transaction(entries: List[Dict[str, Any]], return_resources: bool = False) -> Dict[str, Any]:
+    """
+    Submit entries to the local FHIR server as one transaction Bundle
+
+    With return_resources the server is asked (Prefer: return=representation)
+    to include the stored resources in the response entries; by default HAPI
+    only returns their location and status.
+    """
+    BUNDLE_ENTRIES.labels("transaction", "").observe(len(entries))
+    for entry in entries:
+        if entry["request"]["method"] in ("PUT", "PATCH", "DELETE"):
+            invalidate_definition(entry["request"]["url"])
+    headers = {
+        "Content-Type": "application/fhir+json",
+        "Accept": "application/fhir+json"
+    }
+    if return_resources:
+        headers["Prefer"] = "return=representation"
+    response = await fhir_client.post(
+        FHIR_SERVER_URL,
+        json={
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": entries
+        },
+        headers=headers
+    )
+    response.raise_for_status()
+    return response.json()
+
+async def bulk_create(
+    items: List[Dict[str, Any]],
+    model: type,
+    build_resource: Callable[[Any], Dict[str, Any]],
+    chunk_size: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Validate items with the model and create them as chunked transaction Bundles.
+
+    Items that fail validation are reported and left out. The rest are split
+    into Bundles of chunk_size entries which are submitted up to
+    BULK_MAX_CONCURRENCY at a time. A transaction is all or nothing, so every
+    item of a rejected chunk is reported with that chunk's error. Items the
+    transaction response has no entry for are reported as failed as well.
+    """
+    chunk_size = max(1, chunk_size or BULK_CHUNK_SIZE)
+    outcomes: List[Dict[str, Any]] = [None] * len(items)
+    pending = []
+    
+    for index, item in enumerate(items):
+        try:
+            resource = build_resource(model(**item))
+        except ValidationError as e:
+            outcomes[index] = {
+                "index": index,
+                "status": "invalid",
+                "errors": [{"loc": list(error["loc"]), "msg": error["msg"]} for error in e.errors()]
+            }
+            continue
+        pending.append((index, {
+            "fullUrl": f"urn:uuid:{uuid.uuid4()}",
+            "resource": resource,
+            "request": {
+                "method": "POST",
+                "url": resource["resourceType"]
+            }
+        }))
+    
+    semaphore = asyncio.Semaphore(BULK_MAX_CONCURRENCY)
+    
+    async def submit_chunk(chunk):
+        async with semaphore:
+            try:
+                transaction_response = await submit_fhir_transaction([entry for _, entry in chunk])
+            except httpx.HTTPError as e:
+                error_message = str(e)
+                if isinstance(e, httpx.HTTPStatusError):
+                    error_message = e.response.text or error_message
+                logger.error("Bulk transaction of %s entries failed: %s", len(chunk), error_message)
+                for index, _ in chunk:
+                    outcomes[index] = {"index": index, "status": "failed", "error": error_message}
+                return
+            except Exception as e:
+                # Never let one chunk cancel the others, whose items may already be committed
+                logger.exception("Bulk transaction of %s entries failed", len(chunk))
+                for index, _ in chunk:
+                    outcomes[index] = {"index": index, "status": "failed", "error": str(e) or type(e).__name__}
+                return
+        
+        for (index, _), response_entry in zip(chunk, transaction_response.get("entry", [])):
+            location = (response_entry.get("response") or {}).get("location", "")
+            outcomes[index] = {
+                "index": index,
+                "status": "created",
+                "id": location.split("/")[1] if "/" in location else None,
+                "location": location
+            }
+        
+        for index, _ in chunk:
+            if outcomes[index] is None:
+                outcomes[index] = {
+                    "index": index,
+                    "status": "failed",
+                    "error": "The transaction response has no entry for this item"
+                }
+    
+    await asyncio.gather(*(
+        submit_chunk(pending[start:start + chunk_size])
+        for start in range(0, len(pending), chunk_size)
+    ))
+    
+    return {
+        "total": len(items),
+        "created": sum(1 for outcome in outcomes if outcome["status"] == "created"),
+        "failed": sum(1 for outcome in outcomes if outcome["status"] != "created"),
+        "results": outcomes
+    }
 
 class PlanDefinitionCreate(BaseModel):
     title: str
@@ -68,6 +893,7 @@ class ProtocolShareRequest(BaseModel):
     selected_tests: Optional[List[str]] = []  # IDs of selected tests when share_mode is 'specificTests'
     shareBatches: Optional[bool] = True  # Whether to share batches
     selectedBatches: Optional[List[str]] = []  # IDs of selected batches to share
+    force_full_share: Optional[bool] = False  # Send every resource, not just the ones changed since the last share
 
 class TestDefinitionCreate(BaseModel):
     title: str
@@ -98,6 +924,7 @@ class TestResultCreate(BaseModel):
     result_date: str
     status: str = "completed"
     comments: Optional[str] = None
+    storage_condition: Optional[str] = None  # e.g. 25C/60%RH, used to group results for shelf-life estimation
 
 class MedicinalProductCreate(BaseModel):
     name: str
@@ -161,31 +988,27 @@ class EnhancedTestDefinitionCreate(BaseModel):
 def read_root():
     return {"message": "Protocol Management API is running"}
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Expose request, upstream FHIR and bundle metrics in Prometheus text format"""
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
 @app.get("/protocols")
-async def get_protocols():
-    """Get all protocols (PlanDefinition resources)"""
+@cached_list_response("/protocols")
+async def get_protocols(compact: bool = False):
+    """Get all protocols (PlanDefinition resources), streamed across every result page"""
     try:
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/PlanDefinition",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
+        return await stream_search_bundle(iter_fhir_search("PlanDefinition"), compact)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch protocols: {str(e)}")
 
 @app.get("/protocols/{protocol_id}")
 async def get_protocol(protocol_id: str):
     """Get a specific protocol by ID"""
     try:
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+        return passthrough_response(*await read_definition_raw("PlanDefinition", protocol_id))
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch protocol: {str(e)}")
 
@@ -278,8 +1101,8 @@ async def create_protocol(protocol: PlanDefinitionCreate):
             # Remove stability_tests from top level
             if "stability_tests" in protocol_data:
                 del protocol_data["stability_tests"]
-        print(f"protocol_data is:{protocol_data}")
-        response = requests.post(
+        log_payload("Creating PlanDefinition", protocol_data)
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/PlanDefinition",
             json=protocol_data,
             headers={
@@ -288,8 +1111,9 @@ async def create_protocol(protocol: PlanDefinitionCreate):
             }
         )
         response.raise_for_status()
+        evict_list_cache("/protocols")
         return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -304,148 +1128,135 @@ async def create_protocol(protocol: PlanDefinitionCreate):
 async def update_protocol(protocol_id: str, protocol_update: PlanDefinitionUpdate):
     """Update an existing protocol"""
     try:
-        # First get the existing protocol
-        try:
-            get_response = requests.get(
-                f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
-                headers={"Accept": "application/fhir+json"}
-            )
-            get_response.raise_for_status()
-            existing_protocol = get_response.json()
-        except requests.RequestException as e:
-            if e.response and e.response.status_code == 404:
-                raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
-            raise e
-        
-        # Update the protocol with new values
-        update_data = protocol_update.dict(exclude_none=True)
-        
-        # Make sure extension array exists
-        if "extension" not in existing_protocol:
-            existing_protocol["extension"] = []
+        def apply_update(existing_protocol: Dict[str, Any]):
+            """Apply the requested changes to the stored protocol; rerun on every retry"""
+            # Update the protocol with new values
+            update_data = protocol_update.dict(exclude_none=True)
+            
+            # Make sure extension array exists
+            if "extension" not in existing_protocol:
+                existing_protocol["extension"] = []
 
-        # Get sponsor details from the request if provided
-        sponsor_name = protocol_update.sponsor_name
-        sponsor_id = protocol_update.sponsor_id
-        
-        # Handle medicinal product reference update
-        if "medicinal_product_id" in update_data:
-            medicinal_product_id = update_data.pop("medicinal_product_id")
-            if medicinal_product_id:
-                # Add medicinal product reference using extension
-                # Check if we already have a medicinal product extension
-                has_extension = False
-                for i, ext in enumerate(existing_protocol.get("extension", [])):
-                    if ext.get("url") == "http://example.org/fhir/StructureDefinition/medicinal-product":
-                        # Update existing extension
-                        existing_protocol["extension"][i] = {
+            # Get sponsor details from the request if provided
+            sponsor_name = protocol_update.sponsor_name
+            sponsor_id = protocol_update.sponsor_id
+            
+            # Handle medicinal product reference update
+            if "medicinal_product_id" in update_data:
+                medicinal_product_id = update_data.pop("medicinal_product_id")
+                if medicinal_product_id:
+                    # Add medicinal product reference using extension
+                    # Check if we already have a medicinal product extension
+                    has_extension = False
+                    for i, ext in enumerate(existing_protocol.get("extension", [])):
+                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/medicinal-product":
+                            # Update existing extension
+                            existing_protocol["extension"][i] = {
+                                "url": "http://example.org/fhir/StructureDefinition/medicinal-product",
+                                "valueReference": {
+                                    "reference": f"MedicinalProductDefinition/{medicinal_product_id}"
+                                }
+                            }
+                            has_extension = True
+                            break
+                
+                    if not has_extension:
+                        # Add new extension
+                        existing_protocol.setdefault("extension", []).append({
                             "url": "http://example.org/fhir/StructureDefinition/medicinal-product",
                             "valueReference": {
                                 "reference": f"MedicinalProductDefinition/{medicinal_product_id}"
                             }
-                        }
-                        has_extension = True
-                        break
+                        })
                 
-                if not has_extension:
-                    # Add new extension
-                    existing_protocol.setdefault("extension", []).append({
-                        "url": "http://example.org/fhir/StructureDefinition/medicinal-product",
-                        "valueReference": {
-                            "reference": f"MedicinalProductDefinition/{medicinal_product_id}"
-                        }
+                    # Set the subjectReference field according to FHIR spec
+                    existing_protocol["subjectReference"] = {
+                        "reference": f"MedicinalProductDefinition/{medicinal_product_id}"
+                    }
+                else:
+                    # Remove the medicinal product reference if it exists
+                    existing_protocol["extension"] = [
+                        ext for ext in existing_protocol.get("extension", []) 
+                        if ext.get("url") != "http://example.org/fhir/StructureDefinition/medicinal-product"
+                    ]
+                
+                    # Remove the subjectReference if it exists
+                    if "subjectReference" in existing_protocol:
+                        del existing_protocol["subjectReference"]
+            
+            # Remove these from update_data since they're not part of FHIR PlanDefinition
+            if "sponsor_name" in update_data:
+                del update_data["sponsor_name"]
+            if "sponsor_id" in update_data:
+                del update_data["sponsor_id"]
+            
+            # Check if sponsor extension exists
+            sponsor_ext_exists = False
+            sponsor_id_ext_exists = False
+            
+            # Update or add sponsor info only if provided in the request
+            if sponsor_name is not None or sponsor_id is not None:
+                for ext in existing_protocol["extension"]:
+                    if ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor" and sponsor_name is not None:
+                        ext["valueString"] = sponsor_name
+                        sponsor_ext_exists = True
+                    elif ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor-id" and sponsor_id is not None:
+                        ext["valueString"] = sponsor_id
+                        sponsor_id_ext_exists = True
+            
+                # Add sponsor extension if it doesn't exist and was provided
+                if not sponsor_ext_exists and sponsor_name is not None:
+                    existing_protocol["extension"].append({
+                        "url": "http://example.org/fhir/StructureDefinition/sponsor",
+                        "valueString": sponsor_name
                     })
                 
-                # Set the subjectReference field according to FHIR spec
-                existing_protocol["subjectReference"] = {
-                    "reference": f"MedicinalProductDefinition/{medicinal_product_id}"
-                }
-            else:
-                # Remove the medicinal product reference if it exists
+                # Add sponsor ID extension if it doesn't exist and was provided
+                if not sponsor_id_ext_exists and sponsor_id is not None:
+                    existing_protocol["extension"].append({
+                        "url": "http://example.org/fhir/StructureDefinition/sponsor-id",
+                        "valueString": sponsor_id
+                    })
+            
+            # Special handling for stability_tests
+            if "stability_tests" in update_data:
+                stability_tests = update_data.pop("stability_tests")
+            
+                # Find and remove existing stability test extension
                 existing_protocol["extension"] = [
-                    ext for ext in existing_protocol.get("extension", []) 
-                    if ext.get("url") != "http://example.org/fhir/StructureDefinition/medicinal-product"
+                    ext for ext in existing_protocol["extension"] 
+                    if ext.get("url") != "http://example.org/fhir/StructureDefinition/stability-test-definitions"
                 ]
                 
-                # Remove the subjectReference if it exists
-                if "subjectReference" in existing_protocol:
-                    del existing_protocol["subjectReference"]
-        
-        # Remove these from update_data since they're not part of FHIR PlanDefinition
-        if "sponsor_name" in update_data:
-            del update_data["sponsor_name"]
-        if "sponsor_id" in update_data:
-            del update_data["sponsor_id"]
-            
-        # Check if sponsor extension exists
-        sponsor_ext_exists = False
-        sponsor_id_ext_exists = False
-        
-        # Update or add sponsor info only if provided in the request
-        if sponsor_name is not None or sponsor_id is not None:
-            for ext in existing_protocol["extension"]:
-                if ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor" and sponsor_name is not None:
-                    ext["valueString"] = sponsor_name
-                    sponsor_ext_exists = True
-                elif ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor-id" and sponsor_id is not None:
-                    ext["valueString"] = sponsor_id
-                    sponsor_id_ext_exists = True
-            
-            # Add sponsor extension if it doesn't exist and was provided
-            if not sponsor_ext_exists and sponsor_name is not None:
-                existing_protocol["extension"].append({
-                    "url": "http://example.org/fhir/StructureDefinition/sponsor",
-                    "valueString": sponsor_name
-                })
-                
-            # Add sponsor ID extension if it doesn't exist and was provided
-            if not sponsor_id_ext_exists and sponsor_id is not None:
-                existing_protocol["extension"].append({
-                    "url": "http://example.org/fhir/StructureDefinition/sponsor-id",
-                    "valueString": sponsor_id
-                })
-            
-        # Special handling for stability_tests
-        if "stability_tests" in update_data:
-            stability_tests = update_data.pop("stability_tests")
+                # Add updated stability tests as extension
+                if stability_tests:
+                    existing_protocol["extension"].append({
+                        "url": "http://example.org/fhir/StructureDefinition/stability-test-definitions",
+                        "extension": [
+                            {
+                                "url": "test",
+                                "valueReference": {
+                                    "reference": f"ActivityDefinition/{test['id']}" if 'id' in test else None,
+                                    "_resource": test
+                                }
+                            } for test in stability_tests
+                        ]
+                    })
             
-            # Find and remove existing stability test extension
-            existing_protocol["extension"] = [
-                ext for ext in existing_protocol["extension"] 
-                if ext.get("url") != "http://example.org/fhir/StructureDefinition/stability-test-definitions"
-            ]
-                
-            # Add updated stability tests as extension
-            if stability_tests:
-                existing_protocol["extension"].append({
-                    "url": "http://example.org/fhir/StructureDefinition/stability-test-definitions",
-                    "extension": [
-                        {
-                            "url": "test",
-                            "valueReference": {
-                                "reference": f"ActivityDefinition/{test['id']}" if 'id' in test else None,
-                                "_resource": test
-                            }
-                        } for test in stability_tests
-                    ]
-                })
+            # Update other fields
+            for key, value in update_data.items():
+                existing_protocol[key] = value
         
-        # Update other fields
-        for key, value in update_data.items():
-            existing_protocol[key] = value
-        
-        # Send the updated protocol back to the FHIR server
-        response = requests.put(
-            f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
-            json=existing_protocol,
-            headers={
-                "Content-Type": "application/fhir+json",
-                "Accept": "application/fhir+json"
-            }
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
+        # Send the updated protocol back with If-Match, reapplying the changes if it was edited concurrently
+        try:
+            updated_protocol = await update_definition("PlanDefinition", protocol_id, apply_update)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
+            raise
+        evict_list_cache("/protocols")
+        return updated_protocol
+    except httpx.HTTPError as e:
         if not isinstance(e, HTTPException):
             error_message = str(e)
             if hasattr(e, 'response') and e.response:
@@ -462,41 +1273,105 @@ async def update_protocol(protocol_id: str, protocol_update: PlanDefinitionUpdat
 async def delete_protocol(protocol_id: str):
     """Delete a protocol"""
     try:
-        response = requests.delete(
+        invalidate_definition(f"PlanDefinition/{protocol_id}")
+        response = await fhir_client.delete(
             f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
             headers={"Accept": "application/fhir+json"}
         )
         response.raise_for_status()
+        evict_list_cache("/protocols")
         return {"message": f"Protocol {protocol_id} deleted successfully"}
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to delete protocol: {str(e)}")
 
-# Organization management endpoints using FHIR Organization resources
+def organization_settings(org: Dict[str, Any]) -> Dict[str, str]:
+    """Pull the URL, API key and type out of an Organization's extensions in one pass"""
+    extensions = ExtensionIndex(org)
+    # The first non-empty value wins
+    return {
+        key: next((value for value in extensions.values(url) if value), "")
+        for key, url in (
+            ("url", "http://example.org/fhir/StructureDefinition/organization-url"),
+            ("api_key", "http://example.org/fhir/StructureDefinition/organization-api-key"),
+            ("type", "http://example.org/fhir/StructureDefinition/organization-type")
+        )
+    }
+
+# Organization directory: every Organization with its settings already extracted,
+# indexed by ID, identifier value and name. Reloaded after ORGANIZATION_CACHE_TTL
+# seconds and dropped by the /organizations write endpoints.
+organization_directory: Dict[str, Any] = {"loaded_at": None, "by_id": {}, "by_identifier": {}, "by_name": {}}
+organization_directory_lock = asyncio.Lock()
+
+def invalidate_organization_directory():
+    """Forget the cached organizations so the next lookup reloads them"""
+    organization_directory["loaded_at"] = None
+    sponsor_organization_ids.clear()
+    evict_list_cache("/organizations")
+
+async def load_organization_directory() -> Dict[str, Any]:
+    """Return the organization directory, reloading it from the FHIR server when stale"""
+    async with organization_directory_lock:
+        loaded_at = organization_directory["loaded_at"]
+        if loaded_at is not None and time.monotonic() - loaded_at < ORGANIZATION_CACHE_TTL:
+            return organization_directory
+        
+        by_id, by_identifier, by_name = {}, {}, {}
+        async for entry in iter_fhir_search("Organization"):
+            org = entry.get("resource", {})
+            if not org.get("id"):
+                continue
+            directory_entry = {
+                "id": org["id"],
+                "name": org.get("name"),
+                "resource": org,
+                **organization_settings(org)
+            }
+            by_id[org["id"]] = directory_entry
+            for identifier in org.get("identifier", []):
+                if identifier.get("value"):
+                    by_identifier.setdefault(identifier["value"], directory_entry)
+            if org.get("name"):
+                by_name.setdefault(org["name"], directory_entry)
+        
+        organization_directory.update({
+            "loaded_at": time.monotonic(),
+            "by_id": by_id,
+            "by_identifier": by_identifier,
+            "by_name": by_name
+        })
+        return organization_directory
+
+async def lookup_organization(org_id: Optional[str] = None, identifier: Optional[str] = None, name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Find an organization in the directory by ID, identifier value or name.
+
+    Returns the directory entry (id, name, url, api_key, type and the raw
+    resource) or None when no organization matches.
+    """
+    directory = await load_organization_directory()
+    if org_id:
+        return directory["by_id"].get(org_id)
+    if identifier:
+        return directory["by_identifier"].get(identifier)
+    if name:
+        return directory["by_name"].get(name)
+    return None
+
+# Organization management endpoints using FHIR Organization resources
 @app.get("/organizations")
-async def get_organizations():
+@cached_list_response("/organizations")
+async def get_organizations(compact: bool = False):
     """Get all organizations"""
     try:
         try:
-            # Try to get organizations directly
-            response = requests.get(
-                f"{FHIR_SERVER_URL}/Organization",
-                headers={"Accept": "application/fhir+json"}
-            )
-            response.raise_for_status()
-            response_data = response.json()
-            
-            # Ensure the response is a proper Bundle with entry array
-            if response_data.get("resourceType") == "Bundle":
-                # Forcibly add an empty entry array if it's missing
-                if "entry" not in response_data or response_data["entry"] is None:
-                    response_data["entry"] = []
-            
-            return response_data
-        except requests.RequestException as inner_e:
+            # Stream organizations directly; the streamed Bundle always has an entry array
+            return await stream_search_bundle(iter_fhir_search("Organization"), compact)
+        except httpx.HTTPError as inner_e:
             # If the request fails, check if it's due to version mismatch
-            print(f"Error fetching organizations: {str(inner_e)}")
+            logger.error("Error fetching organizations: %s", inner_e)
             
             # Return an empty bundle to avoid breaking the frontend
             empty_bundle = {
@@ -550,10 +1425,10 @@ async def create_organization(organization: OrganizationCreate):
         }
         
         # Log the request for debugging
-        print(f"Creating organization: {organization.name} with URL: {url}")
-        print(f"Organization data: {organization_data}")
+        logger.info("Creating organization: %s with URL: %s", organization.name, url)
+        log_payload("Organization data", organization_data)
         
-        response = requests.post(
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/Organization",
             json=organization_data,
             headers={
@@ -562,6 +1437,7 @@ async def create_organization(organization: OrganizationCreate):
             }
         )
         response.raise_for_status()
+        invalidate_organization_directory()
         created_org = response.json()
         
         # Verify that URL extension was correctly saved
@@ -571,12 +1447,12 @@ async def create_organization(organization: OrganizationCreate):
             for ext in created_org["extension"]:
                 if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-url" and ext.get("valueString") == url:
                     extension_url_found = True
-                    print(f"Verified URL in extension: {ext.get('valueString')}")
+                    logger.debug("Verified URL in extension: %s", ext.get('valueString'))
                     break
         
         # If URL extension is missing, update the organization
         if not extension_url_found:
-            print(f"URL extension missing, updating organization to add it")
+            logger.debug("URL extension missing, updating organization to add it")
             try:
                 # Prepare the data for update
                 if "extension" not in created_org:
@@ -589,7 +1465,7 @@ async def create_organization(organization: OrganizationCreate):
                 })
                 
                 # Update the organization
-                update_response = requests.put(
+                update_response = await fhir_client.put(
                     f"{FHIR_SERVER_URL}/Organization/{created_org['id']}",
                     json=created_org,
                     headers={
@@ -599,15 +1475,16 @@ async def create_organization(organization: OrganizationCreate):
                 )
                 
                 if update_response.status_code >= 200 and update_response.status_code < 300:
+                    invalidate_organization_directory()
                     created_org = update_response.json()
-                    print(f"Successfully updated organization {created_org['id']} with URL extension")
+                    logger.info("Successfully updated organization %s with URL extension", created_org['id'])
                 else:
-                    print(f"Warning: Failed to update organization with URL extension: {update_response.status_code}")
+                    logger.warning("Failed to update organization with URL extension: %s", update_response.status_code)
             except Exception as update_error:
-                print(f"Error updating organization with URL extension: {str(update_error)}")
+                logger.error("Error updating organization with URL extension: %s", update_error)
             
         return created_org
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -616,14 +1493,14 @@ async def create_organization(organization: OrganizationCreate):
             except:
                 error_message = e.response.text
         
-        print(f"Error creating organization: {error_message}")
+        logger.error("Error creating organization: %s", error_message)
         raise HTTPException(status_code=500, detail=f"Failed to create organization: {error_message}")
 
 @app.get("/organizations/{org_id}")
 async def get_organization(org_id: str):
     """Get a specific organization by ID"""
     try:
-        response = requests.get(
+        response = await fhir_get(
             f"{FHIR_SERVER_URL}/Organization/{org_id}",
             headers={"Accept": "application/fhir+json"}
         )
@@ -636,24 +1513,20 @@ async def get_organization(org_id: str):
             for telecom in org_data["telecom"]:
                 if telecom.get("system") == "url":
                     url_found = True
-                    print(f"Found URL for org {org_id}: {telecom.get('value')}")
+                    logger.debug("Found URL for org %s: %s", org_id, telecom.get('value'))
                     break
         
         # If no telecom array or URL not found, try to find the URL in extensions
         # This is a workaround for organizations that may be missing the telecom array
         if not url_found:
-            print(f"Warning: No URL found in telecom for organization {org_id}")
+            logger.warning("No URL found in telecom for organization %s", org_id)
             
             # Look in extensions for a URL
-            url_value = None
-            for ext in org_data.get("extension", []):
-                if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-url":
-                    url_value = ext.get("valueString")
-                    break
+            url_value = ExtensionIndex(org_data).value("http://example.org/fhir/StructureDefinition/organization-url")
             
             # If we found a URL in extensions, add it to telecom
             if url_value:
-                print(f"Found URL in extension: {url_value}")
+                logger.debug("Found URL in extension: %s", url_value)
                 if "telecom" not in org_data:
                     org_data["telecom"] = []
                 
@@ -665,7 +1538,7 @@ async def get_organization(org_id: str):
                 
                 # Try to update the organization with the telecom data
                 try:
-                    update_response = requests.put(
+                    update_response = await fhir_client.put(
                         f"{FHIR_SERVER_URL}/Organization/{org_id}",
                         json=org_data,
                         headers={
@@ -674,16 +1547,17 @@ async def get_organization(org_id: str):
                         }
                     )
                     if update_response.status_code >= 200 and update_response.status_code < 300:
+                        invalidate_organization_directory()
                         org_data = update_response.json()
-                        print(f"Successfully added telecom data to organization {org_id}")
+                        logger.info("Successfully added telecom data to organization %s", org_id)
                     else:
-                        print(f"Failed to update organization with telecom data: {update_response.status_code}")
+                        logger.error("Failed to update organization with telecom data: %s", update_response.status_code)
                 except Exception as update_error:
-                    print(f"Error updating organization with telecom data: {str(update_error)}")
+                    logger.error("Error updating organization with telecom data: %s", update_error)
         
         return org_data
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Organization with ID {org_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch organization: {str(e)}")
 
@@ -702,14 +1576,14 @@ async def update_organization(org_id: str, organization: OrganizationCreate):
             
         # First get the existing organization
         try:
-            get_response = requests.get(
+            get_response = await fhir_get(
                 f"{FHIR_SERVER_URL}/Organization/{org_id}",
                 headers={"Accept": "application/fhir+json"}
             )
             get_response.raise_for_status()
             existing_org = get_response.json()
-        except requests.RequestException as e:
-            if e.response and e.response.status_code == 404:
+        except httpx.HTTPError as e:
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
                 raise HTTPException(status_code=404, detail=f"Organization with ID {org_id} not found")
             raise e
         
@@ -756,10 +1630,10 @@ async def update_organization(org_id: str, organization: OrganizationCreate):
             })
         
         # Log update for debugging
-        print(f"Updating organization {org_id}: {organization.name} with URL: {url}")
+        logger.info("Updating organization %s: %s with URL: %s", org_id, organization.name, url)
         
         # Send the updated organization back to the FHIR server
-        response = requests.put(
+        response = await fhir_client.put(
             f"{FHIR_SERVER_URL}/Organization/{org_id}",
             json=existing_org,
             headers={
@@ -768,6 +1642,7 @@ async def update_organization(org_id: str, organization: OrganizationCreate):
             }
         )
         response.raise_for_status()
+        invalidate_organization_directory()
         updated_org = response.json()
         
         # Verify the URL is present in the extension
@@ -779,12 +1654,12 @@ async def update_organization(org_id: str, organization: OrganizationCreate):
                     extension_url_found = True
                     break
                     
-        print(f"After update - URL found in extension: {extension_url_found}")
+        logger.debug("After update - URL found in extension: %s", extension_url_found)
         
         return updated_org
     except HTTPException:
         raise
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -793,24 +1668,29 @@ async def update_organization(org_id: str, organization: OrganizationCreate):
             except:
                 error_message = e.response.text
             
-        print(f"Error updating organization: {error_message}")
+        logger.error("Error updating organization: %s", error_message)
         raise HTTPException(status_code=500, detail=f"Failed to update organization: {error_message}")
 
 @app.delete("/organizations/{org_id}")
 async def delete_organization(org_id: str):
     """Delete an organization"""
     try:
-        response = requests.delete(
+        response = await fhir_client.delete(
             f"{FHIR_SERVER_URL}/Organization/{org_id}",
             headers={"Accept": "application/fhir+json"}
         )
         response.raise_for_status()
+        invalidate_organization_directory()
         return {"message": f"Organization {org_id} deleted successfully"}
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Organization with ID {org_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to delete organization: {str(e)}")
 
+# Sponsor Organization IDs already found or created on external servers,
+# keyed by (external server URL, sponsor ID); cleared with the organization directory
+sponsor_organization_ids: Dict[tuple, str] = {}
+
 # Helper function to push a protocol to an external FHIR server
 async def ensure_sponsor_organization_exists(sponsor_id: str, sponsor_name: str, external_server_url: str, api_key: str = None):
     """
@@ -826,6 +1706,10 @@ async def ensure_sponsor_organization_exists(sponsor_id: str, sponsor_name: str,
     Returns:
         The organization resource ID in the external system
     """
+    cache_key = (external_server_url, sponsor_id)
+    if cache_key in sponsor_organization_ids:
+        return sponsor_organization_ids[cache_key]
+    
     try:
         # Prepare headers
         headers = {
@@ -839,7 +1723,7 @@ async def ensure_sponsor_organization_exists(sponsor_id: str, sponsor_name: str,
             
         # First check if an organization with this sponsor ID already exists
         search_url = f"{external_server_url}/Organization?identifier={sponsor_id}"
-        search_response = requests.get(
+        search_response = await fhir_client.get(
             search_url,
             headers=headers,
             timeout=10
@@ -853,7 +1737,8 @@ async def ensure_sponsor_organization_exists(sponsor_id: str, sponsor_name: str,
             entries = search_response.json().get('entry', [])
             if entries:
                 # Return the existing organization ID
-                return entries[0]['resource']['id']
+                sponsor_organization_ids[cache_key] = entries[0]['resource']['id']
+                return sponsor_organization_ids[cache_key]
         
         # If not found, create a new organization
         organization_data = {
@@ -883,7 +1768,7 @@ async def ensure_sponsor_organization_exists(sponsor_id: str, sponsor_name: str,
         }
         
         # Create the organization
-        create_response = requests.post(
+        create_response = await fhir_client.post(
             f"{external_server_url}/Organization",
             json=organization_data,
             headers=headers,
@@ -891,13 +1776,14 @@ async def ensure_sponsor_organization_exists(sponsor_id: str, sponsor_name: str,
         )
         
         if create_response.status_code >= 200 and create_response.status_code < 300:
-            return create_response.json().get('id')
+            sponsor_organization_ids[cache_key] = create_response.json().get('id')
+            return sponsor_organization_ids[cache_key]
         else:
-            print(f"Failed to create sponsor organization in CRO system: {create_response.status_code}")
+            logger.error("Failed to create sponsor organization in CRO system: %s", create_response.status_code)
             # Return None if creation failed
             return None
     except Exception as e:
-        print(f"Error ensuring sponsor organization exists: {str(e)}")
+        logger.error("Error ensuring sponsor organization exists: %s", e)
         return None
 
 async def push_protocol_to_external_server(protocol: dict, external_server_url: str, api_key: str = None, share_mode: str = "fullProtocol", selected_tests: List[str] = None):
@@ -912,11 +1798,11 @@ async def push_protocol_to_external_server(protocol: dict, external_server_url:
         share_mode: 'fullProtocol' or 'specificTests'
         selected_tests: List of test IDs to include when share_mode is 'specificTests'
     """
-    print(f"Starting protocol sharing with mode: {share_mode}, selected tests: {selected_tests}")
-    print(f"External server URL: {external_server_url}")
+    logger.info("Starting protocol sharing with mode: %s, selected tests: %s", share_mode, selected_tests)
+    logger.debug("External server URL: %s", external_server_url)
     try:
         # Create a copy of the protocol to modify for the external server
-        external_protocol = protocol.copy()
+        external_protocol = copy.deepcopy(protocol)
         
         # Remove the id as it will be assigned by the external server
         if "id" in external_protocol:
@@ -942,7 +1828,7 @@ async def push_protocol_to_external_server(protocol: dict, external_server_url:
         
         # We need both sponsor name and ID to properly link the protocol
         if not sponsor_name or not sponsor_id:
-            print(f"Warning: Missing sponsor information. Name: {sponsor_name}, ID: {sponsor_id}")
+            logger.warning("Missing sponsor information. Name: %s, ID: %s", sponsor_name, sponsor_id)
             sponsor_name = sponsor_name or "Unknown Sponsor"
             sponsor_id = sponsor_id or f"UNKNOWN-{datetime.now().strftime('%Y%m%d%H%M%S')}"
         
@@ -979,7 +1865,7 @@ async def push_protocol_to_external_server(protocol: dict, external_server_url:
                 }
             })
         else:
-            print(f"Warning: Could not create/find sponsor organization in CRO system")
+            logger.warning("Could not create/find sponsor organization in CRO system")
         
         # If sharing specific tests, filter the protocol actions
         if share_mode == "specificTests" and selected_tests:
@@ -1068,7 +1954,7 @@ async def push_protocol_to_external_server(protocol: dict, external_server_url:
             headers["Authorization"] = f"Bearer {api_key}"
         
         # Send the protocol to the external server
-        external_response = requests.post(
+        external_response = await fhir_client.post(
             f"{external_server_url}/PlanDefinition",
             json=external_protocol,
             headers=headers,
@@ -1093,37 +1979,366 @@ async def push_protocol_to_external_server(protocol: dict, external_server_url:
     except Exception as e:
         return (False, f"Error sharing to {external_server_url}: {str(e)}")
 
+def share_references(resource: Dict[str, Any]) -> List[str]:
+    """
+    List the references a shared resource needs alongside it on the receiving server.
+
+    Covers the protocol's medicinal product and shared organizations and a
+    test's observation and specimen definitions, whether linked through our
+    extensions or the ActivityDefinition requirement elements. Only references to the
+    resource type expected at each location are returned.
+    """
+    references = []
+    
+    def add(value, resource_type):
+        reference = (value or {}).get("reference")
+        if reference and reference.startswith(f"{resource_type}/"):
+            references.append(reference)
+    
+    add(resource.get("subjectReference"), "MedicinalProductDefinition")
+    
+    # Enhanced tests link their definitions directly on the ActivityDefinition
+    for reference in resource.get("observationResultRequirement", []):
+        add({"reference": reference}, "ObservationDefinition")
+    for reference in resource.get("specimenRequirement", []):
+        add({"reference": reference}, "SpecimenDefinition")
+    
+    extensions = ExtensionIndex(resource)
+    for reference in extensions.nested_values("http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations"):
+        add({"reference": reference}, "Organization")
+    for reference in extensions.nested_values("http://example.org/fhir/StructureDefinition/observation-definitions"):
+        add({"reference": reference}, "ObservationDefinition")
+    for reference in extensions.values("http://example.org/fhir/StructureDefinition/specimen-definition"):
+        add({"reference": reference}, "SpecimenDefinition")
+    
+    return references
+
+async def resolve_reference_closure(roots: List[Dict[str, Any]]) -> Dict[tuple, Dict[str, Any]]:
+    """
+    Resolve every resource reachable from the roots through share_references.
+
+    Walks the references breadth-first. Each level is loaded with one _id
+    search per resource type, all types at once, so a protocol with many
+    tests takes a couple of round trips instead of one read per reference.
+    Returns the resolved resources keyed by (resource type, ID), excluding
+    the roots themselves.
+    """
+    seen = {(root.get("resourceType"), root.get("id")) for root in roots}
+    resolved = {}
+    pending = roots
+    
+    while pending:
+        # Group this level's unseen references by resource type
+        wanted = {}
+        for resource in pending:
+            for reference in share_references(resource):
+                resource_type, _, resource_id = reference.partition("/")
+                resource_id = resource_id.split("/")[0]
+                if resource_id and (resource_type, resource_id) not in seen:
+                    seen.add((resource_type, resource_id))
+                    wanted.setdefault(resource_type, []).append(resource_id)
+        
+        if not wanted:
+            break
+        
+        resource_types = list(wanted)
+        results = await asyncio.gather(
+            *(read_resources_by_id(resource_type, wanted[resource_type]) for resource_type in resource_types),
+            return_exceptions=True
+        )
+        
+        pending = []
+        for resource_type, result in zip(resource_types, results):
+            if isinstance(result, Exception):
+                logger.error("Error fetching referenced %s resources: %s", resource_type, result)
+                continue
+            for resource_id in wanted[resource_type]:
+                if resource_id not in result:
+                    logger.error("Error fetching referenced %s %s: not found", resource_type, resource_id)
+            for resource_id, resource in result.items():
+                resolved[(resource_type, resource_id)] = resource
+                pending.append(resource)
+    
+    return resolved
+
+async def build_share_bundle(protocol_id: str, protocol: Dict[str, Any], shared_batches: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Build the transaction Bundle that is pushed to the organizations a protocol is shared with.
+
+    The bundle holds the protocol, its test definitions, the shared batches and
+    the resources they reference. None of it depends on the target organization,
+    so share_protocol builds it once and sends the same content to every target.
+
+    Returns a dict with the bundle and the number of tests, batches and
+    referenced resources it contains.
+    """
+    # First, prepare the protocol
+    external_protocol = copy.deepcopy(protocol)
+    # Use the original protocol ID
+    protocol_logical_id = protocol_id
+    
+    # Add a tag to indicate this is a shared protocol
+    external_protocol.setdefault("meta", {}).setdefault("tag", []).append({
+        "system": "http://example.org/fhir/tags",
+        "code": "shared-protocol"
+    })
+    
+    # Get the test definitions for this protocol
+    associated_tests = []
+    async for entry in iter_extension_search("ActivityDefinition", {
+        "stability-test-protocol": f"PlanDefinition/{protocol_id}"
+    }):
+        external_test = entry.get("resource", {})
+        test_id = external_test.get("id")
+        if not test_id:
+            continue
+        
+        # Add test to bundle entries
+        associated_tests.append({
+            "fullUrl": f"ActivityDefinition/{test_id}",
+            "resource": external_test,
+            "request": {
+                "method": "PUT",  # Use PUT to preserve IDs
+                "url": f"ActivityDefinition/{test_id}"
+            }
+        })
+    
+    # Extract existing sponsor info from the protocol
+    extensions = ExtensionIndex(protocol)
+    sponsor_name = extensions.value("http://example.org/fhir/StructureDefinition/sponsor")
+    sponsor_id = extensions.value("http://example.org/fhir/StructureDefinition/sponsor-id")
+    
+    # Include the shared batches
+    associated_batches = []
+    for batch_id, batch in shared_batches.items():
+        # Copy the batch so the caller's version stays untouched
+        external_batch = copy.deepcopy(batch)
+        
+        # Add meta tag to indicate this is a shared batch
+        external_batch.setdefault("meta", {}).setdefault("tag", []).append({
+            "system": "http://example.org/fhir/tags",
+            "code": "shared-batch"
+        })
+        
+        # Make sure extension exists
+        if "extension" not in external_batch:
+            external_batch["extension"] = []
+        
+        # If we have sponsor info, add it to the batch
+        if sponsor_name:
+            external_batch["extension"].append({
+                "url": "http://example.org/fhir/StructureDefinition/sponsor",
+                "valueString": sponsor_name
+            })
+        
+        if sponsor_id:
+            external_batch["extension"].append({
+                "url": "http://example.org/fhir/StructureDefinition/sponsor-id",
+                "valueString": sponsor_id
+            })
+        
+        # Add protocol_id to batch for easier reference
+        if "identifier" not in external_batch:
+            external_batch["identifier"] = []
+        
+        # Add protocol ID if it doesn't exist
+        if not any(
+            ident.get("system") == "http://example.org/fhir/identifier/protocol" and ident.get("value") == protocol_id
+            for ident in external_batch["identifier"]
+        ):
+            external_batch["identifier"].append({
+                "system": "http://example.org/fhir/identifier/protocol",
+                "value": protocol_id
+            })
+        
+        # Add proper medication code for stability batches
+        external_batch["code"] = {
+            "coding": [
+                {
+                    "system": "http://example.org/fhir/medication-types",
+                    "code": "stability-batch"
+                }
+            ],
+            "text": external_batch.get("code", {}).get("text", "Stability Test Batch")
+        }
+        
+        # Update the protocol reference to use the logical ID
+        for ext in external_batch["extension"]:
+            if ext.get("url") == "http://example.org/fhir/StructureDefinition/batch-protocol":
+                ext["valueReference"]["reference"] = f"PlanDefinition/{protocol_logical_id}"
+                break
+        else:
+            # Add the protocol reference if it doesn't exist
+            external_batch["extension"].append({
+                "url": "http://example.org/fhir/StructureDefinition/batch-protocol",
+                "valueReference": {
+                    "reference": f"PlanDefinition/{protocol_logical_id}"
+                }
+            })
+        
+        # Add batch to bundle entries
+        associated_batches.append({
+            "fullUrl": f"Medication/{batch_id}",
+            "resource": external_batch,
+            "request": {
+                "method": "PUT",  # Use PUT to preserve IDs
+                "url": f"Medication/{batch_id}"
+            }
+        })
+    
+    # Create the bundle with all resources
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            {
+                "fullUrl": f"PlanDefinition/{protocol_logical_id}",
+                "resource": external_protocol,
+                "request": {
+                    "method": "PUT",  # Use PUT to preserve IDs
+                    "url": f"PlanDefinition/{protocol_logical_id}"
+                }
+            }
+        ] + associated_tests + associated_batches
+    }
+    
+    # Add all referenced resources to the bundle
+    referenced_resources = await resolve_reference_closure(
+        [external_protocol] + [test_entry["resource"] for test_entry in associated_tests]
+    )
+    for (resource_type, resource_id), resource in referenced_resources.items():
+        bundle["entry"].append({
+            "fullUrl": f"{resource_type}/{resource_id}",
+            "resource": resource,
+            "request": {
+                "method": "PUT",
+                "url": f"{resource_type}/{resource_id}"
+            }
+        })
+    
+    logger.debug(
+        "Share bundle for protocol %s: 1 PlanDefinition, %s ActivityDefinitions, %s Medication resources, %s referenced resources",
+        protocol_id, len(associated_tests), len(associated_batches), len(referenced_resources)
+    )
+    
+    return {
+        "bundle": bundle,
+        "hashes": {
+            entry["request"]["url"]: share_resource_hash(entry["resource"])
+            for entry in bundle["entry"]
+        },
+        "test_count": len(associated_tests),
+        "batch_count": len(associated_batches),
+        "referenced_count": len(referenced_resources)
+    }
+
+# Content hashes of the resources last pushed successfully, keyed by (organization ID, protocol ID).
+# Kept in memory only; after a restart the next share sends everything again.
+share_push_state: Dict[tuple, Dict[str, str]] = {}
+
+# Resource types deleted on the receiving side when they are no longer part of the share.
+# Only tests qualify: a test missing from the bundle is no longer linked to the protocol
+# here, while a batch missing from it may just not have been selected this time and can
+# still be in use at the CRO.
+SHARE_DELETABLE_TYPES = ("ActivityDefinition",)
+
+def share_resource_hash(resource: Dict[str, Any]) -> str:
+    """Hash a resource's content, ignoring the server-managed versionId and lastUpdated"""
+    content = dict(resource)
+    if "meta" in content:
+        content["meta"] = {
+            key: value for key, value in content["meta"].items()
+            if key not in ("versionId", "lastUpdated")
+        }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def share_delta_entries(share_bundle: Dict[str, Any], pushed_hashes: Dict[str, str]) -> List[Dict[str, Any]]:
+    """
+    Select the share bundle entries a target does not have yet.
+
+    Returns the entries whose content changed since the hashes in pushed_hashes
+    were recorded, plus DELETE entries for tests that were pushed before but
+    are no longer linked to the protocol.
+    """
+    entries = [
+        entry for entry in share_bundle["bundle"]["entry"]
+        if pushed_hashes.get(entry["request"]["url"]) != share_bundle["hashes"][entry["request"]["url"]]
+    ]
+    for resource_url in pushed_hashes:
+        if resource_url not in share_bundle["hashes"] and resource_url.split("/")[0] in SHARE_DELETABLE_TYPES:
+            entries.append({
+                "request": {
+                    "method": "DELETE",
+                    "url": resource_url
+                }
+            })
+    return entries
+
+# Background share jobs, kept in memory by job ID
+share_jobs: Dict[str, Dict[str, Any]] = {}
+
+def create_share_job(protocol_id: str, organization_ids: List[str]) -> Dict[str, Any]:
+    """Register a new share job, dropping the oldest finished jobs beyond SHARE_JOB_HISTORY"""
+    finished = [job_id for job_id, job in share_jobs.items() if job["status"] in ("completed", "failed")]
+    for job_id in finished[:max(0, len(finished) - SHARE_JOB_HISTORY)]:
+        del share_jobs[job_id]
+    
+    now = datetime.now().isoformat()
+    job = {
+        "id": str(uuid.uuid4()),
+        "protocol_id": protocol_id,
+        "status": "pending",
+        "created_at": now,
+        "updated_at": now,
+        "organizations": {
+            org_id: {"organization_id": org_id, "status": "pending"}
+            for org_id in organization_ids
+        },
+        "resource_counts": None,
+        "result": None,
+        "error": None,
+        "events": [],
+        "_changed": asyncio.Event()
+    }
+    share_jobs[job["id"]] = job
+    return job
+
+def record_share_progress(job: Dict[str, Any], event_type: str, **data):
+    """Append a progress event to a share job and wake up anyone streaming it"""
+    now = datetime.now().isoformat()
+    job["updated_at"] = now
+    job["events"].append({"type": event_type, "timestamp": now, **data})
+    job["_changed"].set()
+    job["_changed"] = asyncio.Event()
+
+def share_job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Public view of a share job, without its event log and internals"""
+    organizations = list(job["organizations"].values())
+    return {
+        "job_id": job["id"],
+        "protocol_id": job["protocol_id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "progress": {
+            "total": len(organizations),
+            "completed": sum(1 for org in organizations if org["status"] == "completed"),
+            "failed": sum(1 for org in organizations if org["status"] == "failed")
+        },
+        "organizations": organizations,
+        "resource_counts": job["resource_counts"],
+        "result": job["result"],
+        "error": job["error"]
+    }
+
 # Protocol sharing endpoints using FHIR PlanDefinition
-@app.post("/protocols/{protocol_id}/share")
-async def share_protocol(protocol_id: str, share_request: ProtocolShareRequest):
+async def run_protocol_share(protocol_id: str, share_request: ProtocolShareRequest, job: Dict[str, Any]) -> Dict[str, Any]:
     """Share a protocol with organizations by updating extension in the PlanDefinition and pushing to external servers"""
     try:
-        # First get the existing protocol
-        try:
-            get_response = requests.get(
-                f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
-                headers={"Accept": "application/fhir+json"}
-            )
-            get_response.raise_for_status()
-            existing_protocol = get_response.json()
-        except requests.RequestException as e:
-            if e.response and e.response.status_code == 404:
-                raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
-            raise HTTPException(status_code=500, detail=f"Failed to verify protocol existence: {str(e)}")
-        
         # Create or update the sharing extension
         share_ext_url = "http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations"
         
-        # Remove existing sharing extension if any
-        if "extension" not in existing_protocol:
-            existing_protocol["extension"] = []
-        else:
-            existing_protocol["extension"] = [
-                ext for ext in existing_protocol["extension"] 
-                if ext.get("url") != share_ext_url
-            ]
-        
-        # Add new sharing extension with organizations
+        # Sharing extension entries for the selected organizations
         org_references = []
         for org_id in share_request.organization_ids:
             org_references.append({
@@ -1132,518 +2347,317 @@ async def share_protocol(protocol_id: str, share_request: ProtocolShareRequest):
                 }
             })
         
-        if org_references:
-            existing_protocol["extension"].append({
-                "url": share_ext_url,
-                "extension": org_references
-            })
+        def set_shared_organizations(existing_protocol: Dict[str, Any]):
+            """Replace the sharing extension with the requested organizations"""
+            # Remove existing sharing extension if any
+            if "extension" not in existing_protocol:
+                existing_protocol["extension"] = []
+            else:
+                existing_protocol["extension"] = [
+                    ext for ext in existing_protocol["extension"] 
+                    if ext.get("url") != share_ext_url
+                ]
+            
+            # Add new sharing extension with organizations
+            if org_references:
+                existing_protocol["extension"].append({
+                    "url": share_ext_url,
+                    "extension": org_references
+                })
         
-        # Update the protocol locally
-        response = requests.put(
-            f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
-            json=existing_protocol,
-            headers={
-                "Content-Type": "application/fhir+json",
-                "Accept": "application/fhir+json"
-            }
-        )
-        response.raise_for_status()
+        # Update the protocol locally, reapplying the extension if it was edited concurrently
+        try:
+            existing_protocol = await update_definition("PlanDefinition", protocol_id, set_shared_organizations)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
+            raise
+        evict_list_cache("/protocols")
         
         # Now handle batch sharing if requested
+        shared_batches = {}
+        batch_load_failed = False
         if hasattr(share_request, 'shareBatches') and share_request.shareBatches and hasattr(share_request, 'selectedBatches'):
-            # Process each batch to mark it as shared with the selected CROs
+            # Load all selected batches at once; the same set is reused for every organization below
+            try:
+                shared_batches = await read_resources_by_id("Medication", share_request.selectedBatches)
+            except httpx.HTTPError as batch_error:
+                logger.error("Error loading batches for sharing: %s", batch_error)
+                batch_load_failed = True
+            
             for batch_id in share_request.selectedBatches:
-                try:
-                    # Get the batch
-                    batch_response = requests.get(
-                        f"{FHIR_SERVER_URL}/Medication/{batch_id}",
-                        headers={"Accept": "application/fhir+json"}
-                    )
-                    batch_response.raise_for_status()
-                    batch = batch_response.json()
-                    
-                    # Add shared-with-cro extension
-                    if "extension" not in batch:
-                        batch["extension"] = []
-                    
-                    # Remove any existing shared-with-cro extension
-                    batch["extension"] = [
-                        ext for ext in batch["extension"]
-                        if ext.get("url") != "http://example.org/fhir/StructureDefinition/shared-with-cro"
-                    ]
-                    
-                    # Add extension to indicate this batch is shared with CROs
-                    batch["extension"].append({
-                        "url": "http://example.org/fhir/StructureDefinition/shared-with-cro",
-                        "valueBoolean": True
-                    })
-                    
-                    # Add specific organizations this batch is shared with
-                    batch["extension"].append({
-                        "url": "http://example.org/fhir/StructureDefinition/shared-with-organizations",
-                        "extension": org_references
-                    })
-                    
-                    # Add proper medication code for stability batches
-                    batch["extension"].append({
-                        "url": "http://example.org/fhir/StructureDefinition/medication-type",
-                        "valueString": "stability-batch"
-                    })
-                    
-                    # Update the batch
-                    batch_update_response = requests.put(
-                        f"{FHIR_SERVER_URL}/Medication/{batch_id}",
-                        json=batch,
-                        headers={
-                            "Content-Type": "application/fhir+json",
-                            "Accept": "application/fhir+json"
-                        }
+                if batch_id not in shared_batches:
+                    logger.error("Error updating batch %s: batch not found", batch_id)
+            
+            # Mark each batch as shared with the selected CROs
+            tag_entries = []
+            for batch_id, batch in shared_batches.items():
+                # Remove any existing sharing extensions before adding the current ones
+                batch["extension"] = [
+                    ext for ext in batch.get("extension", [])
+                    if ext.get("url") not in (
+                        "http://example.org/fhir/StructureDefinition/shared-with-cro",
+                        "http://example.org/fhir/StructureDefinition/shared-with-organizations",
+                        "http://example.org/fhir/StructureDefinition/medication-type"
                     )
-                    batch_update_response.raise_for_status()
-                    
-                except Exception as batch_error:
-                    print(f"Error updating batch {batch_id}: {str(batch_error)}")
-                    # Continue with other batches
+                ]
+                
+                # Add extension to indicate this batch is shared with CROs
+                batch["extension"].append({
+                    "url": "http://example.org/fhir/StructureDefinition/shared-with-cro",
+                    "valueBoolean": True
+                })
+                
+                # Add specific organizations this batch is shared with
+                batch["extension"].append({
+                    "url": "http://example.org/fhir/StructureDefinition/shared-with-organizations",
+                    "extension": org_references
+                })
+                
+                # Add proper medication code for stability batches
+                batch["extension"].append({
+                    "url": "http://example.org/fhir/StructureDefinition/medication-type",
+                    "valueString": "stability-batch"
+                })
+                
+                tag_entries.append({
+                    "resource": batch,
+                    "request": {
+                        "method": "PUT",
+                        "url": f"Medication/{batch_id}"
+                    }
+                })
+            
+            # Write all tag updates in one transaction
+            if tag_entries:
+                try:
+                    await submit_fhir_transaction(tag_entries)
+                except httpx.HTTPError as batch_error:
+                    logger.error("Error updating batches: %s", batch_error)
+            
+            record_share_progress(job, "batches_tagged", batch_count=len(shared_batches))
         
-        # Now attempt to push the protocol to each external organization's FHIR server
-        share_results = []
+        # Build the share bundle once; only headers and the endpoint differ per organization
+        share_bundle = None
+        share_bundle_content = None
+        share_bundle_error = None
+        if share_request.share_mode == "fullProtocol" or (share_request.share_mode == "specificTests" and share_request.selected_tests):
+            try:
+                share_bundle = await build_share_bundle(protocol_id, existing_protocol, shared_batches)
+                share_bundle_content = json.dumps(share_bundle["bundle"])
+            except Exception as bundle_error:
+                logger.error("Error creating bundle: %s", bundle_error)
+                share_bundle_error = bundle_error
+        
+        if share_bundle is not None:
+            job["resource_counts"] = {
+                "protocols": 1,
+                "tests": share_bundle["test_count"],
+                "batches": share_bundle["batch_count"],
+                "referenced": share_bundle["referenced_count"]
+            }
+            record_share_progress(job, "bundle_built", resource_counts=job["resource_counts"])
         
-        for org_id in share_request.organization_ids:
-            # Get organization details
+        # Now attempt to push the protocol to each external organization's FHIR server
+        async def share_with_organization(org_id: str) -> Dict[str, Any]:
+            # Get organization details from the directory
             try:
-                org_response = requests.get(
-                    f"{FHIR_SERVER_URL}/Organization/{org_id}",
-                    headers={"Accept": "application/fhir+json"}
-                )
+                org = await lookup_organization(org_id)
                 
-                if org_response.status_code == 200:
-                    org = org_response.json()
-                    
-                    # Debug the organization data
-                    print(f"DEBUG - Organization {org_id} data: {json.dumps(org)}")
-                    
-                    # Extract URL directly from extension
-                    url = None
-                    if "extension" in org and org.get("extension"):
-                        print(f"DEBUG - Found {len(org.get('extension'))} extensions")
-                        for ext in org.get("extension", []):
-                            print(f"DEBUG - Extension: {json.dumps(ext)}")
-                            if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-url":
-                                url = ext.get("valueString")
-                                print(f"DEBUG - Found URL in extension: {url}")
-                                break
-                    else:
-                        print(f"DEBUG - No extensions found in organization {org_id}")
-                    
-                    # Log what we found
-                    if url:
-                        print(f"DEBUG - Using URL for org {org_id}: {url}")
-                    else:
-                        print(f"DEBUG - No URL found for org {org_id} in extension")
-                    
-                    # Extract API key from extension
-                    api_key = None
-                    for ext in org.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-api-key":
-                            api_key = ext.get("valueString")
-                            if api_key:
-                                break
-                    
-                    if url:
-                        # Create a FHIR Bundle transaction to push protocol and test definitions together
-                        if share_request.share_mode == "fullProtocol" or (share_request.share_mode == "specificTests" and share_request.selected_tests):
-                            try:
-                                # Get all test definitions for this protocol
-                                tests_response = requests.get(
-                                    f"{FHIR_SERVER_URL}/ActivityDefinition",
-                                    headers={"Accept": "application/fhir+json"}
-                                )
-                                tests_response.raise_for_status()
-                                
-                                all_tests = tests_response.json()
-                                associated_tests = []
-                                
-                                # First, prepare the protocol
-                                external_protocol = existing_protocol.copy()
-                                # Use the original protocol ID
-                                protocol_logical_id = protocol_id
-                                
-                                # Make sure it has meta tags
-                                if "meta" not in external_protocol:
-                                    external_protocol["meta"] = {}
-                                if "tag" not in external_protocol["meta"]:
-                                    external_protocol["meta"]["tag"] = []
-                                
-                                # Add a tag to indicate this is a shared protocol
-                                external_protocol["meta"]["tag"].append({
-                                    "system": "http://example.org/fhir/tags",
-                                    "code": "shared-protocol"
-                                })
-                                
-                                if all_tests and all_tests.get("resourceType") == "Bundle" and all_tests.get("entry"):
-                                    for entry in all_tests["entry"]:
-                                        test = entry.get("resource", {})
-                                        test_id = test.get("id")
-                                        
-                                        if not test_id:
-                                            continue
-                                            
-                                        # Check if this test is associated with the protocol
-                                        is_for_protocol = False
-                                        for ext in test.get("extension", []):
-                                            if (ext.get("url") == "http://example.org/fhir/StructureDefinition/stability-test-protocol" and
-                                                ext.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}"):
-                                                is_for_protocol = True
-                                                break
-                                        
-                                        if is_for_protocol:
-                                            # Create a copy of the test
-                                            external_test = test.copy()
-                                            
-                                            # Update the protocol reference to use the logical ID
-                                            for ext_idx, ext in enumerate(external_test.get("extension", [])):
-                                                if ext.get("url") == "http://example.org/fhir/StructureDefinition/stability-test-protocol":
-                                                    # Replace the reference with the logical ID
-                                                    external_test["extension"][ext_idx]["valueReference"]["reference"] = f"PlanDefinition/{protocol_logical_id}"
-                                                    break
-                                            else:
-                                                # Add the protocol reference if it doesn't exist
-                                                if "extension" not in external_test:
-                                                    external_test["extension"] = []
-                                                external_test["extension"].append({
-                                                    "url": "http://example.org/fhir/StructureDefinition/stability-test-protocol",
-                                                    "valueReference": {
-                                                        "reference": f"PlanDefinition/{protocol_logical_id}"
-                                                    }
-                                                })
-                                            
-                                            # Add test to bundle entries
-                                            associated_tests.append({
-                                                "fullUrl": f"ActivityDefinition/{test_id}",
-                                                "resource": external_test,
-                                                "request": {
-                                                    "method": "PUT",  # Use PUT to preserve IDs
-                                                    "url": f"ActivityDefinition/{test_id}"
-                                                }
-                                            })
-                                
-                                # Now check if we need to include batches
-                                associated_batches = []
-                                
-                                # If batches are being shared, include them in the bundle
-                                if (hasattr(share_request, 'shareBatches') and 
-                                    share_request.shareBatches and 
-                                    hasattr(share_request, 'selectedBatches') and
-                                    share_request.selectedBatches):
-                                    
-                                    print(f"DEBUG - Processing {len(share_request.selectedBatches)} batches for sharing")
-                                    
-                                    for batch_id in share_request.selectedBatches:
-                                        try:
-                                            print(f"DEBUG - Fetching Medication resource for batch {batch_id}")
-                                            # Get the batch
-                                            batch_response = requests.get(
-                                                f"{FHIR_SERVER_URL}/Medication/{batch_id}",
-                                                headers={"Accept": "application/fhir+json"}
-                                            )
-                                            batch_response.raise_for_status()
-                                            batch = batch_response.json()
-                                            print(f"DEBUG - Retrieved Medication resource: {json.dumps(batch)}")
-                                            
-                                            # Create a copy for the external server
-                                            external_batch = batch.copy()
-                                            
-                                            # Add meta tag to indicate this is a shared batch
-                                            if "meta" not in external_batch:
-                                                external_batch["meta"] = {}
-                                            if "tag" not in external_batch["meta"]:
-                                                external_batch["meta"]["tag"] = []
-                                            
-                                            external_batch["meta"]["tag"].append({
-                                                "system": "http://example.org/fhir/tags",
-                                                "code": "shared-batch"
-                                            })
-                                            
-                                            # Make sure extension exists
-                                            if "extension" not in external_batch:
-                                                external_batch["extension"] = []
-                                                
-                                            # Extract existing sponsor info from the protocol
-                                            sponsor_name = None
-                                            sponsor_id = None
-                                            
-                                            for ext in existing_protocol.get("extension", []):
-                                                if ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor":
-                                                    sponsor_name = ext.get("valueString")
-                                                elif ext.get("url") == "http://example.org/fhir/StructureDefinition/sponsor-id":
-                                                    sponsor_id = ext.get("valueString")
-                                            
-                                            # If we have sponsor info, add it to the batch
-                                            if sponsor_name:
-                                                external_batch["extension"].append({
-                                                    "url": "http://example.org/fhir/StructureDefinition/sponsor",
-                                                    "valueString": sponsor_name
-                                                })
-                                            
-                                            if sponsor_id:
-                                                external_batch["extension"].append({
-                                                    "url": "http://example.org/fhir/StructureDefinition/sponsor-id",
-                                                    "valueString": sponsor_id
-                                                })
-                                                
-                                            # Add protocol_id to batch for easier reference
-                                            if "identifier" not in external_batch:
-                                                external_batch["identifier"] = []
-                                            
-                                            # Check if protocol ID already exists in identifiers
-                                            protocol_id_exists = False
-                                            for ident in external_batch.get("identifier", []):
-                                                if (ident.get("system") == "http://example.org/fhir/identifier/protocol" and
-                                                    ident.get("value") == protocol_id):
-                                                    protocol_id_exists = True
-                                                    break
-                                            
-                                            # Add protocol ID if it doesn't exist
-                                            if not protocol_id_exists:
-                                                external_batch["identifier"].append({
-                                                    "system": "http://example.org/fhir/identifier/protocol",
-                                                    "value": protocol_id
-                                                })
-                                                
-                                            # Add proper medication code for stability batches
-                                            external_batch["code"] = {
-                                                "coding": [
-                                                    {
-                                                        "system": "http://example.org/fhir/medication-types",
-                                                        "code": "stability-batch"
-                                                    }
-                                                ],
-                                                "text": external_batch.get("code", {}).get("text", "Stability Test Batch")
-                                            }
-                                            
-                                            # Update the protocol reference to use the logical ID
-                                            for ext_idx, ext in enumerate(external_batch.get("extension", [])):
-                                                if ext.get("url") == "http://example.org/fhir/StructureDefinition/batch-protocol":
-                                                    # Replace the reference with the logical ID
-                                                    external_batch["extension"][ext_idx]["valueReference"]["reference"] = f"PlanDefinition/{protocol_logical_id}"
-                                                    break
-                                            else:
-                                                # Add the protocol reference if it doesn't exist
-                                                external_batch["extension"].append({
-                                                    "url": "http://example.org/fhir/StructureDefinition/batch-protocol",
-                                                    "valueReference": {
-                                                        "reference": f"PlanDefinition/{protocol_logical_id}"
-                                                    }
-                                                })
-                                            
-                                            # Add batch to bundle entries
-                                            associated_batches.append({
-                                                "fullUrl": f"Medication/{batch_id}",
-                                                "resource": external_batch,
-                                                "request": {
-                                                    "method": "PUT",  # Use PUT to preserve IDs
-                                                    "url": f"Medication/{batch_id}"
-                                                }
-                                            })
-                                            print(f"DEBUG - Added Medication resource to bundle entries")
-                                        except Exception as batch_error:
-                                            print(f"Error processing batch {batch_id} for sharing: {str(batch_error)}")
-                                
-                                # Create the bundle with all resources
-                                bundle = {
+                if not org:
+                    return {
+                        "organization_id": org_id,
+                        "success": False,
+                        "message": "Could not retrieve organization details: 404"
+                    }
+                
+                url = org["url"]
+                api_key = org["api_key"]
+                
+                if not url:
+                    logger.debug("No URL found for org %s in extension", org_id)
+                    return {
+                        "organization_id": org_id,
+                        "organization_name": org["name"] or "Unknown",
+                        "success": False,
+                        "message": "No FHIR server URL provided for this organization"
+                    }
+                
+                logger.debug("Using URL for org %s: %s", org_id, url)
+                
+                if share_bundle_error is not None:
+                    success, message = False, f"Error sharing protocol: {str(share_bundle_error)}"
+                elif share_bundle is not None:
+                    try:
+                        # Prepare headers
+                        headers = {
+                            "Content-Type": "application/fhir+json",
+                            "Accept": "application/fhir+json",
+                            CORRELATION_ID_HEADER: correlation_id.get()
+                        }
+                        
+                        # Add API key if provided
+                        if api_key:
+                            headers["Authorization"] = f"Bearer {api_key}"
+                        
+                        # Check if this is a CRO backend URL or a direct FHIR server URL
+                        target_url = url
+                        
+                        # If URL is for a CRO FHIR server, check if we should use their middleware endpoint instead
+                        if "/fhir" in url:
+                            # Try to see if there's a middleware endpoint available
+                            cro_backend_url = url.replace("/fhir", "/sponsor/shared-resources")
+                            logger.debug("Attempting to use CRO middleware endpoint: %s", cro_backend_url)
+                            target_url = cro_backend_url
+                        
+                        # For Docker connectivity, replace localhost with container names if needed
+                        if "localhost:8001" in target_url:
+                            docker_url = target_url.replace("localhost:8001", "cro-backend:8000")
+                            logger.debug("Replacing %s with Docker network URL: %s", target_url, docker_url)
+                            target_url = docker_url
+                        elif "localhost:8081" in target_url:
+                            docker_url = target_url.replace("localhost:8081", "cro-fhir-server:8080")
+                            logger.debug("Replacing %s with Docker network URL: %s", target_url, docker_url)
+                            target_url = docker_url
+                        
+                        # Only send what changed since the last successful share with this organization.
+                        # Without the selected batches the bundle is incomplete, so it is sent in full,
+                        # without removals, and not recorded as the organization's state
+                        pushed_hashes = {} if share_request.force_full_share or batch_load_failed else share_push_state.get((org_id, protocol_id), {})
+                        delta_entries = share_delta_entries(share_bundle, pushed_hashes)
+                        if delta_entries:
+                            BUNDLE_ENTRIES.labels("share", "").observe(len(delta_entries))
+                        
+                        if not delta_entries:
+                            bundle_response = None
+                        elif not pushed_hashes:
+                            # Nothing was shared before, so the full bundle serialized above applies as is
+                            logger.info("Pushing bundle with protocol, %s test definitions, %s batches, and %s referenced resources to %s", share_bundle['test_count'], share_bundle['batch_count'], share_bundle['referenced_count'], target_url)
+                            bundle_response = await fhir_client.post(
+                                target_url,  # Use middleware endpoint if available
+                                content=share_bundle_content,
+                                headers=headers,
+                                timeout=45  # Longer timeout for bundle processing
+                            )
+                        else:
+                            logger.info("Pushing %s changed resources to %s", len(delta_entries), target_url)
+                            bundle_response = await fhir_client.post(
+                                target_url,  # Use middleware endpoint if available
+                                json={
                                     "resourceType": "Bundle",
                                     "type": "transaction",
-                                    "entry": [
-                                        {
-                                            "fullUrl": f"PlanDefinition/{protocol_logical_id}",
-                                            "resource": external_protocol,
-                                            "request": {
-                                                "method": "PUT",  # Use PUT to preserve IDs
-                                                "url": f"PlanDefinition/{protocol_logical_id}"
-                                            }
-                                        }
-                                    ] + associated_tests + associated_batches
-                                }
-                                
-                                print(f"DEBUG - Bundle contents:")
-                                print(f"- 1 PlanDefinition")
-                                print(f"- {len(associated_tests)} ActivityDefinitions")
-                                print(f"- {len(associated_batches)} Medication resources")
-                                print(f"DEBUG - Bundle entries: {json.dumps([entry['fullUrl'] for entry in bundle['entry']])}")
-                                
-                                # Add all referenced resources to the bundle
-                                referenced_resources = set()
-                                
-                                # Helper function to add referenced resources
-                                async def add_referenced_resource(reference, resource_type):
-                                    if not reference or not reference.startswith(f"{resource_type}/"):
-                                        return
-                                    
-                                    resource_id = reference.split("/")[1]
-                                    if resource_id in referenced_resources:
-                                        return
-                                    
-                                    try:
-                                        print(f"DEBUG - Fetching referenced {resource_type} {resource_id}")
-                                        response = requests.get(
-                                            f"{FHIR_SERVER_URL}/{resource_type}/{resource_id}",
-                                            headers={"Accept": "application/fhir+json"}
-                                        )
-                                        response.raise_for_status()
-                                        resource = response.json()
-                                        
-                                        # Add to bundle
-                                        bundle["entry"].append({
-                                            "fullUrl": f"{resource_type}/{resource_id}",
-                                            "resource": resource,
-                                            "request": {
-                                                "method": "PUT",
-                                                "url": f"{resource_type}/{resource_id}"
-                                            }
-                                        })
-                                        referenced_resources.add(resource_id)
-                                        print(f"DEBUG - Added {resource_type} {resource_id} to bundle")
-                                    except Exception as e:
-                                        print(f"Error fetching referenced {resource_type} {resource_id}: {str(e)}")
-                                
-                                # Add MedicinalProductDefinition from PlanDefinition
-                                if "subjectReference" in external_protocol and "reference" in external_protocol["subjectReference"]:
-                                    await add_referenced_resource(external_protocol["subjectReference"]["reference"], "MedicinalProductDefinition")
-                                
-                                # Add Organization from PlanDefinition's shared organizations extension
-                                for ext in external_protocol.get("extension", []):
-                                    if ext.get("url") == "http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations":
-                                        for org_ext in ext.get("extension", []):
-                                            if "valueReference" in org_ext and "reference" in org_ext["valueReference"]:
-                                                await add_referenced_resource(org_ext["valueReference"]["reference"], "Organization")
-                                
-                                # Add all referenced resources from ActivityDefinitions
-                                for test_entry in associated_tests:
-                                    test = test_entry["resource"]
-                                    for ext in test.get("extension", []):
-                                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/observation-definitions":
-                                            for obs_ext in ext.get("extension", []):
-                                                if "valueReference" in obs_ext and "reference" in obs_ext["valueReference"]:
-                                                    await add_referenced_resource(obs_ext["valueReference"]["reference"], "ObservationDefinition")
-                                        elif ext.get("url") == "http://example.org/fhir/StructureDefinition/specimen-definition":
-                                            if "valueReference" in ext and "reference" in ext["valueReference"]:
-                                                await add_referenced_resource(ext["valueReference"]["reference"], "SpecimenDefinition")
-                                
-                                print(f"DEBUG - Bundle contents:")
-                                print(f"- 1 PlanDefinition")
-                                print(f"- {len(associated_tests)} ActivityDefinitions")
-                                print(f"- {len(associated_batches)} Medication resources")
-                                print(f"- {len(referenced_resources)} referenced resources")
-                                print(f"DEBUG - Bundle entries: {json.dumps([entry['fullUrl'] for entry in bundle['entry']])}")
-                                
-                                # Send the bundle to the external server
-                                print(f"Pushing bundle with protocol, {len(associated_tests)} test definitions, {len(associated_batches)} batches, and {len(referenced_resources)} referenced resources to {url}")
-                                
-                                # Prepare headers
-                                headers = {
-                                    "Content-Type": "application/fhir+json",
-                                    "Accept": "application/fhir+json"
-                                }
-                                
-                                # Add API key if provided
-                                if api_key:
-                                    headers["Authorization"] = f"Bearer {api_key}"
-                                
-                                # Check if this is a CRO backend URL or a direct FHIR server URL
-                                target_url = url
-                                
-                                # If URL is for a CRO FHIR server, check if we should use their middleware endpoint instead
-                                if "/fhir" in url:
-                                    # Try to see if there's a middleware endpoint available
-                                    cro_backend_url = url.replace("/fhir", "/sponsor/shared-resources")
-                                    print(f"Attempting to use CRO middleware endpoint: {cro_backend_url}")
-                                    target_url = cro_backend_url
-                                  
-                                # For Docker connectivity, replace localhost with container names if needed
-                                if "localhost:8001" in target_url:
-                                    docker_url = target_url.replace("localhost:8001", "cro-backend:8000")
-                                    print(f"Replacing {target_url} with Docker network URL: {docker_url}")
-                                    target_url = docker_url
-                                elif "localhost:8081" in target_url:
-                                    docker_url = target_url.replace("localhost:8081", "cro-fhir-server:8080")
-                                    print(f"Replacing {target_url} with Docker network URL: {docker_url}")
-                                    target_url = docker_url
-                                print(f"bundle: {bundle}")
-                                bundle_response = requests.post(
-                                    target_url,  # Use middleware endpoint if available
-                                    json=bundle,
-                                    headers=headers,
-                                    timeout=45  # Longer timeout for bundle processing
-                                )
-                                
-                                if bundle_response.status_code >= 200 and bundle_response.status_code < 300:
-                                    message_parts = []
-                                    message_parts.append(f"Successfully shared protocol")
-                                    if len(associated_tests) > 0:
-                                        message_parts.append(f"{len(associated_tests)} test definitions")
-                                    if len(associated_batches) > 0:
-                                        message_parts.append(f"{len(associated_batches)} batches")
-                                    
-                                    # Include both the original URL and target URL if different
-                                    endpoint_message = f" to {url}"
-                                    if target_url != url:
-                                        endpoint_message = f" to {url} via middleware {target_url}"
-                                    
-                                    success_message = " and ".join(message_parts) + endpoint_message
-                                    print(f"Successfully shared with {org.get('name')}: {success_message}")
-                                    success, message = True, success_message
-                                else:
-                                    print(f"Failed to share bundle with {org.get('name')}: {bundle_response.status_code} - {bundle_response.text}")
-                                    success, message = False, f"Failed to share protocol: {bundle_response.text}"
-                                    
-                            except Exception as bundle_error:
-                                print(f"Error creating or sending bundle: {str(bundle_error)}")
-                                success, message = False, f"Error sharing protocol: {str(bundle_error)}"
-                        else:
-                            # If not sharing tests, just push the protocol
-                            success, message = await push_protocol_to_external_server(
-                                existing_protocol,
-                                url,
-                                api_key,
-                                share_request.share_mode,
-                                share_request.selected_tests
+                                    "entry": delta_entries
+                                },
+                                headers=headers,
+                                timeout=45  # Longer timeout for bundle processing
                             )
                         
-                        share_results.append({
-                            "organization_id": org_id,
-                            "organization_name": org.get("name"),
-                            "success": success,
-                            "message": message
-                        })
-                    else:
-                        share_results.append({
-                            "organization_id": org_id,
-                            "organization_name": org.get("name", "Unknown"),
-                            "success": False,
-                            "message": "No FHIR server URL provided for this organization"
-                        })
+                        # Include both the original URL and target URL if different
+                        endpoint_message = f" to {url}"
+                        if target_url != url:
+                            endpoint_message = f" to {url} via middleware {target_url}"
+                        
+                        if bundle_response is None:
+                            success, message = True, f"Protocol already up to date at {url}"
+                        elif bundle_response.status_code >= 200 and bundle_response.status_code < 300:
+                            sent_urls = [entry["request"]["url"] for entry in delta_entries if entry["request"]["method"] == "PUT"]
+                            sent_tests = sum(1 for sent_url in sent_urls if sent_url.startswith("ActivityDefinition/"))
+                            sent_batches = sum(1 for sent_url in sent_urls if sent_url.startswith("Medication/"))
+                            removed = len(delta_entries) - len(sent_urls)
+                            
+                            message_parts = []
+                            message_parts.append(f"Successfully shared protocol")
+                            if sent_tests > 0:
+                                message_parts.append(f"{sent_tests} test definitions")
+                            if sent_batches > 0:
+                                message_parts.append(f"{sent_batches} batches")
+                            if removed > 0:
+                                message_parts.append(f"{removed} removals")
+                            
+                            success_message = " and ".join(message_parts) + endpoint_message
+                            logger.info("Successfully shared with %s: %s", org.get('name'), success_message)
+                            success, message = True, success_message
+                            
+                            # The CRO middleware answers 200 even when single resources failed
+                            try:
+                                push_errors = bundle_response.json().get("error_count", 0)
+                            except ValueError:
+                                push_errors = 0
+                            if not push_errors and not batch_load_failed:
+                                # Batches left out of this share stay at the organization, so their
+                                # hashes are kept for the next delta
+                                previous_hashes = share_push_state.get((org_id, protocol_id), {})
+                                share_push_state[(org_id, protocol_id)] = {
+                                    **{
+                                        resource_url: resource_hash
+                                        for resource_url, resource_hash in previous_hashes.items()
+                                        if resource_url.startswith("Medication/")
+                                    },
+                                    **share_bundle["hashes"]
+                                }
+                        else:
+                            logger.error("Failed to share bundle with %s: %s - %s", org.get('name'), bundle_response.status_code, bundle_response.text)
+                            success, message = False, f"Failed to share protocol: {bundle_response.text}"
+                    
+                    except Exception as bundle_error:
+                        logger.error("Error sending bundle: %s", bundle_error)
+                        success, message = False, f"Error sharing protocol: {str(bundle_error)}"
                 else:
-                    share_results.append({
-                        "organization_id": org_id,
-                        "success": False,
-                        "message": f"Could not retrieve organization details: {org_response.status_code}"
-                    })
+                    # If not sharing tests, just push the protocol
+                    success, message = await push_protocol_to_external_server(
+                        existing_protocol,
+                        url,
+                        api_key,
+                        share_request.share_mode,
+                        share_request.selected_tests
+                    )
+                
+                return {
+                    "organization_id": org_id,
+                    "organization_name": org.get("name"),
+                    "success": success,
+                    "message": message
+                }
             except Exception as org_error:
-                share_results.append({
+                return {
                     "organization_id": org_id,
                     "success": False,
                     "message": f"Error processing organization: {str(org_error)}"
-                })
+                }
+        
+        # Push to organizations concurrently, bounded by SHARE_MAX_CONCURRENCY
+        share_semaphore = asyncio.Semaphore(SHARE_MAX_CONCURRENCY)
+        
+        async def share_with_limit(org_id: str) -> Dict[str, Any]:
+            async with share_semaphore:
+                job["organizations"][org_id]["status"] = "running"
+                record_share_progress(job, "organization_started", organization_id=org_id)
+                try:
+                    result = await asyncio.wait_for(share_with_organization(org_id), timeout=SHARE_TARGET_TIMEOUT)
+                except asyncio.TimeoutError:
+                    result = {
+                        "organization_id": org_id,
+                        "success": False,
+                        "message": f"Timed out after {SHARE_TARGET_TIMEOUT} seconds"
+                    }
+                job["organizations"][org_id].update(result)
+                job["organizations"][org_id]["status"] = "completed" if result["success"] else "failed"
+                record_share_progress(job, "organization_finished", **result)
+                return result
+        
+        share_results = await asyncio.gather(
+            *(share_with_limit(org_id) for org_id in share_request.organization_ids)
+        )
         
         return {
             "message": f"Protocol {protocol_id} shared with {len(share_request.organization_ids)} organizations",
-            "share_results": share_results,
+            "share_results": list(share_results),
             "batches_shared": hasattr(share_request, 'shareBatches') and share_request.shareBatches and 
                               hasattr(share_request, 'selectedBatches') and len(share_request.selectedBatches)
         }
     except HTTPException:
         raise
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -1654,74 +2668,104 @@ async def share_protocol(protocol_id: str, share_request: ProtocolShareRequest):
             
         raise HTTPException(status_code=500, detail=f"Failed to share protocol: {error_message}")
 
+async def run_share_job(protocol_id: str, share_request: ProtocolShareRequest, job: Dict[str, Any]):
+    """Run a share job in the background and record its outcome on the job"""
+    job["status"] = "running"
+    record_share_progress(job, "started")
+    try:
+        job["result"] = await run_protocol_share(protocol_id, share_request, job)
+        job["status"] = "completed"
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["error"] = e.detail
+    except Exception as e:
+        logger.error("Error running share job %s: %s", job['id'], e)
+        job["status"] = "failed"
+        job["error"] = f"Failed to share protocol: {str(e)}"
+    record_share_progress(job, job["status"], error=job["error"])
+
+@app.post("/protocols/{protocol_id}/share", status_code=202)
+async def share_protocol(protocol_id: str, share_request: ProtocolShareRequest):
+    """Start sharing a protocol with organizations as a background job and return its ID"""
+    job = create_share_job(protocol_id, share_request.organization_ids)
+    job["_task"] = asyncio.create_task(run_share_job(protocol_id, share_request, job))
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/share-jobs/{job['id']}",
+        "events_url": f"/share-jobs/{job['id']}/events"
+    }
+
+@app.get("/share-jobs/{job_id}")
+async def get_share_job(job_id: str):
+    """Get the progress of a share job, per organization"""
+    job = share_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Share job with ID {job_id} not found")
+    return share_job_status(job)
+
+@app.get("/share-jobs/{job_id}/events")
+async def stream_share_job_events(job_id: str):
+    """Stream the progress events of a share job as server-sent events"""
+    job = share_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Share job with ID {job_id} not found")
+    
+    async def events():
+        sent = 0
+        while True:
+            # Grab the wake-up event before checking, so no update is missed
+            changed = job["_changed"]
+            while sent < len(job["events"]):
+                event = job["events"][sent]
+                sent += 1
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            if job["status"] in ("completed", "failed"):
+                break
+            await changed.wait()
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/protocols/{protocol_id}/shares")
 async def get_protocol_shares(protocol_id: str):
     """Get organizations that this protocol is shared with by reading extension in the PlanDefinition"""
     try:
         # Get the protocol
-        protocol_response = requests.get(
-            f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        protocol_response.raise_for_status()
-        protocol = protocol_response.json()
+        protocol = await read_definition("PlanDefinition", protocol_id)
         
         # Extract organization references
         share_ext_url = "http://example.org/fhir/StructureDefinition/plan-definition-shared-organizations"
-        org_references = []
-        
-        for ext in protocol.get("extension", []):
-            if ext.get("url") == share_ext_url:
-                for org_ext in ext.get("extension", []):
-                    if "valueReference" in org_ext and "reference" in org_ext["valueReference"]:
-                        ref = org_ext["valueReference"]["reference"]
-                        if ref.startswith("Organization/"):
-                            org_id = ref.split("/")[1]
-                            org_references.append(org_id)
+        org_references = [
+            ref.split("/")[1]
+            for ref in ExtensionIndex(protocol).nested_values(share_ext_url)
+            if isinstance(ref, str) and ref.startswith("Organization/")
+        ]
         
         if not org_references:
             return []
         
-        # Get details for each organization
+        # Get the shared organizations from the directory
         shared_orgs = []
         for org_id in org_references:
             try:
-                org_response = requests.get(
-                    f"{FHIR_SERVER_URL}/Organization/{org_id}",
-                    headers={"Accept": "application/fhir+json"}
-                )
-                if org_response.status_code == 200:
-                    org = org_response.json()
-                    
-                    # Extract URL from extension
-                    url = ""
-                    for ext in org.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-url":
-                            url = ext.get("valueString", "")
-                            if url:
-                                break
-                    
-                    # Extract API key from extension
-                    api_key = ""
-                    for ext in org.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/organization-api-key":
-                            api_key = ext.get("valueString", "")
-                            break
-                    
-                    shared_orgs.append({
-                        "id": org.get("id"),
-                        "name": org.get("name"),
-                        "url": url,
-                        "api_key": api_key,
-                        "shared_at": None  # No timestamp in FHIR model
-                    })
-            except Exception as org_error:
-                print(f"Error fetching organization {org_id}: {str(org_error)}")
-                # Continue with other organizations
+                org = await lookup_organization(org_id)
+            except httpx.HTTPError as org_error:
+                logger.error("Error fetching organization %s: %s", org_id, org_error)
+                continue
+            if not org:
+                continue
+            
+            shared_orgs.append({
+                "id": org["id"],
+                "name": org["name"],
+                "url": org["url"],
+                "api_key": org["api_key"],
+                "shared_at": None  # No timestamp in FHIR model
+            })
         
         return shared_orgs
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch protocol shares: {str(e)}")
 
@@ -1731,7 +2775,7 @@ async def create_test(test: TestDefinitionCreate):
     """Create a new stability test definition using FHIR ActivityDefinition"""
     try:
         # Log incoming test data for debugging
-        print(f"Creating test with data: {test.dict()}")
+        log_payload("Creating test", test)
         
         # Convert to FHIR ActivityDefinition
         test_data = {
@@ -1774,7 +2818,7 @@ async def create_test(test: TestDefinitionCreate):
         
         # Add parameters if provided
         if test.parameters:
-            print(f"Adding test parameters: {test.parameters}")
+            logger.debug("Adding test parameters: %s", test.parameters)
             test_data["extension"].append({
                 "url": "http://example.org/fhir/StructureDefinition/stability-test-parameters",
                 "valueString": json.dumps(test.parameters)
@@ -1782,13 +2826,13 @@ async def create_test(test: TestDefinitionCreate):
             
         # Add acceptance criteria if provided
         if test.acceptance_criteria:
-            print(f"Adding acceptance criteria: {test.acceptance_criteria}")
+            logger.debug("Adding acceptance criteria: %s", test.acceptance_criteria)
             test_data["extension"].append({
                 "url": "http://example.org/fhir/StructureDefinition/stability-test-acceptance-criteria",
                 "valueString": json.dumps(test.acceptance_criteria)
             })
         
-        response = requests.post(
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/ActivityDefinition",
             json=test_data,
             headers={
@@ -1797,10 +2841,11 @@ async def create_test(test: TestDefinitionCreate):
             }
         )
         response.raise_for_status()
+        evict_list_cache("/tests", protocol_id=test.protocol_id)
         
         # Return the created test definition
         return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -1811,59 +2856,88 @@ async def create_test(test: TestDefinitionCreate):
         
         raise HTTPException(status_code=500, detail=f"Failed to create test: {error_message}")
 
-@app.post("/enhanced-tests")
-async def create_enhanced_test(test: EnhancedTestDefinitionCreate):
+def add_test_action(protocol: Dict[str, Any], test_title: str, activity_reference: str, timepoint: Optional[str] = None):
     """
-    Create a new stability test using the full FHIR resource hierarchy:
-    - ActivityDefinition: the main test definition
-    - ObservationDefinition(s): defines what measurements to take
-    - SpecimenDefinition: defines what samples are needed
-    
-    This endpoint creates all resources and links them together.
+    Add a test to a PlanDefinition's actions.
+
+    With a timepoint the test goes under the action titled with that timepoint,
+    which is created when missing; otherwise it becomes a top-level action.
+    """
+    actions = protocol.setdefault("action", [])
+    test_action = {
+        "title": test_title,
+        "definitionCanonical": activity_reference
+    }
+    
+    if not timepoint:
+        actions.append(test_action)
+        return
+    
+    for action in actions:
+        if action.get("title") == timepoint:
+            action.setdefault("action", []).append(test_action)
+            return
+    
+    # Create a new timepoint action with this test
+    actions.append({
+        "title": timepoint,
+        "timingTiming": {
+            "repeat": {
+                "boundsDuration": {
+                    "value": int(timepoint.split("-")[0]) if "-" in timepoint else 0,
+                    "unit": "months"
+                }
+            }
+        },
+        "action": [test_action]
+    })
+
+@app.post("/enhanced-tests")
+async def create_enhanced_test(test: EnhancedTestDefinitionCreate):
+    """
+    Create a new stability test using the full FHIR resource hierarchy:
+    - ActivityDefinition: the main test definition
+    - ObservationDefinition(s): defines what measurements to take
+    - SpecimenDefinition: defines what samples are needed
+    
+    Everything is submitted as one transaction Bundle, with urn:uuid fullUrls
+    linking the new resources and a version-conditional update adding the
+    test to the PlanDefinition's actions. Either all resources are created
+    and the protocol is updated, or nothing is.
     """
     try:
-        print(f"Creating enhanced test with data: {test.dict(exclude_none=True)}")
-        created_resources = {}
+        log_payload("Creating enhanced test", test)
+        
+        entries = []
+        
+        def add_entry(resource: Dict[str, Any]) -> str:
+            full_url = f"urn:uuid:{uuid.uuid4()}"
+            entries.append({
+                "fullUrl": full_url,
+                "resource": resource,
+                "request": {
+                    "method": "POST",
+                    "url": resource["resourceType"]
+                }
+            })
+            return full_url
         
-        # Step 1: Create ObservationDefinition resources if provided
-        observation_ids = []
-        if test.observation_definitions:
-            for obs_def in test.observation_definitions:
-                # Create each observation definition
-                obs_def_with_protocol = obs_def.copy()
-                if not obs_def_with_protocol.protocol_id:
-                    obs_def_with_protocol.protocol_id = test.protocol_id
-                
-                try:
-                    obs_response = await create_observation_definition(obs_def_with_protocol)
-                    obs_id = obs_response.get("id")
-                    if obs_id:
-                        observation_ids.append(obs_id)
-                        created_resources[f"ObservationDefinition/{obs_id}"] = obs_response
-                except Exception as obs_error:
-                    print(f"Error creating ObservationDefinition: {str(obs_error)}")
-                    # Continue with other definitions
-            
-            print(f"Created {len(observation_ids)} ObservationDefinition resources")
-        
-        # Step 2: Create SpecimenDefinition if provided
-        specimen_id = None
+        # ObservationDefinition and SpecimenDefinition resources, if provided
+        observation_urls = []
+        for obs_def in test.observation_definitions or []:
+            obs_def_with_protocol = obs_def.copy()
+            if not obs_def_with_protocol.protocol_id:
+                obs_def_with_protocol.protocol_id = test.protocol_id
+            observation_urls.append(add_entry(observation_definition_resource(obs_def_with_protocol)))
+        
+        specimen_url = None
         if test.specimen_definition:
             specimen_def = test.specimen_definition.copy()
             if not specimen_def.protocol_id:
                 specimen_def.protocol_id = test.protocol_id
-                
-            try:
-                specimen_response = await create_specimen_definition(specimen_def)
-                specimen_id = specimen_response.get("id")
-                if specimen_id:
-                    created_resources[f"SpecimenDefinition/{specimen_id}"] = specimen_response
-                    print(f"Created SpecimenDefinition with id: {specimen_id}")
-            except Exception as specimen_error:
-                print(f"Error creating SpecimenDefinition: {str(specimen_error)}")
-                # Continue without specimen definition
-        
-        # Step 3: Create the main ActivityDefinition (test definition)
+            specimen_url = add_entry(specimen_definition_resource(specimen_def))
+        
+        # The main ActivityDefinition (test definition)
         activity_data = {
             "resourceType": "ActivityDefinition",
             "meta": {
@@ -1908,16 +2982,13 @@ async def create_enhanced_test(test: EnhancedTestDefinitionCreate):
                 "valueString": test.test_subtype
             })
         
-        # Add timepoint if provided
+        # Add timepoint if provided; the timing itself only lives on the PlanDefinition
         if test.timepoint:
             activity_data["extension"].append({
                 "url": "http://example.org/fhir/StructureDefinition/stability-test-timepoint",
                 "valueString": test.timepoint
             })
             
-            # Remove redundant timing information from ActivityDefinition
-            # The timing should only be in the PlanDefinition, not duplicated here
-            
         # Add parameters if provided
         if test.parameters:
             activity_data["extension"].append({
@@ -1932,127 +3003,92 @@ async def create_enhanced_test(test: EnhancedTestDefinitionCreate):
                 "valueString": json.dumps(test.acceptance_criteria)
             })
         
-        # Add links to ObservationDefinitions using observationResultRequirement
-        if observation_ids:
-            activity_data["observationResultRequirement"] = [
-                f"ObservationDefinition/{oid}" for oid in observation_ids
-            ]
-
-        # Add link to SpecimenDefinition using specimenRequirement
-        if specimen_id:
-            activity_data["specimenRequirement"] = [
-                f"SpecimenDefinition/{specimen_id}"
-            ]
-        
-        # Create the ActivityDefinition
-        activity_response = requests.post(
-            f"{FHIR_SERVER_URL}/ActivityDefinition",
-            json=activity_data,
-            headers={
-                "Content-Type": "application/fhir+json",
-                "Accept": "application/fhir+json"
-            }
-        )
-        activity_response.raise_for_status()
-        activity_result = activity_response.json()
-        activity_id = activity_result.get("id")
+        # Link the ObservationDefinitions and SpecimenDefinition; the server rewrites
+        # the urn:uuid placeholders to the assigned IDs in the resources it stores
+        if observation_urls:
+            activity_data["observationResultRequirement"] = observation_urls
+        if specimen_url:
+            activity_data["specimenRequirement"] = [specimen_url]
         
-        if activity_id:
-            created_resources[f"ActivityDefinition/{activity_id}"] = activity_result
-            print(f"Created ActivityDefinition with id: {activity_id}")
+        activity_url = add_entry(activity_data)
         
-        # Step 4: Update the PlanDefinition to include this test in its actions if needed
-        try:
-            protocol_response = requests.get(
-                f"{FHIR_SERVER_URL}/PlanDefinition/{test.protocol_id}",
-                headers={"Accept": "application/fhir+json"}
-            )
-            protocol_response.raise_for_status()
-            protocol = protocol_response.json()
-            
-            # Check if we need to add this as an action
-            actions = protocol.get("action", [])
-            action_exists = False
-            
-            for action in actions:
-                # Check if this action references our new ActivityDefinition
-                def_canonical = action.get("definitionCanonical")
-                if def_canonical and def_canonical == f"ActivityDefinition/{activity_id}":
-                    action_exists = True
-                    break
-                    
-                # Also check for timepoint match if provided
-                if test.timepoint and action.get("title") == test.timepoint:
-                    # If we're adding to an existing timepoint action, see if we need to add our test
-                    action_actions = action.get("action", [])
-                    for sub_action in action_actions:
-                        if sub_action.get("definitionCanonical") == f"ActivityDefinition/{activity_id}":
-                            action_exists = True
-                            break
+        # Add the test to the protocol's actions, only if nobody changed the protocol since we
+        # read it. On a conflict nothing was written, so the protocol is read again and the
+        # whole transaction resubmitted, up to UPDATE_RETRY_ATTEMPTS times.
+        for attempt in range(1, UPDATE_RETRY_ATTEMPTS + 1):
+            try:
+                protocol = await read_definition("PlanDefinition", test.protocol_id)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 404:
+                    raise HTTPException(status_code=404, detail=f"Protocol with ID {test.protocol_id} not found")
+                raise
             
-            if not action_exists and activity_id:
-                if test.timepoint:
-                    # Try to find a matching timepoint action to add this to
-                    timepoint_action = None
-                    for i, action in enumerate(actions):
-                        if action.get("title") == test.timepoint:
-                            timepoint_action = action
-                            timepoint_idx = i
-                            break
-                    
-                    if timepoint_action:
-                        # Add this test to the existing timepoint action
-                        if "action" not in timepoint_action:
-                            timepoint_action["action"] = []
-                            
-                        timepoint_action["action"].append({
-                            "title": test.title,
-                            "definitionCanonical": f"ActivityDefinition/{activity_id}"
-                        })
-                        
-                        # Update the action in the protocol
-                        protocol["action"][timepoint_idx] = timepoint_action
-                    else:
-                        # Create a new timepoint action with this test
-                        protocol["action"].append({
-                            "title": test.timepoint,
-                            "timingTiming": {
-                                "repeat": {
-                                    "boundsDuration": {
-                                        "value": int(test.timepoint.split("-")[0]) if "-" in test.timepoint else 0,
-                                        "unit": "months"
-                                    }
-                                }
-                            },
-                            "action": [
-                                {
-                                    "title": test.title,
-                                    "definitionCanonical": f"ActivityDefinition/{activity_id}"
-                                }
-                            ]
-                        })
-                else:
-                    # Add as a top-level action
-                    protocol["action"].append({
-                        "title": test.title,
-                        "definitionCanonical": f"ActivityDefinition/{activity_id}"
-                    })
-                
-                # Update the protocol
-                update_response = requests.put(
-                    f"{FHIR_SERVER_URL}/PlanDefinition/{test.protocol_id}",
-                    json=protocol,
-                    headers={
-                        "Content-Type": "application/fhir+json",
-                        "Accept": "application/fhir+json"
-                    }
+            protocol_request = {
+                "method": "PUT",
+                "url": f"PlanDefinition/{test.protocol_id}"
+            }
+            version_id = protocol.get("meta", {}).get("versionId")
+            if version_id:
+                protocol_request["ifMatch"] = f'W/"{version_id}"'
+            add_test_action(protocol, test.title, activity_url, test.timepoint)
+            transaction_entries = entries + [{
+                "fullUrl": f"{FHIR_SERVER_URL}/PlanDefinition/{test.protocol_id}",
+                "resource": protocol,
+                "request": protocol_request
+            }]
+            
+            try:
+                transaction_response = await submit_fhir_transaction(transaction_entries, return_resources=True)
+                break
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in (409, 412):
+                    raise
+                if attempt == UPDATE_RETRY_ATTEMPTS:
+                    raise HTTPException(
+                        status_code=409,
+                        detail=f"Protocol {test.protocol_id} was modified while the test was being created, please retry"
+                    )
+                logger.info(
+                    "PlanDefinition/%s was modified concurrently, resubmitting enhanced test (attempt %s of %s)",
+                    test.protocol_id, attempt, UPDATE_RETRY_ATTEMPTS
                 )
-                update_response.raise_for_status()
+        
+        evict_list_cache("/protocols")
+        evict_list_cache("/tests", protocol_id=test.protocol_id)
+        
+        # Map the transaction response back onto the created resources. The submitted
+        # copies still hold the urn:uuid placeholders, so resources the server did not
+        # return are read back instead
+        created_resources = {}
+        missing = {}
+        activity_id = None
+        for response_entry in transaction_response.get("entry", []):
+            location = response_entry.get("response", {}).get("location", "")
+            resource_type, _, rest = location.partition("/")
+            resource_id = rest.split("/")[0]
+            if resource_type == "PlanDefinition":
                 created_resources[f"PlanDefinition/{test.protocol_id}"] = "updated to include test"
-                print(f"Updated PlanDefinition/{test.protocol_id} to include the new test")
-        except Exception as protocol_error:
-            print(f"Warning: Failed to update protocol with test action: {str(protocol_error)}")
-            # Continue without updating protocol
+                continue
+            created_resources[f"{resource_type}/{resource_id}"] = response_entry.get("resource")
+            if not response_entry.get("resource"):
+                missing.setdefault(resource_type, []).append(resource_id)
+            if resource_type == "ActivityDefinition":
+                activity_id = resource_id
+        
+        for resource_type, resource_ids in missing.items():
+            try:
+                stored = await read_resources_by_id(resource_type, resource_ids)
+            except httpx.HTTPError as e:
+                # The transaction is committed, so a failed read-back is not an error
+                logger.warning("Could not read back created %s resources: %s", resource_type, e)
+                continue
+            for resource_id in resource_ids:
+                created_resources[f"{resource_type}/{resource_id}"] = stored.get(resource_id)
+        
+        logger.info(
+            "Created ActivityDefinition/%s with %s linked definitions and updated PlanDefinition/%s in one transaction",
+            activity_id, len(entries) - 1, test.protocol_id
+        )
         
         # Return a summary of all created resources
         return {
@@ -2060,10 +3096,12 @@ async def create_enhanced_test(test: EnhancedTestDefinitionCreate):
             "resources_created": len(created_resources),
             "resources": created_resources
         }
-        
+    
+    except HTTPException:
+        raise
     except Exception as e:
         error_message = str(e)
-        print(f"Error creating enhanced test: {error_message}")
+        logger.error("Error creating enhanced test: %s", error_message)
         if hasattr(e, 'response') and e.response:
             try:
                 error_detail = e.response.json()
@@ -2074,150 +3112,114 @@ async def create_enhanced_test(test: EnhancedTestDefinitionCreate):
         raise HTTPException(status_code=500, detail=f"Failed to create enhanced test: {error_message}")
 
 @app.get("/tests")
-async def get_tests(protocol_id: Optional[str] = None):
+@cached_list_response("/tests")
+async def get_tests(protocol_id: Optional[str] = None, compact: bool = False):
     """Get all stability test definitions, optionally filtered by protocol ID"""
     try:
-        print(f"Fetching tests from FHIR server: {FHIR_SERVER_URL}")
-        print(f"Protocol filter: {protocol_id or 'None'}")
+        logger.debug("Fetching tests from FHIR server: %s", FHIR_SERVER_URL)
+        logger.debug("Protocol filter: %s", protocol_id or 'None')
         
-        # Get all test definitions
+        # Stream test definitions page by page
         try:
-            response = requests.get(
-                f"{FHIR_SERVER_URL}/ActivityDefinition",
-                headers={"Accept": "application/fhir+json"},
-                timeout=5  # 5 second timeout
-            )
-            
-            print(f"ActivityDefinition search status code: {response.status_code}")
-            response.raise_for_status()
-            all_tests = response.json()
-            print(f"Found {all_tests.get('total', 0)} total ActivityDefinition resources")
-            
-            # Check if we have a valid bundle
-            if not all_tests or all_tests.get("resourceType") != "Bundle":
-                print(f"Warning: Expected Bundle but got {all_tests.get('resourceType', 'None')}")
-                return {"resourceType": "Bundle", "type": "searchset", "total": 0, "entry": []}
-                
-            if not all_tests.get("entry"):
-                print("Warning: Bundle contains no entries")
-                return {"resourceType": "Bundle", "type": "searchset", "total": 0, "entry": []}
-            
             if protocol_id:
-                # Filter tests by protocol_id in the extension
-                filtered_entries = []
-                
-                for entry in all_tests["entry"]:
-                    test = entry.get("resource", {})
-                    
-                    # Check for protocol reference in extensions
-                    for ext in test.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/stability-test-protocol":
-                            if ext.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}":
-                                filtered_entries.append(entry)
-                                break
-                
-                # Return filtered bundle
-                filtered_bundle = {
-                    "resourceType": "Bundle",
-                    "type": "searchset",
-                    "total": len(filtered_entries),
-                    "entry": filtered_entries
-                }
-                
-                print(f"Filtered to {len(filtered_entries)} tests for protocol {protocol_id}")
-                return filtered_bundle
+                # Let the FHIR server filter on the stability-test-protocol extension
+                entries = iter_extension_search("ActivityDefinition", {
+                    "stability-test-protocol": f"PlanDefinition/{protocol_id}"
+                })
+            else:
+                entries = iter_fhir_search("ActivityDefinition")
             
-            return all_tests
+            return await stream_search_bundle(entries, compact)
             
-        except requests.Timeout:
-            print(f"Error: Connection to FHIR server at {FHIR_SERVER_URL} timed out")
+        except httpx.TimeoutException:
+            logger.error("Connection to FHIR server at %s timed out", FHIR_SERVER_URL)
             raise HTTPException(
                 status_code=504, 
                 detail=f"Connection to FHIR server timed out. Please check that the FHIR server is running at {FHIR_SERVER_URL}."
             )
-    except requests.ConnectionError as e:
+    except httpx.ConnectError as e:
         error_message = f"Could not connect to FHIR server at {FHIR_SERVER_URL}: {str(e)}"
-        print(f"Error: {error_message}")
+        logger.error(error_message)
         raise HTTPException(status_code=503, detail=error_message)
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = f"Failed to fetch tests: {str(e)}"
-        print(f"Error: {error_message}")
+        logger.error(error_message)
         raise HTTPException(status_code=500, detail=error_message)
 
 @app.get("/tests/{test_id}")
 async def get_test(test_id: str):
     """Get a specific test definition by ID"""
     try:
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/ActivityDefinition/{test_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+        return passthrough_response(*await read_definition_raw("ActivityDefinition", test_id))
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Test with ID {test_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch test: {str(e)}")
 
 # Batch Management Endpoints
-@app.post("/batches")
-async def create_batch(batch: BatchCreate):
-    """Create a new test batch using FHIR Medication resource"""
-    try:
-        # Convert to FHIR Medication with proper structure
-        batch_data = {
-            "resourceType": "Medication",
-            "code": {
-                "coding": [
-                    {
-                        "system": "http://example.org/stability-batches",
-                        "code": "stability-batch",
-                        "display": "Stability Test Batch"
-                    }
-                ],
-                "text": batch.name
-            },
-            "status": batch.status,
-            "identifier": [
+def batch_resource(batch: BatchCreate) -> Dict[str, Any]:
+    """Build the FHIR Medication for a BatchCreate request"""
+    batch_data = {
+        "resourceType": "Medication",
+        "code": {
+            "coding": [
                 {
-                    "system": "http://example.org/batch-identifiers",
-                    "value": batch.identifier
+                    "system": "http://example.org/stability-batches",
+                    "code": "stability-batch",
+                    "display": "Stability Test Batch"
                 }
             ],
-            "batch": {
-                "lotNumber": batch.lot_number,
-                "expirationDate": batch.expiry_date,
-                "extension": []
-            },
+            "text": batch.name
+        },
+        "status": batch.status,
+        "identifier": [
+            {
+                "system": "http://example.org/batch-identifiers",
+                "value": batch.identifier
+            }
+        ],
+        "batch": {
+            "lotNumber": batch.lot_number,
+            "expirationDate": batch.expiry_date,
             "extension": []
-        }
-        
-        # Add manufacturing date as extension in batch
-        if batch.manufacturing_date:
-            batch_data["batch"]["extension"].append({
-                "url": "http://example.org/fhir/StructureDefinition/manufacturing-date",
-                "valueDateTime": batch.manufacturing_date
-            })
-        
-        # Add reference to medicinal product if provided
-        if batch.medicinal_product_id:
-            # Use extension for MedicinalProductDefinition reference
-            batch_data["extension"].append({
-                "url": "http://example.org/fhir/StructureDefinition/medicinal-product",
-                "valueReference": {
-                    "reference": f"MedicinalProductDefinition/{batch.medicinal_product_id}",
-                    "display": "Medicinal Product Definition"
-                }
-            })
+        },
+        "extension": []
+    }
+    
+    # Add manufacturing date as extension in batch
+    if batch.manufacturing_date:
+        batch_data["batch"]["extension"].append({
+            "url": "http://example.org/fhir/StructureDefinition/manufacturing-date",
+            "valueDateTime": batch.manufacturing_date
+        })
+    
+    # Add reference to medicinal product if provided
+    if batch.medicinal_product_id:
+        # Use extension for MedicinalProductDefinition reference
+        batch_data["extension"].append({
+            "url": "http://example.org/fhir/StructureDefinition/medicinal-product",
+            "valueReference": {
+                "reference": f"MedicinalProductDefinition/{batch.medicinal_product_id}",
+                "display": "Medicinal Product Definition"
+            }
+        })
+    
+        # Provide standard ingredient link for improved interoperability
+        batch_data.setdefault("ingredient", []).append({
+            "itemReference": {
+                "reference": f"MedicinalProductDefinition/{batch.medicinal_product_id}"
+            }
+        })
+    
+    return batch_data
 
-            # Provide standard ingredient link for improved interoperability
-            batch_data.setdefault("ingredient", []).append({
-                "itemReference": {
-                    "reference": f"MedicinalProductDefinition/{batch.medicinal_product_id}"
-                }
-            })
+@app.post("/batches")
+async def create_batch(batch: BatchCreate):
+    """Create a new test batch using FHIR Medication resource"""
+    try:
+        batch_data = batch_resource(batch)
         
-        response = requests.post(
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/Medication",
             json=batch_data,
             headers={
@@ -2229,7 +3231,7 @@ async def create_batch(batch: BatchCreate):
         
         # Return the created batch
         return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -2240,185 +3242,171 @@ async def create_batch(batch: BatchCreate):
         
         raise HTTPException(status_code=500, detail=f"Failed to create batch: {error_message}")
 
+@app.post("/batches:bulk")
+async def create_batches_bulk(batches: List[Dict[str, Any]], chunk_size: Optional[int] = None):
+    """Create many batches at once, returning the outcome of each item in request order"""
+    return await bulk_create(batches, BatchCreate, batch_resource, chunk_size)
+
 @app.get("/batches")
-async def get_batches(protocol_id: Optional[str] = None):
+async def get_batches(protocol_id: Optional[str] = None, compact: bool = False):
     """Get all batches (Medication resources), optionally filtered by protocol ID"""
     try:
+        entries = iter_fhir_search("Medication")
+        
         if protocol_id:
             # First, get the protocol to find its medicinal product
             medicinal_product_id = None
             try:
-                protocol_response = requests.get(
-                    f"{FHIR_SERVER_URL}/PlanDefinition/{protocol_id}",
-                    headers={"Accept": "application/fhir+json"}
-                )
-                protocol_response.raise_for_status()
-                protocol = protocol_response.json()
+                protocol = await read_definition("PlanDefinition", protocol_id)
                 
                 # Check if protocol has a subject reference to medicinal product
                 if "subjectReference" in protocol and "reference" in protocol["subjectReference"]:
                     ref = protocol["subjectReference"]["reference"]
                     if ref.startswith("MedicinalProductDefinition/"):
                         medicinal_product_id = ref.split("/")[1]
-                        print(f"Found medicinal product ID in protocol: {medicinal_product_id}")
+                        logger.debug("Found medicinal product ID in protocol: %s", medicinal_product_id)
             except Exception as e:
-                print(f"Error getting protocol medicinal product: {str(e)}")
-            
-            # Get all Medications
-            response = requests.get(
-                f"{FHIR_SERVER_URL}/Medication",
-                headers={"Accept": "application/fhir+json"}
-            )
-            response.raise_for_status()
-            all_medications = response.json()
+                logger.error("Error getting protocol medicinal product: %s", e)
             
             # Filter medications by medicinal_product_id or direct protocol reference
-            if all_medications and all_medications.get("resourceType") == "Bundle" and all_medications.get("entry"):
-                filtered_entries = []
+            def is_for_protocol(medication):
+                extensions = ExtensionIndex(medication)
                 
-                for entry in all_medications["entry"]:
-                    medication = entry.get("resource", {})
-                    include_entry = False
-                    
-                    # First check for direct protocol reference (backward compatibility)
-                    for ext in medication.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/batch-protocol":
-                            if ext.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}":
-                                include_entry = True
-                                break
-                    
-                    # If not included yet and we have a medicinal product ID, check for that
-                    if not include_entry and medicinal_product_id:
-                        # Check medicinal product reference in extensions
-                        for ext in medication.get("extension", []):
-                            if ext.get("url") == "http://example.org/fhir/StructureDefinition/medicinal-product":
-                                if ext.get("valueReference", {}).get("reference") == f"MedicinalProductDefinition/{medicinal_product_id}":
-                                    include_entry = True
-                                    break
-                        
-                        # Also check ingredient references
-                        if not include_entry and "ingredient" in medication:
-                            for ingredient in medication["ingredient"]:
-                                if "itemReference" in ingredient and ingredient["itemReference"].get("reference") == f"MedicinalProductDefinition/{medicinal_product_id}":
-                                    include_entry = True
-                                    break
+                # First check for direct protocol reference (backward compatibility)
+                if f"PlanDefinition/{protocol_id}" in extensions.values("http://example.org/fhir/StructureDefinition/batch-protocol"):
+                    return True
+                
+                # If not included yet and we have a medicinal product ID, check for that
+                if medicinal_product_id:
+                    # Check medicinal product reference in extensions
+                    if f"MedicinalProductDefinition/{medicinal_product_id}" in extensions.values("http://example.org/fhir/StructureDefinition/medicinal-product"):
+                        return True
                     
-                    if include_entry:
-                        filtered_entries.append(entry)
+                    # Also check ingredient references
+                    for ingredient in medication.get("ingredient", []):
+                        if "itemReference" in ingredient and ingredient["itemReference"].get("reference") == f"MedicinalProductDefinition/{medicinal_product_id}":
+                            return True
                 
-                # Return filtered bundle
-                filtered_bundle = {
-                    "resourceType": "Bundle",
-                    "type": "searchset",
-                    "total": len(filtered_entries),
-                    "entry": filtered_entries
-                }
-                return filtered_bundle
-            
-            return all_medications
-        else:
-            # Get all Medications without filtering
-            response = requests.get(
-                f"{FHIR_SERVER_URL}/Medication",
-                headers={"Accept": "application/fhir+json"}
-            )
+                return False
             
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
+            if medicinal_product_id:
+                entries = filter_entries(entries, is_for_protocol)
+            else:
+                # Only the direct protocol reference can match, so let the FHIR server filter
+                entries = iter_extension_search("Medication", {
+                    "batch-protocol": f"PlanDefinition/{protocol_id}"
+                })
+        
+        return await stream_search_bundle(entries, compact)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch batches: {str(e)}")
 
 @app.get("/batches/{batch_id}")
 async def get_batch(batch_id: str):
     """Get a specific batch by ID"""
     try:
-        response = requests.get(
+        response = await fhir_get(
             f"{FHIR_SERVER_URL}/Medication/{batch_id}",
             headers={"Accept": "application/fhir+json"}
         )
         response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+        return passthrough_response(
+            response.content,
+            response.headers.get("content-type", "application/fhir+json"),
+            response.status_code
+        )
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Batch with ID {batch_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch batch: {str(e)}")
 
 # Test Results Endpoints
-@app.post("/results")
-async def create_test_result(result: TestResultCreate):
-    """Create a new test result using FHIR Observation resource"""
-    try:
-        print(f"Creating test result with data: {result.dict()}")
-        
-        # Convert to FHIR Observation
-        result_data = {
-            "resourceType": "Observation",
-            "status": result.status,
-            "code": {
-                "coding": [
-                    {
-                        "system": "http://example.org/stability-tests",
-                        "code": "result",
-                        "display": "Stability Test Result"
-                    }
-                ]
-            },
-            "effectiveDateTime": result.result_date,
-            "valueString": json.dumps(result.value) if isinstance(result.value, (dict, list)) else str(result.value),
-            "subject": {
-                "reference": f"Medication/{result.batch_id}"
-            },
-            "extension": [
-                {
-                    "url": "http://example.org/fhir/StructureDefinition/test-definition",
-                    "valueReference": {
-                        "reference": f"ActivityDefinition/{result.test_id}"
-                    }
-                },
+def test_result_resource(result: TestResultCreate) -> Dict[str, Any]:
+    """Build the FHIR Observation for a TestResultCreate request"""
+    result_data = {
+        "resourceType": "Observation",
+        "status": result.status,
+        "code": {
+            "coding": [
                 {
-                    "url": "http://example.org/fhir/StructureDefinition/result-organization",
-                    "valueReference": {
-                        "reference": f"Organization/{result.organization_id}"
-                    }
+                    "system": "http://example.org/stability-tests",
+                    "code": "result",
+                    "display": "Stability Test Result"
                 }
             ]
-        }
-        
-        print(f"Converted to FHIR Observation: {json.dumps(result_data, indent=2)}")
-        
-        # Link to ObservationDefinition if provided
-        if result.observation_definition_id:
-            result_data["hasMember"] = [
-                {
-                    "reference": f"ObservationDefinition/{result.observation_definition_id}"
+        },
+        "effectiveDateTime": result.result_date,
+        "valueString": json.dumps(result.value) if isinstance(result.value, (dict, list)) else str(result.value),
+        "subject": {
+            "reference": f"Medication/{result.batch_id}"
+        },
+        "extension": [
+            {
+                "url": "http://example.org/fhir/StructureDefinition/test-definition",
+                "valueReference": {
+                    "reference": f"ActivityDefinition/{result.test_id}"
                 }
-            ]
-            
-            # Also add as a specific extension
-            result_data["extension"].append({
-                "url": "http://example.org/fhir/StructureDefinition/observation-definition-reference",
+            },
+            {
+                "url": "http://example.org/fhir/StructureDefinition/result-organization",
                 "valueReference": {
-                    "reference": f"ObservationDefinition/{result.observation_definition_id}"
+                    "reference": f"Organization/{result.organization_id}"
                 }
-            })
+            }
+        ]
+    }
+    
+    # Link to ObservationDefinition if provided
+    if result.observation_definition_id:
+        result_data["hasMember"] = [
+            {
+                "reference": f"ObservationDefinition/{result.observation_definition_id}"
+            }
+        ]
+    
+        # Also add as a specific extension
+        result_data["extension"].append({
+            "url": "http://example.org/fhir/StructureDefinition/observation-definition-reference",
+            "valueReference": {
+                "reference": f"ObservationDefinition/{result.observation_definition_id}"
+            }
+        })
+    
+    # Add unit if provided
+    if result.unit:
+        result_data["extension"].append({
+            "url": "http://example.org/fhir/StructureDefinition/result-unit",
+            "valueString": result.unit
+        })
+    
+    # Add storage condition if provided
+    if result.storage_condition:
+        result_data["extension"].append({
+            "url": "http://example.org/fhir/StructureDefinition/storage-condition",
+            "valueString": result.storage_condition
+        })
+    
+    # Add comments if provided
+    if result.comments:
+        result_data["note"] = [
+            {
+                "text": result.comments
+            }
+        ]
+    
+    return result_data
+
+@app.post("/results")
+async def create_test_result(result: TestResultCreate):
+    """Create a new test result using FHIR Observation resource"""
+    try:
+        log_payload("Creating test result", result)
         
-        # Add unit if provided
-        if result.unit:
-            result_data["extension"].append({
-                "url": "http://example.org/fhir/StructureDefinition/result-unit",
-                "valueString": result.unit
-            })
-            
-        # Add comments if provided
-        if result.comments:
-            result_data["note"] = [
-                {
-                    "text": result.comments
-                }
-            ]
+        result_data = test_result_resource(result)
+        log_payload("Converted to FHIR Observation", result_data)
         
-        print(f"Sending request to FHIR server: {FHIR_SERVER_URL}/Observation")
-        response = requests.post(
+        logger.debug("Sending request to FHIR server: %s/Observation", FHIR_SERVER_URL)
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/Observation",
             json=result_data,
             headers={
@@ -2428,122 +3416,68 @@ async def create_test_result(result: TestResultCreate):
         )
         
         if response.status_code >= 400:
-            print(f"FHIR server error response: {response.status_code}")
-            print(f"Error details: {response.text}")
+            logger.error("FHIR server error response: %s %s", response.status_code, response.text)
             response.raise_for_status()
             
-        print(f"Successfully created test result with ID: {response.json().get('id')}")
+        logger.info("Successfully created test result with ID: %s", response.json().get('id'))
         return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
                 error_detail = e.response.json()
                 error_message = json.dumps(error_detail)
-                print(f"FHIR server error response: {error_message}")
+                logger.error("FHIR server error response: %s", error_message)
             except:
                 error_message = e.response.text
-                print(f"FHIR server error response (text): {error_message}")
+                logger.error("FHIR server error response (text): %s", error_message)
         
-        print(f"Failed to create test result: {error_message}")
+        logger.error("Failed to create test result: %s", error_message)
         raise HTTPException(status_code=500, detail=f"Failed to create test result: {error_message}")
     except Exception as e:
-        print(f"Unexpected error creating test result: {str(e)}")
+        logger.error("Unexpected error creating test result: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to create test result: {str(e)}")
 
+@app.post("/results:bulk")
+async def create_test_results_bulk(results: List[Dict[str, Any]], chunk_size: Optional[int] = None):
+    """Create many test results at once, returning the outcome of each item in request order"""
+    return await bulk_create(results, TestResultCreate, test_result_resource, chunk_size)
+
 @app.get("/results")
 async def get_results(
     batch_id: Optional[str] = None,
     test_id: Optional[str] = None,
-    organization_id: Optional[str] = None
+    organization_id: Optional[str] = None,
+    compact: bool = False
 ):
     """Get test results, optionally filtered by batch, test, or organization"""
     try:
         # Build standard query parameters
-        query_params = []
+        query_params = {}
         if batch_id:
             # 'subject' is the appropriate search parameter for Observation when referencing a Medication
-            query_params.append(f"subject=Medication/{batch_id}")
+            query_params["subject"] = f"Medication/{batch_id}"
         
-        query_string = "&".join(query_params)
+        # Extension filters go to the FHIR server when it supports them
+        references = {}
+        if test_id:
+            references["test-definition"] = f"ActivityDefinition/{test_id}"
+        if organization_id:
+            references["result-organization"] = f"Organization/{organization_id}"
         
-        # Get observations
-        if query_string:
-            response = requests.get(
-                f"{FHIR_SERVER_URL}/Observation?{query_string}",
-                headers={"Accept": "application/fhir+json"}
-            )
+        # Get observations page by page
+        if references:
+            entries = iter_extension_search("Observation", references, query_params)
         else:
-            response = requests.get(
-                f"{FHIR_SERVER_URL}/Observation",
-                headers={"Accept": "application/fhir+json"}
-            )
-            
-        response.raise_for_status()
-        all_observations = response.json()
+            entries = iter_fhir_search("Observation", query_params)
         
-        # If test_id or organization_id filters are specified, we need to filter in our code
-        if (test_id or organization_id) and all_observations and all_observations.get("resourceType") == "Bundle" and all_observations.get("entry"):
-            filtered_entries = []
-            
-            for entry in all_observations["entry"]:
-                observation = entry.get("resource", {})
-                include_entry = True
-                
-                # Check test_id filter
-                if test_id and include_entry:
-                    test_reference_found = False
-                    for ext in observation.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/test-definition":
-                            if ext.get("valueReference", {}).get("reference") == f"ActivityDefinition/{test_id}":
-                                test_reference_found = True
-                                break
-                    include_entry = test_reference_found
-                
-                # Check organization_id filter
-                if organization_id and include_entry:
-                    org_reference_found = False
-                    for ext in observation.get("extension", []):
-                        if ext.get("url") == "http://example.org/fhir/StructureDefinition/result-organization":
-                            if ext.get("valueReference", {}).get("reference") == f"Organization/{organization_id}":
-                                org_reference_found = True
-                                break
-                    include_entry = org_reference_found
-                
-                if include_entry:
-                    filtered_entries.append(entry)
-            
-            # Return filtered bundle
-            filtered_bundle = {
-                "resourceType": "Bundle",
-                "type": "searchset",
-                "total": len(filtered_entries),
-                "entry": filtered_entries
-            }
-            return filtered_bundle
-            
-        return all_observations
-    except requests.RequestException as e:
+        return await stream_search_bundle(entries, compact)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch test results: {str(e)}")
 
-@app.get("/results/{result_id}")
-async def get_result(result_id: str):
-    """Get a specific test result by ID"""
-    try:
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/Observation/{result_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
-            raise HTTPException(status_code=404, detail=f"Result with ID {result_id} not found")
-        raise HTTPException(status_code=500, detail=f"Failed to fetch result: {str(e)}")
-
-# Endpoint to fetch CRO test results
+# Endpoint to fetch CRO test results; declared before /results/{result_id} so "cro" is not taken for an ID
 @app.get("/results/cro", response_model=List[Dict[str, Any]])
-async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[str] = None):
+async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[str] = None, compact: bool = False):
     """
     Fetch test results from CROs for a specific protocol or batch
     
@@ -2554,7 +3488,6 @@ async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[
     try:
         # Build query to find results
         query_params = {
-            "_count": 100,
             "category": "stability-test"
         }
         
@@ -2564,19 +3497,20 @@ async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[
         # Filter by batch if provided
         if batch_id:
             query_params["subject"] = f"Medication/{batch_id}"
+            # Results without a protocol reference are matched through their batch,
+            # so have the batches returned with the results instead of fetched per result
+            if protocol_id:
+                query_params["_include"] = "Observation:subject"
         
-        # Execute the query
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/Observation",
-            params=query_params,
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        
-        # Get all results
+        # Get all results, following every result page
         all_results = []
-        for entry in response.json().get("entry", []):
+        batch_matched = []
+        included_batches = {}
+        async for entry in iter_fhir_search("Observation", query_params):
             observation = entry["resource"]
+            if entry.get("search", {}).get("mode") == "include":
+                included_batches[f"{observation.get('resourceType')}/{observation.get('id')}"] = observation
+                continue
             
             # Process each result to extract key information
             processed_result = {
@@ -2598,12 +3532,13 @@ async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[
                 processed_result["value"] = "No value recorded"
                 processed_result["unit"] = ""
             
+            extensions = ExtensionIndex(observation)
+            
             # Extract protocol reference if available
-            for ext in observation.get("extension", []):
-                if ext.get("url") == "http://example.org/fhir/StructureDefinition/test-protocol":
-                    if ext.get("valueReference", {}).get("reference", "").startswith("PlanDefinition/"):
-                        processed_result["protocol_id"] = ext.get("valueReference", {}).get("reference", "").replace("PlanDefinition/", "")
-                        break
+            for ref in extensions.values("http://example.org/fhir/StructureDefinition/test-protocol"):
+                if ref.startswith("PlanDefinition/"):
+                    processed_result["protocol_id"] = ref.replace("PlanDefinition/", "")
+                    break
             
             # Extract performer information
             if observation.get("performer") and len(observation["performer"]) > 0:
@@ -2612,12 +3547,11 @@ async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[
                 processed_result["performed_by"] = "Unknown"
                 
             # Extract CRO organization information
-            for ext in observation.get("extension", []):
-                if ext.get("url") == "http://example.org/fhir/StructureDefinition/result-organization" and ext.get("valueReference"):
-                    ref = ext.get("valueReference", {})
-                    processed_result["cro_id"] = ref.get("reference", "").replace("Organization/", "")
-                    processed_result["cro_name"] = ref.get("display", "Unknown CRO")
-                    break
+            cro_ext = extensions.first("http://example.org/fhir/StructureDefinition/result-organization")
+            if cro_ext and cro_ext.get("valueReference"):
+                ref = cro_ext["valueReference"]
+                processed_result["cro_id"] = ref.get("reference", "").replace("Organization/", "")
+                processed_result["cro_name"] = ref.get("display", "Unknown CRO")
             
             # Filter by protocol if specified
             if protocol_id:
@@ -2625,27 +3559,33 @@ async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[
                     all_results.append(processed_result)
                 # If result doesn't have protocol ID but has batch ID, check if batch belongs to protocol
                 elif batch_id and batch_id == processed_result.get("batch_id"):
-                    # Check if batch belongs to protocol
-                    try:
-                        batch_response = requests.get(
-                            f"{FHIR_SERVER_URL}/Medication/{batch_id}",
-                            headers={"Accept": "application/fhir+json"}
-                        )
-                        if batch_response.status_code == 200:
-                            batch = batch_response.json()
-                            # Check extensions for protocol reference
-                            for ext in batch.get("extension", []):
-                                if ext.get("url") == "http://example.org/fhir/StructureDefinition/batch-protocol" and ext.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}":
-                                    all_results.append(processed_result)
-                                    break
-                    except:
-                        # If we can't fetch batch, skip this result
-                        pass
+                    all_results.append(processed_result)
+                    batch_matched.append(processed_result)
             else:
                 # No protocol filter, add all results
                 all_results.append(processed_result)
+        
+        # Every batch-matched result has the same batch, so it is checked once, from the
+        # included resources or with a single read if the server ignored _include
+        if batch_matched:
+            batch = included_batches.get(f"Medication/{batch_id}")
+            if batch is None:
+                try:
+                    batch_response = await fhir_get(
+                        f"{FHIR_SERVER_URL}/Medication/{batch_id}",
+                        headers={"Accept": "application/fhir+json"}
+                    )
+                    if batch_response.status_code == 200:
+                        batch = batch_response.json()
+                except httpx.HTTPError:
+                    # If we can't fetch batch, skip these results
+                    pass
+            # Check extensions for protocol reference
+            if not (batch and has_extension_reference(batch, "http://example.org/fhir/StructureDefinition/batch-protocol", f"PlanDefinition/{protocol_id}")):
+                unconfirmed = {id(result) for result in batch_matched}
+                all_results = [result for result in all_results if id(result) not in unconfirmed]
                 
-        return all_results
+        return list_response(all_results, compact)
     except Exception as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
@@ -2657,57 +3597,148 @@ async def get_cro_results(protocol_id: Optional[str] = None, batch_id: Optional[
         
         raise HTTPException(status_code=500, detail=f"Failed to retrieve CRO results: {error_message}")
 
-# External results endpoint for CROs to push results
-@app.post("/results/external")
-async def receive_external_result(result: Dict[str, Any]):
-    """Receive test results from external CROs"""
+@app.get("/results/{result_id}")
+async def get_result(result_id: str):
+    """Get a specific test result by ID"""
     try:
-        # Verify this is a valid result from a CRO
-        is_cro_result = False
-        
-        # Check extensions for source indicator
-        for ext in result.get("extension", []):
-            if (ext.get("url") == "http://example.org/fhir/StructureDefinition/result-source" and
-                ext.get("valueString") == "cro"):
-                is_cro_result = True
-                break
-        
-        if not is_cro_result:
-            raise HTTPException(status_code=400, detail="Result does not appear to be from a CRO")
-        
-        # Create a copy and save to our server
-        local_result = result.copy()
-        
-        # Remove any existing ID as our server will assign a new one
-        if "id" in local_result:
-            del local_result["id"]
-        
-        # Add shared status and processing metadata
-        if "meta" not in local_result:
-            local_result["meta"] = {}
-        if "tag" not in local_result["meta"]:
-            local_result["meta"]["tag"] = []
+        response = await fhir_get(
+            f"{FHIR_SERVER_URL}/Observation/{result_id}",
+            headers={"Accept": "application/fhir+json"}
+        )
+        response.raise_for_status()
+        return passthrough_response(
+            response.content,
+            response.headers.get("content-type", "application/fhir+json"),
+            response.status_code
+        )
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
+            raise HTTPException(status_code=404, detail=f"Result with ID {result_id} not found")
+        raise HTTPException(status_code=500, detail=f"Failed to fetch result: {str(e)}")
+
+# Identifier system for results that arrive without an identifier of their own
+RESULT_CONTENT_HASH_SYSTEM = "http://example.org/fhir/identifier/result-content-hash"
+
+def external_result_identity(result: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Return the identifier that makes an external result idempotent
+
+    The result's own identifier is used when it has one with a system and
+    value; otherwise a hash of the result content, ignoring id and meta, so
+    a resent result maps to the same identifier.
+    """
+    for identifier in result.get("identifier", []):
+        if identifier.get("system") and identifier.get("value"):
+            return {"system": identifier["system"], "value": identifier["value"]}
+    content = {key: value for key, value in result.items() if key not in ("id", "meta")}
+    return {
+        "system": RESULT_CONTENT_HASH_SYSTEM,
+        "value": hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+    }
+
+def fhir_search_escape(value: str) -> str:
+    """Escape the characters that have a meaning inside a FHIR search value (\\ , | $)"""
+    for character in ("\\", ",", "|", "$"):
+        value = value.replace(character, "\\" + character)
+    return value
+
+# External results endpoint for CROs to push results
+@app.post("/results/external")
+async def receive_external_result(payload: Union[Dict[str, Any], List[Dict[str, Any]]]):
+    """
+    Receive test results from external CROs
+
+    Accepts a single Observation, an array of Observations or a Bundle of them.
+    All results are written in one transaction with conditional creates keyed
+    on the result identifier (or a content hash), so a retried delivery does
+    not duplicate results.
+    """
+    try:
+        single = isinstance(payload, dict) and payload.get("resourceType") != "Bundle"
+        if single:
+            results = [payload]
+        elif isinstance(payload, dict):
+            results = [entry.get("resource") or {} for entry in payload.get("entry", [])]
+        else:
+            results = payload
+        
+        outcomes = [None] * len(results)
+        entries = []
+        entry_indexes = []
+        seen_identities = {}
+        
+        for index, result in enumerate(results):
+            # Verify this is a valid result from a CRO
+            # Check extensions for source indicator
+            if "cro" not in ExtensionIndex(result).values("http://example.org/fhir/StructureDefinition/result-source"):
+                if single:
+                    raise HTTPException(status_code=400, detail="Result does not appear to be from a CRO")
+                outcomes[index] = {"index": index, "status": "rejected", "error": "Result does not appear to be from a CRO"}
+                continue
+            
+            identity = external_result_identity(result)
+            identity_key = (identity["system"], identity["value"])
+            # The same result twice in one delivery is written once
+            if identity_key in seen_identities:
+                outcomes[index] = {"index": index, "status": "duplicate", "duplicate_of": seen_identities[identity_key]}
+                continue
+            seen_identities[identity_key] = index
+            
+            # Create a copy and save to our server
+            local_result = copy.deepcopy(result)
+            
+            # Remove any existing ID as our server will assign a new one
+            local_result.pop("id", None)
+            
+            # Add tag to indicate this is a CRO-provided result
+            local_result.setdefault("meta", {}).setdefault("tag", []).append({
+                "system": "http://example.org/fhir/tags",
+                "code": "cro-provided-result"
+            })
+            if identity["system"] == RESULT_CONTENT_HASH_SYSTEM:
+                local_result.setdefault("identifier", []).append(identity)
+            
+            entries.append({
+                "fullUrl": f"urn:uuid:{uuid.uuid4()}",
+                "resource": local_result,
+                "request": {
+                    "method": "POST",
+                    "url": "Observation",
+                    "ifNoneExist": urlencode({
+                        "identifier": f"{fhir_search_escape(identity['system'])}|{fhir_search_escape(identity['value'])}"
+                    })
+                }
+            })
+            entry_indexes.append(index)
+        
+        # Save to our FHIR server in one transaction
+        transaction_response = await submit_fhir_transaction(entries) if entries else {"entry": []}
+        for index, response_entry in zip(entry_indexes, transaction_response.get("entry", [])):
+            response_info = response_entry.get("response", {})
+            location = response_info.get("location", "")
+            outcomes[index] = {
+                "index": index,
+                # 201 when the result was created, 200 when it had been received before
+                "status": "created" if response_info.get("status", "").startswith("201") else "existing",
+                "id": location.split("/")[1] if "/" in location else None
+            }
         
-        # Add tag to indicate this is a CRO-provided result
-        local_result["meta"]["tag"].append({
-            "system": "http://example.org/fhir/tags",
-            "code": "cro-provided-result"
-        })
+        for outcome in outcomes:
+            if outcome["status"] == "duplicate":
+                outcome["id"] = outcomes[outcome["duplicate_of"]].get("id")
         
-        # Save to our FHIR server
-        response = requests.post(
-            f"{FHIR_SERVER_URL}/Observation",
-            json=local_result,
-            headers={
-                "Content-Type": "application/fhir+json",
-                "Accept": "application/fhir+json"
+        if single:
+            return {
+                "message": "Result received and saved successfully" if outcomes[0]["status"] == "created" else "Result was already received",
+                "id": outcomes[0]["id"]
             }
-        )
-        response.raise_for_status()
         
         return {
-            "message": "Result received and saved successfully",
-            "id": response.json().get("id")
+            "message": f"Received {len(results)} results",
+            "created": sum(1 for outcome in outcomes if outcome["status"] == "created"),
+            "existing": sum(1 for outcome in outcomes if outcome["status"] in ("existing", "duplicate")),
+            "rejected": sum(1 for outcome in outcomes if outcome["status"] == "rejected"),
+            "results": outcomes
         }
     except HTTPException:
         raise
@@ -2766,7 +3797,7 @@ async def create_medicinal_product(product: MedicinalProductCreate):
                 }
             ]
         
-        response = requests.post(
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/MedicinalProductDefinition",
             json=product_data,
             headers={
@@ -2775,10 +3806,11 @@ async def create_medicinal_product(product: MedicinalProductCreate):
             }
         )
         response.raise_for_status()
+        evict_list_cache("/medicinal-products")
         
         # Return the created medicinal product
         return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -2790,24 +3822,13 @@ async def create_medicinal_product(product: MedicinalProductCreate):
         raise HTTPException(status_code=500, detail=f"Failed to create medicinal product: {error_message}")
 
 @app.get("/medicinal-products")
-async def get_medicinal_products():
+@cached_list_response("/medicinal-products")
+async def get_medicinal_products(compact: bool = False):
     """Get all medicinal products"""
     try:
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/MedicinalProductDefinition",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        response_data = response.json()
-        
-        # Ensure the response is a proper Bundle with entry array
-        if response_data.get("resourceType") == "Bundle":
-            # Forcibly add an empty entry array if it's missing
-            if "entry" not in response_data or response_data["entry"] is None:
-                response_data["entry"] = []
-        
-        return response_data
-    except requests.RequestException as e:
+        # The streamed Bundle always carries an entry array, even when empty
+        return await stream_search_bundle(iter_fhir_search("MedicinalProductDefinition"), compact)
+    except httpx.HTTPError as e:
         # Create an empty bundle with proper structure
         empty_bundle = {
             "resourceType": "Bundle",
@@ -2822,107 +3843,116 @@ async def get_medicinal_products():
         empty_bundle["link"] = [{"relation": "self", "url": f"{FHIR_SERVER_URL}/MedicinalProductDefinition"}]
         
         # Log the error but return an empty bundle
-        print(f"Error fetching medicinal products: {str(e)}")
+        logger.error("Error fetching medicinal products: %s", e)
         return empty_bundle
 
 @app.get("/medicinal-products/{product_id}")
 async def get_medicinal_product(product_id: str):
     """Get a specific medicinal product by ID"""
     try:
-        response = requests.get(
+        response = await fhir_get(
             f"{FHIR_SERVER_URL}/MedicinalProductDefinition/{product_id}",
             headers={"Accept": "application/fhir+json"}
         )
         response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+        return passthrough_response(
+            response.content,
+            response.headers.get("content-type", "application/fhir+json"),
+            response.status_code
+        )
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Medicinal product with ID {product_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch medicinal product: {str(e)}")
 
 # ObservationDefinition endpoints
-@app.post("/observation-definitions")
-async def create_observation_definition(observation_def: ObservationDefinitionCreate):
-    """Create a new test definition using FHIR ObservationDefinition resource"""
-    try:
-        # Convert to FHIR ObservationDefinition
-        obs_def_data = {
-            "resourceType": "ObservationDefinition",
-            "status": "active",
-            "code": {
+def observation_definition_resource(observation_def: ObservationDefinitionCreate) -> Dict[str, Any]:
+    """Build the FHIR ObservationDefinition for an ObservationDefinitionCreate request"""
+    obs_def_data = {
+        "resourceType": "ObservationDefinition",
+        "status": "active",
+        "code": {
+            "coding": [
+                {
+                    "system": "http://example.org/stability-tests",
+                    "code": observation_def.code,
+                    "display": observation_def.code_display or observation_def.title
+                }
+            ],
+            "text": observation_def.title
+        },
+        "permittedDataType": [observation_def.permitted_data_type],
+    }
+    
+    # Add description if provided
+    if observation_def.description:
+        obs_def_data["description"] = observation_def.description
+    
+    # Add category if provided
+    if observation_def.category:
+        obs_def_data["category"] = [
+            {
                 "coding": [
                     {
-                        "system": "http://example.org/stability-tests",
-                        "code": observation_def.code,
-                        "display": observation_def.code_display or observation_def.title
+                        "system": "http://example.org/stability-test-categories",
+                        "code": observation_def.category
                     }
-                ],
-                "text": observation_def.title
-            },
-            "permittedDataType": [observation_def.permitted_data_type],
-        }
-        
-        # Add description if provided
-        if observation_def.description:
-            obs_def_data["description"] = observation_def.description
-            
-        # Add category if provided
-        if observation_def.category:
-            obs_def_data["category"] = [
-                {
-                    "coding": [
-                        {
-                            "system": "http://example.org/stability-test-categories",
-                            "code": observation_def.category
-                        }
-                    ]
+                ]
+            }
+        ]
+    
+    # Add reference range if provided
+    if observation_def.reference_range:
+        obs_def_data["qualifiedInterval"] = [
+            {
+                "category": "reference",
+                "range": {
+                    "low": observation_def.reference_range.get("low"),
+                    "high": observation_def.reference_range.get("high")
                 }
-            ]
-        
-        # Add reference range if provided
-        if observation_def.reference_range:
-            obs_def_data["qualifiedInterval"] = [
-                {
-                    "category": "reference",
-                    "range": {
-                        "low": observation_def.reference_range.get("low"),
-                        "high": observation_def.reference_range.get("high")
+            }
+        ]
+    
+    # Add unit if provided
+    if observation_def.unit:
+        obs_def_data["quantitativeDetails"] = {
+            "unit": {
+                "coding": [
+                    {
+                        "system": "http://unitsofmeasure.org",
+                        "code": observation_def.unit
                     }
-                }
-            ]
-        
-        # Add unit if provided
-        if observation_def.unit:
-            obs_def_data["quantitativeDetails"] = {
-                "unit": {
-                    "coding": [
-                        {
-                            "system": "http://unitsofmeasure.org",
-                            "code": observation_def.unit
-                        }
-                    ],
-                    "text": observation_def.unit
-                }
+                ],
+                "text": observation_def.unit
             }
+        }
+    
+    # Add extensions for protocol and timepoint links
+    obs_def_data["extension"] = []
+    
+    if observation_def.protocol_id:
+        obs_def_data["extension"].append({
+            "url": "http://example.org/fhir/StructureDefinition/protocol-reference",
+            "valueReference": {
+                "reference": f"PlanDefinition/{observation_def.protocol_id}"
+            }
+        })
+    
+    if observation_def.timepoint_id:
+        obs_def_data["extension"].append({
+            "url": "http://example.org/fhir/StructureDefinition/timepoint-reference",
+            "valueString": observation_def.timepoint_id
+        })
+    
+    return obs_def_data
+
+@app.post("/observation-definitions")
+async def create_observation_definition(observation_def: ObservationDefinitionCreate):
+    """Create a new test definition using FHIR ObservationDefinition resource"""
+    try:
+        obs_def_data = observation_definition_resource(observation_def)
         
-        # Add extensions for protocol and timepoint links
-        obs_def_data["extension"] = []
-        
-        if observation_def.protocol_id:
-            obs_def_data["extension"].append({
-                "url": "http://example.org/fhir/StructureDefinition/protocol-reference",
-                "valueReference": {
-                    "reference": f"PlanDefinition/{observation_def.protocol_id}"
-                }
-            })
-            
-        if observation_def.timepoint_id:
-            obs_def_data["extension"].append({
-                "url": "http://example.org/fhir/StructureDefinition/timepoint-reference",
-                "valueString": observation_def.timepoint_id
-            })
-        
-        response = requests.post(
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/ObservationDefinition",
             json=obs_def_data,
             headers={
@@ -2934,7 +3964,7 @@ async def create_observation_definition(observation_def: ObservationDefinitionCr
         
         # Return the created observation definition
         return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -2946,140 +3976,116 @@ async def create_observation_definition(observation_def: ObservationDefinitionCr
         raise HTTPException(status_code=500, detail=f"Failed to create observation definition: {error_message}")
 
 @app.get("/observation-definitions")
-async def get_observation_definitions(protocol_id: Optional[str] = None):
+async def get_observation_definitions(protocol_id: Optional[str] = None, compact: bool = False):
     """Get all observation definitions, optionally filtered by protocol ID"""
     try:
-        # Get all definitions first
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/ObservationDefinition",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        all_defs = response.json()
-        
-        # If protocol_id is provided, filter by protocol reference
-        if protocol_id and all_defs and all_defs.get("resourceType") == "Bundle" and all_defs.get("entry"):
-            filtered_entries = []
-            
-            for entry in all_defs["entry"]:
-                obs_def = entry.get("resource", {})
-                
-                # Check for protocol reference in extensions
-                for ext in obs_def.get("extension", []):
-                    if ext.get("url") == "http://example.org/fhir/StructureDefinition/protocol-reference":
-                        if ext.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}":
-                            filtered_entries.append(entry)
-                            break
-            
-            # Return filtered bundle
-            filtered_bundle = {
-                "resourceType": "Bundle",
-                "type": "searchset",
-                "total": len(filtered_entries),
-                "entry": filtered_entries
-            }
-            return filtered_bundle
+        # Stream every page of definitions, keeping only the protocol's when asked
+        entries = iter_fhir_search("ObservationDefinition")
+        if protocol_id:
+            entries = filter_entries(entries, lambda obs_def: has_extension_reference(
+                obs_def, "http://example.org/fhir/StructureDefinition/protocol-reference", f"PlanDefinition/{protocol_id}"
+            ))
         
-        return all_defs
-    except requests.RequestException as e:
+        return await stream_search_bundle(entries, compact)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch observation definitions: {str(e)}")
 
 @app.get("/observation-definitions/{obs_def_id}")
 async def get_observation_definition(obs_def_id: str):
     """Get a specific observation definition by ID"""
     try:
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/ObservationDefinition/{obs_def_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+        return await read_definition("ObservationDefinition", obs_def_id)
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Observation definition with ID {obs_def_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch observation definition: {str(e)}")
 
 # SpecimenDefinition endpoints
-@app.post("/specimen-definitions")
-async def create_specimen_definition(specimen_def: SpecimenDefinitionCreate):
-    """Create a new specimen definition using FHIR SpecimenDefinition resource"""
-    try:
-        # Convert to FHIR SpecimenDefinition
-        specimen_data = {
-            "resourceType": "SpecimenDefinition",
-            "status": "active",
-            "typeCollected": {
-                "coding": [
-                    {
-                        "system": "http://example.org/specimen-types",
-                        "code": specimen_def.type_code,
-                        "display": specimen_def.type_display or specimen_def.title
-                    }
-                ],
-                "text": specimen_def.title
-            },
-            "typeTested": [
+def specimen_definition_resource(specimen_def: SpecimenDefinitionCreate) -> Dict[str, Any]:
+    """Build the FHIR SpecimenDefinition for a SpecimenDefinitionCreate request"""
+    specimen_data = {
+        "resourceType": "SpecimenDefinition",
+        "status": "active",
+        "typeCollected": {
+            "coding": [
                 {
-                    "preference": "preferred",
-                    "container": {
-                        "material": {
-                            "text": specimen_def.container_material or specimen_def.container_type or "Not specified"
-                        }
+                    "system": "http://example.org/specimen-types",
+                    "code": specimen_def.type_code,
+                    "display": specimen_def.type_display or specimen_def.title
+                }
+            ],
+            "text": specimen_def.title
+        },
+        "typeTested": [
+            {
+                "preference": "preferred",
+                "container": {
+                    "material": {
+                        "text": specimen_def.container_material or specimen_def.container_type or "Not specified"
                     }
                 }
-            ]
-        }
-        
-        # Add description if provided
-        if specimen_def.description:
-            specimen_data["description"] = specimen_def.description
-            
-        # Add container type if provided
-        if specimen_def.container_type:
-            specimen_data["typeTested"][0]["container"]["type"] = {
-                "text": specimen_def.container_type
             }
-        
-        # Add minimum volume if provided
-        if specimen_def.minimum_volume and specimen_def.minimum_volume_unit:
-            specimen_data["typeTested"][0]["container"]["minimumVolumeQuantity"] = {
-                "value": specimen_def.minimum_volume,
-                "unit": specimen_def.minimum_volume_unit
+        ]
+    }
+    
+    # Add description if provided
+    if specimen_def.description:
+        specimen_data["description"] = specimen_def.description
+    
+    # Add container type if provided
+    if specimen_def.container_type:
+        specimen_data["typeTested"][0]["container"]["type"] = {
+            "text": specimen_def.container_type
+        }
+    
+    # Add minimum volume if provided
+    if specimen_def.minimum_volume and specimen_def.minimum_volume_unit:
+        specimen_data["typeTested"][0]["container"]["minimumVolumeQuantity"] = {
+            "value": specimen_def.minimum_volume,
+            "unit": specimen_def.minimum_volume_unit
+        }
+    
+    # Add temperature handling information if provided
+    if specimen_def.temperature_qualifier or specimen_def.temperature:
+        handling = {}
+    
+        if specimen_def.temperature_qualifier:
+            handling["temperatureQualifier"] = {
+                "text": specimen_def.temperature_qualifier
             }
-        
-        # Add temperature handling information if provided
-        if specimen_def.temperature_qualifier or specimen_def.temperature:
-            handling = {}
-            
-            if specimen_def.temperature_qualifier:
-                handling["temperatureQualifier"] = {
-                    "text": specimen_def.temperature_qualifier
-                }
-            
-            if specimen_def.temperature:
-                handling["temperatureRange"] = {
-                    "low": {
-                        "value": specimen_def.temperature,
-                        "unit": specimen_def.temperature_unit or "C"
-                    },
-                    "high": {
-                        "value": specimen_def.temperature,
-                        "unit": specimen_def.temperature_unit or "C"
-                    }
-                }
-            
-            specimen_data["typeTested"][0]["handling"] = [handling]
-        
-        # Add protocol reference as extension if provided
-        if specimen_def.protocol_id:
-            specimen_data["extension"] = [{
-                "url": "http://example.org/fhir/StructureDefinition/protocol-reference",
-                "valueReference": {
-                    "reference": f"PlanDefinition/{specimen_def.protocol_id}"
+    
+        if specimen_def.temperature:
+            handling["temperatureRange"] = {
+                "low": {
+                    "value": specimen_def.temperature,
+                    "unit": specimen_def.temperature_unit or "C"
+                },
+                "high": {
+                    "value": specimen_def.temperature,
+                    "unit": specimen_def.temperature_unit or "C"
                 }
-            }]
+            }
+    
+        specimen_data["typeTested"][0]["handling"] = [handling]
+    
+    # Add protocol reference as extension if provided
+    if specimen_def.protocol_id:
+        specimen_data["extension"] = [{
+            "url": "http://example.org/fhir/StructureDefinition/protocol-reference",
+            "valueReference": {
+                "reference": f"PlanDefinition/{specimen_def.protocol_id}"
+            }
+        }]
+    
+    return specimen_data
+
+@app.post("/specimen-definitions")
+async def create_specimen_definition(specimen_def: SpecimenDefinitionCreate):
+    """Create a new specimen definition using FHIR SpecimenDefinition resource"""
+    try:
+        specimen_data = specimen_definition_resource(specimen_def)
         
-        response = requests.post(
+        response = await fhir_client.post(
             f"{FHIR_SERVER_URL}/SpecimenDefinition",
             json=specimen_data,
             headers={
@@ -3091,7 +4097,7 @@ async def create_specimen_definition(specimen_def: SpecimenDefinitionCreate):
         
         # Return the created specimen definition
         return response.json()
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         error_message = str(e)
         if hasattr(e, 'response') and e.response:
             try:
@@ -3103,56 +4109,27 @@ async def create_specimen_definition(specimen_def: SpecimenDefinitionCreate):
         raise HTTPException(status_code=500, detail=f"Failed to create specimen definition: {error_message}")
 
 @app.get("/specimen-definitions")
-async def get_specimen_definitions(protocol_id: Optional[str] = None):
+async def get_specimen_definitions(protocol_id: Optional[str] = None, compact: bool = False):
     """Get all specimen definitions, optionally filtered by protocol ID"""
     try:
-        # Get all definitions
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/SpecimenDefinition",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        all_defs = response.json()
-        
-        # If protocol_id is provided, filter by protocol reference
-        if protocol_id and all_defs and all_defs.get("resourceType") == "Bundle" and all_defs.get("entry"):
-            filtered_entries = []
-            
-            for entry in all_defs["entry"]:
-                specimen_def = entry.get("resource", {})
-                
-                # Check for protocol reference in extensions
-                for ext in specimen_def.get("extension", []):
-                    if ext.get("url") == "http://example.org/fhir/StructureDefinition/protocol-reference":
-                        if ext.get("valueReference", {}).get("reference") == f"PlanDefinition/{protocol_id}":
-                            filtered_entries.append(entry)
-                            break
-            
-            # Return filtered bundle
-            filtered_bundle = {
-                "resourceType": "Bundle",
-                "type": "searchset",
-                "total": len(filtered_entries),
-                "entry": filtered_entries
-            }
-            return filtered_bundle
+        # Stream every page of definitions, keeping only the protocol's when asked
+        entries = iter_fhir_search("SpecimenDefinition")
+        if protocol_id:
+            entries = filter_entries(entries, lambda specimen_def: has_extension_reference(
+                specimen_def, "http://example.org/fhir/StructureDefinition/protocol-reference", f"PlanDefinition/{protocol_id}"
+            ))
         
-        return all_defs
-    except requests.RequestException as e:
+        return await stream_search_bundle(entries, compact)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch specimen definitions: {str(e)}")
 
 @app.get("/specimen-definitions/{specimen_def_id}")
 async def get_specimen_definition(specimen_def_id: str):
     """Get a specific specimen definition by ID"""
     try:
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/SpecimenDefinition/{specimen_def_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        if e.response and e.response.status_code == 404:
+        return await read_definition("SpecimenDefinition", specimen_def_id)
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
             raise HTTPException(status_code=404, detail=f"Specimen definition with ID {specimen_def_id} not found")
         raise HTTPException(status_code=500, detail=f"Failed to fetch specimen definition: {str(e)}")
 
@@ -3160,23 +4137,13 @@ async def get_observation_definitions_for_test(test_id: str):
     """Get all ObservationDefinitions linked to a specific test (ActivityDefinition)"""
     try:
         # First get the ActivityDefinition
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/ActivityDefinition/{test_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        test = response.json()
+        test = await read_definition("ActivityDefinition", test_id)
         
         # Look for our custom extension with ObservationDefinition references
         observation_refs = []
-        for extension in test.get("extension", []):
-            if extension.get("url") == "http://example.org/fhir/StructureDefinition/observation-definitions":
-                # Extract references from nested extensions
-                for nested_ext in extension.get("extension", []):
-                    if nested_ext.get("url") == "reference" and nested_ext.get("valueReference"):
-                        ref = nested_ext.get("valueReference").get("reference")
-                        if ref and ref.startswith("ObservationDefinition/"):
-                            observation_refs.append(ref.split("/")[1])
+        for ref in ExtensionIndex(test).nested_values("http://example.org/fhir/StructureDefinition/observation-definitions"):
+            if isinstance(ref, str) and ref.startswith("ObservationDefinition/"):
+                observation_refs.append(ref.split("/")[1])
         
         if not observation_refs:
             return []
@@ -3185,51 +4152,33 @@ async def get_observation_definitions_for_test(test_id: str):
         results = []
         for obs_id in observation_refs:
             try:
-                obs_response = requests.get(
-                    f"{FHIR_SERVER_URL}/ObservationDefinition/{obs_id}",
-                    headers={"Accept": "application/fhir+json"}
-                )
-                obs_response.raise_for_status()
-                results.append(obs_response.json())
+                results.append(await read_definition("ObservationDefinition", obs_id))
             except Exception as e:
-                print(f"Error fetching ObservationDefinition {obs_id}: {str(e)}")
+                logger.error("Error fetching ObservationDefinition %s: %s", obs_id, e)
                 
         return results
     except Exception as e:
-        print(f"Error getting ObservationDefinitions for test {test_id}: {str(e)}")
+        logger.error("Error getting ObservationDefinitions for test %s: %s", test_id, e)
         return []
 
 async def get_specimen_definition_for_test(test_id: str):
     """Get the SpecimenDefinition linked to a specific test (ActivityDefinition)"""
     try:
         # First get the ActivityDefinition
-        response = requests.get(
-            f"{FHIR_SERVER_URL}/ActivityDefinition/{test_id}",
-            headers={"Accept": "application/fhir+json"}
-        )
-        response.raise_for_status()
-        test = response.json()
+        test = await read_definition("ActivityDefinition", test_id)
         
         # Look for our custom extension with SpecimenDefinition reference
-        for extension in test.get("extension", []):
-            if extension.get("url") == "http://example.org/fhir/StructureDefinition/specimen-definition":
-                if extension.get("valueReference"):
-                    ref = extension.get("valueReference").get("reference")
-                    if ref and ref.startswith("SpecimenDefinition/"):
-                        specimen_id = ref.split("/")[1]
-                        try:
-                            specimen_response = requests.get(
-                                f"{FHIR_SERVER_URL}/SpecimenDefinition/{specimen_id}",
-                                headers={"Accept": "application/fhir+json"}
-                            )
-                            specimen_response.raise_for_status()
-                            return specimen_response.json()
-                        except Exception as e:
-                            print(f"Error fetching SpecimenDefinition {specimen_id}: {str(e)}")
+        ref = ExtensionIndex(test).value("http://example.org/fhir/StructureDefinition/specimen-definition")
+        if isinstance(ref, str) and ref.startswith("SpecimenDefinition/"):
+            specimen_id = ref.split("/")[1]
+            try:
+                return await read_definition("SpecimenDefinition", specimen_id)
+            except Exception as e:
+                logger.error("Error fetching SpecimenDefinition %s: %s", specimen_id, e)
         
         return None
     except Exception as e:
-        print(f"Error getting SpecimenDefinition for test {test_id}: {str(e)}")
+        logger.error("Error getting SpecimenDefinition for test %s: %s", test_id, e)
         return None
 
 @app.get("/tests/{test_id}/observation-definitions")
@@ -3254,6 +4203,493 @@ async def get_test_specimen_definition(test_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get specimen definition: {str(e)}")
 
+# Stability Analytics
+
+DAYS_PER_MONTH = 365.25 / 12
+
+# Months per unit of a timepoint or Duration, by UCUM code or spelled out
+DURATION_UNIT_MONTHS = {
+    "": 1.0, "m": 1.0, "mo": 1.0, "month": 1.0, "months": 1.0,
+    "a": 12.0, "y": 12.0, "yr": 12.0, "year": 12.0, "years": 12.0,
+    "w": 7 / DAYS_PER_MONTH, "wk": 7 / DAYS_PER_MONTH, "week": 7 / DAYS_PER_MONTH, "weeks": 7 / DAYS_PER_MONTH,
+    "d": 1 / DAYS_PER_MONTH, "day": 1 / DAYS_PER_MONTH, "days": 1 / DAYS_PER_MONTH,
+}
+
+NUMBER_PATTERN = r"[-+]?\d+(?:\.\d+)?"
+# A unit or % may follow either number, as in "95.0% - 105.0%" or "2 mg to 8 mg"
+RANGE_PATTERN = re.compile(rf"({NUMBER_PATTERN})\s*(?:%|[a-zµ/]+)?\s*(?:-|–|to)\s*({NUMBER_PATTERN})", re.IGNORECASE)
+TIMEPOINT_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*-?\s*([a-z]*)", re.IGNORECASE)
+LOWER_LIMIT_WORDS = ("min", "lower", "nlt", "not less", "at least", ">=", "≥", ">")
+UPPER_LIMIT_WORDS = ("max", "upper", "nmt", "not more", "at most", "<=", "≤", "<", "limit")
+# Words of criteria keys that name a bound rather than the attribute being measured
+BOUND_KEY_WORDS = {
+    "min", "max", "minimum", "maximum", "lower", "upper", "limit", "limits", "value",
+    "nlt", "nmt", "range", "spec", "specification", "acceptance", "criteria", "criterion",
+}
+
+# Upper Student t quantiles for 1-10 degrees of freedom; with more, the Cornish-Fisher
+# expansion below is accurate to 1e-4
+T_QUANTILES = {
+    0.95: np.array([6.313752, 2.919986, 2.353363, 2.131847, 2.015048, 1.943180, 1.894579, 1.859548, 1.833113, 1.812461]),
+    0.975: np.array([12.706205, 4.302653, 3.182446, 2.776445, 2.570582, 2.446912, 2.364624, 2.306004, 2.262157, 2.228139]),
+}
+NORMAL_QUANTILES = {0.95: 1.6448536269514722, 0.975: 1.959963984540054}
+
+def duration_months(value: Any, unit: Optional[str]) -> Optional[float]:
+    """Convert a duration to months, or None if the unit is not a unit of time"""
+    factor = DURATION_UNIT_MONTHS.get((unit or "").strip().rstrip(".").lower())
+    if factor is None or value is None:
+        return None
+    try:
+        return float(value) * factor
+    except (TypeError, ValueError):
+        return None
+
+def timepoint_months(label: Optional[str]) -> Optional[float]:
+    """Read a timepoint label such as "3-months", "6 M" or "T0" as months"""
+    if not label:
+        return None
+    match = TIMEPOINT_PATTERN.search(label)
+    return duration_months(match.group(1), match.group(2)) if match else None
+
+def protocol_timepoints(protocol: Dict[str, Any]) -> Dict[str, float]:
+    """Map the ID and title of every timed PlanDefinition action to its time in months"""
+    timepoints = {}
+    pending = list(protocol.get("action", []))
+    while pending:
+        action = pending.pop()
+        pending.extend(action.get("action", []))
+        bounds = action.get("timingTiming", {}).get("repeat", {}).get("boundsDuration")
+        months = duration_months(bounds.get("value"), bounds.get("unit") or bounds.get("code")) if bounds else None
+        if months is None:
+            continue
+        for key in (action.get("id"), action.get("title")):
+            if key:
+                timepoints[key] = months
+    return timepoints
+
+def acceptance_limits(criteria: Any) -> Optional[tuple]:
+    """
+    Read the numeric (lower, upper) limits of free-form acceptance criteria, None where absent
+
+    Understands ranges such as "95.0-105.0%", keys naming the bound (min, max,
+    lower_limit, NMT, ...) and values such as "NLT 95" or "≤ 0.5%". Limits from
+    several keys are only combined when the keys just name the bound, as in
+    min_value/max_value. Keys such as "Impurity A" and "Total" describe
+    different measurements, so such criteria are ambiguous and None is returned.
+    """
+    bounded = {}
+    items = criteria.items() if isinstance(criteria, dict) else []
+    for key, value in items:
+        if isinstance(value, dict):
+            bounds = acceptance_limits(value)
+            if bounds is None:
+                return None
+        else:
+            text = str(value)
+            label = f"{key} {text}".lower()
+            match = RANGE_PATTERN.search(text)
+            number = re.search(NUMBER_PATTERN, text)
+            if match and float(match.group(1)) < float(match.group(2)):
+                bounds = (float(match.group(1)), float(match.group(2)))
+            elif number and any(word in label for word in LOWER_LIMIT_WORDS):
+                bounds = (float(number.group()), None)
+            elif number and any(word in label for word in UPPER_LIMIT_WORDS):
+                bounds = (None, float(number.group()))
+            else:
+                bounds = (None, None)
+        if bounds != (None, None):
+            bounded[key] = bounds
+    
+    if len(bounded) > 1 and not all(set(re.findall(r"[a-z]+", str(key).lower())) <= BOUND_KEY_WORDS for key in bounded):
+        return None
+    
+    lower = upper = None
+    for low, high in bounded.values():
+        if low is not None:
+            lower = low if lower is None else max(lower, low)
+        if high is not None:
+            upper = high if upper is None else min(upper, high)
+    return lower, upper
+
+def numeric_result(observation: Dict[str, Any]) -> Optional[float]:
+    """Return the numeric value of an Observation, or None for text and missing values"""
+    if "valueQuantity" in observation:
+        value = observation["valueQuantity"].get("value")
+    else:
+        value = observation.get("valueString")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if np.isfinite(value) else None
+
+def fhir_date(value: Optional[str]) -> Optional[datetime]:
+    """Parse the date part of a FHIR date or dateTime, or None if there is none"""
+    try:
+        return datetime.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return None
+
+def t_quantile(probability: float, df: np.ndarray) -> np.ndarray:
+    """Upper Student t quantiles for an array of degrees of freedom"""
+    z = NORMAL_QUANTILES[probability]
+    z2 = z * z
+    v = np.maximum(df, 1).astype(float)
+    expansion = (
+        z
+        + (z2 + 1) * z / (4 * v)
+        + ((5 * z2 + 16) * z2 + 3) * z / (96 * v ** 2)
+        + (((3 * z2 + 19) * z2 + 17) * z2 - 15) * z / (384 * v ** 3)
+        + ((((79 * z2 + 776) * z2 + 1482) * z2 - 1920) * z2 - 945) * z / (92160 * v ** 4)
+    )
+    table = T_QUANTILES[probability]
+    return np.where(v <= len(table), table[np.minimum(v, len(table)).astype(int) - 1], expansion)
+
+def months_within_upper_limit(intercept, slope, mean_months, sxx, n, k, limit) -> np.ndarray:
+    """
+    Last time, per series, at which the upper confidence bound of the mean stays within limit
+
+    The bound intercept + slope*t + sqrt(k*(1/n + (t - mean_months)**2/sxx)) is
+    convex in t, so it is within the limit on a single interval and the answer
+    is the larger root of the squared equation that is a root of the bound
+    itself. 0 when the bound already exceeds the limit at t=0, inf when it
+    never reaches it. Lower limits are handled by negating the line and limit.
+    """
+    margin = limit - intercept
+    w = k / sxx
+    a = slope * slope - w
+    b = 2 * (w * mean_months - slope * margin)
+    c = margin * margin - k / n - w * mean_months * mean_months
+    root = np.sqrt(np.maximum(b * b - 4 * a * c, 0))
+    linear = np.abs(a) <= 1e-12 * (slope * slope + w)
+    candidates = np.stack([
+        np.where(linear, -c / b, (-b - root) / (2 * a)),
+        np.where(linear, -c / b, (-b + root) / (2 * a)),
+    ])
+    # Roots of the squared equation where the line is above the limit belong to the lower bound
+    valid = margin - slope * candidates >= -1e-9 * (1 + np.abs(margin) + np.abs(slope * candidates))
+    crossing = np.max(np.where(valid & np.isfinite(candidates), candidates, -np.inf), axis=0)
+    at_release = intercept + np.sqrt(k * (1 / n + mean_months * mean_months / sxx))
+    return np.where(
+        at_release > limit, 0.0,
+        np.where(slope + np.sqrt(w) <= 0, np.inf, np.maximum(crossing, 0.0))
+    )
+
+def fit_shelf_life(series: np.ndarray, months: np.ndarray, values: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Fit a least-squares line to every series at once and estimate its shelf life as in ICH Q1E
+
+    series is the series index of each measurement; lower and upper hold one
+    limit per series, NaN where there is none. The shelf life is where the
+    one-sided 95% confidence bound of the mean (two-sided with both limits)
+    meets a limit, and is not extrapolated beyond twice the observed period or
+    12 months past it. Sums are taken with bincount, so there is no Python loop
+    per series.
+    """
+    count = len(lower)
+    n = np.bincount(series, minlength=count).astype(float)
+    observed = np.zeros(count)
+    np.maximum.at(observed, series, months)
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        mean_months = np.bincount(series, months, count) / n
+        mean_value = np.bincount(series, values, count) / n
+        deviation = months - mean_months[series]
+        sxx = np.bincount(series, deviation * deviation, count)
+        slope = np.bincount(series, deviation * (values - mean_value[series]), count) / sxx
+        intercept = mean_value - slope * mean_months
+        residuals = values - intercept[series] - slope[series] * months
+        df = n - 2
+        residual_sd = np.sqrt(np.bincount(series, residuals * residuals, count) / df)
+        
+        has_lower = ~np.isnan(lower)
+        has_upper = ~np.isnan(upper)
+        quantile = np.where(has_lower & has_upper, t_quantile(0.975, df), t_quantile(0.95, df))
+        k = (quantile * residual_sd) ** 2
+        within_upper = np.where(has_upper, months_within_upper_limit(intercept, slope, mean_months, sxx, n, k, upper), np.inf)
+        within_lower = np.where(has_lower, months_within_upper_limit(-intercept, -slope, mean_months, sxx, n, k, -lower), np.inf)
+        within_limits = np.minimum(within_upper, within_lower)
+        horizon = np.minimum(2 * observed, observed + 12)
+    
+    return {
+        "points": n,
+        "fitted": (df >= 1) & (sxx > 0),
+        "slope": slope,
+        "intercept": intercept,
+        "residual_sd": residual_sd,
+        "shelf_life": np.minimum(within_limits, horizon),
+        "limited_by_extrapolation": within_limits > horizon,
+    }
+
+def finite_or_none(value: float, digits: int) -> Optional[float]:
+    """Round a NumPy result for JSON, mapping NaN and infinity to None"""
+    return round(value, digits) if np.isfinite(value) else None
+
+@app.get("/protocols/{protocol_id}/shelf-life")
+async def get_protocol_shelf_life(protocol_id: str):
+    """
+    Estimate shelf life from the protocol's stability results, following ICH Q1E
+
+    Results are those linked to one of the protocol's tests, through the
+    test-definition extension of our own results or, for results forwarded by
+    a CRO, through a code naming the test's ActivityDefinition. CRO results
+    that name their test only in free text cannot be tied to the protocol and
+    are not seen; results that are withdrawn, not numeric, or have no batch or
+    time are counted in "excluded". A CRO reports against its Device copy of a
+    batch, so its results form their own series.
+    
+    Numeric results are grouped into one series per batch, test and storage
+    condition and each series gets its own regression line. Tests are matched
+    by title, so a test defined once per timepoint still forms one series.
+    Time comes from the result's protocol timepoint, the test's timepoint or the
+    batch manufacturing date, and otherwise counts from the first result of the
+    series. Batches are not pooled: a test and condition gets the shelf life of
+    its shortest-lived batch, and each storage condition that of its most
+    limiting test.
+    """
+    protocol_reference = f"PlanDefinition/{protocol_id}"
+    try:
+        protocol = await read_definition("PlanDefinition", protocol_id)
+        
+        tests = {}
+        async for entry in iter_extension_search("ActivityDefinition", {"stability-test-protocol": protocol_reference}):
+            test = entry.get("resource", {})
+            if test.get("id"):
+                tests[test["id"]] = test
+        
+        batches = {}
+        async for entry in iter_extension_search("Medication", {"batch-protocol": protocol_reference}):
+            batch = entry.get("resource", {})
+            if batch.get("id"):
+                batches[batch["id"]] = batch
+        
+        # One paged search per test, so only a few run at once to leave the pool to other requests
+        semaphore = asyncio.Semaphore(SEARCH_MAX_CONCURRENCY)
+        
+        async def test_results(test_id: str) -> List[Dict[str, Any]]:
+            async with semaphore:
+                return [
+                    entry.get("resource", {})
+                    async for entry in iter_extension_search("Observation", {"test-definition": f"ActivityDefinition/{test_id}"})
+                ]
+        
+        # Results forwarded by a CRO have no test-definition extension; they carry the
+        # test's ActivityDefinition ID as their code instead
+        async def cro_results(test_ids: List[str]) -> List[Dict[str, Any]]:
+            codes = ",".join(f"http://example.org/fhir/stability-tests|{test_id}" for test_id in test_ids)
+            async with semaphore:
+                return [entry.get("resource", {}) async for entry in iter_fhir_search("Observation", {"code": codes})]
+        
+        test_ids = list(tests)
+        chunks = [test_ids[start:start + FHIR_PAGE_SIZE] for start in range(0, len(test_ids), FHIR_PAGE_SIZE)]
+        fetched = await asyncio.gather(
+            *(test_results(test_id) for test_id in test_ids),
+            *(cro_results(chunk) for chunk in chunks)
+        )
+    except httpx.HTTPError as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 404:
+            raise HTTPException(status_code=404, detail=f"Protocol with ID {protocol_id} not found")
+        raise HTTPException(status_code=500, detail=f"Failed to load stability results: {str(e)}")
+    
+    timepoints = protocol_timepoints(protocol)
+    
+    def timepoint(label: Optional[str]) -> Optional[float]:
+        return timepoints[label] if label in timepoints else timepoint_months(label)
+    
+    manufactured = {
+        f"Medication/{batch_id}": fhir_date(ExtensionIndex(batch.get("batch")).value("http://example.org/fhir/StructureDefinition/manufacturing-date"))
+        for batch_id, batch in batches.items()
+    }
+    
+    # Per test: attribute name, acceptance limits, default condition and timepoint
+    test_settings = {}
+    for test_id, test in tests.items():
+        extensions = ExtensionIndex(test)
+        try:
+            criteria = json.loads(extensions.value("http://example.org/fhir/StructureDefinition/stability-test-acceptance-criteria", "{}"))
+        except ValueError:
+            criteria = {}
+        try:
+            parameters = json.loads(extensions.value("http://example.org/fhir/StructureDefinition/stability-test-parameters", "{}"))
+        except ValueError:
+            parameters = {}
+        if not isinstance(parameters, dict):
+            parameters = {}
+        condition = next((parameters[key] for key in ("storage_condition", "storage-condition", "condition") if parameters.get(key)), None)
+        test_settings[test_id] = (
+            test.get("title") or test_id,
+            acceptance_limits(criteria),
+            str(condition) if condition is not None else None,
+            timepoint(extensions.value("http://example.org/fhir/StructureDefinition/stability-test-timepoint"))
+        )
+    
+    # Pair every result with its test, each result once
+    results = []
+    seen = set()
+    for test_id, observations in zip(test_ids, fetched):
+        for observation in observations:
+            seen.add(observation.get("id"))
+            results.append((test_id, observation))
+    for observations in fetched[len(test_ids):]:
+        for observation in observations:
+            test_id = next((
+                coding.get("code") for coding in observation.get("code", {}).get("coding", [])
+                if coding.get("system") == "http://example.org/fhir/stability-tests" and coding.get("code") in tests
+            ), None)
+            if test_id and observation.get("id") not in seen:
+                seen.add(observation.get("id"))
+                results.append((test_id, observation))
+    
+    # Collect every numeric result as (series key, months or None, date, value), counting
+    # the results that cannot be used
+    excluded = {"withdrawn": 0, "not_numeric": 0, "no_batch": 0, "no_time": 0}
+    series_keys = {}
+    series_tests = {}
+    measurements = []
+    for test_id, observation in results:
+        test_name, limits, test_condition, test_months = test_settings[test_id]
+        if observation.get("status") in ("entered-in-error", "cancelled"):
+            excluded["withdrawn"] += 1
+            continue
+        value = numeric_result(observation)
+        if value is None:
+            excluded["not_numeric"] += 1
+            continue
+        # Sponsor batches are Medications; a CRO refers to its copy of the batch as a Device
+        batch_reference = observation.get("subject", {}).get("reference", "")
+        if not batch_reference.startswith(("Medication/", "Device/")):
+            excluded["no_batch"] += 1
+            continue
+        extensions = ExtensionIndex(observation)
+        condition = extensions.value("http://example.org/fhir/StructureDefinition/storage-condition", test_condition)
+        
+        months = timepoints.get(extensions.value("http://example.org/fhir/StructureDefinition/protocol-timepoint"))
+        if months is None:
+            months = timepoint(extensions.value("http://example.org/fhir/StructureDefinition/protocol-timepoint-title"))
+        if months is None:
+            months = test_months
+        measured = fhir_date(observation.get("effectiveDateTime"))
+        if months is None and measured and manufactured.get(batch_reference):
+            months = (measured - manufactured[batch_reference]).days / DAYS_PER_MONTH
+        
+        key = (batch_reference, test_name, condition)
+        index = series_keys.setdefault(key, len(series_keys))
+        series_tests.setdefault(index, {"test_ids": set(), "limits": []})
+        if test_id not in series_tests[index]["test_ids"]:
+            series_tests[index]["test_ids"].add(test_id)
+            series_tests[index]["limits"].append(limits)
+        measurements.append((index, months, measured, value))
+    
+    # Series without a timepoint for every result count from their first measurement instead
+    untimed = {index for index, months, _, _ in measurements if months is None}
+    first_measured = {}
+    for index, _, measured, _ in measurements:
+        if index in untimed and measured and (index not in first_measured or measured < first_measured[index]):
+            first_measured[index] = measured
+    
+    series_index, months_list, value_list = [], [], []
+    for index, months, measured, value in measurements:
+        if index in untimed:
+            if not measured:
+                excluded["no_time"] += 1
+                continue
+            months = (measured - first_measured[index]).days / DAYS_PER_MONTH
+        series_index.append(index)
+        months_list.append(months)
+        value_list.append(value)
+    
+    count = len(series_keys)
+    lower = np.full(count, np.nan)
+    upper = np.full(count, np.nan)
+    ambiguous = set()
+    for index, info in series_tests.items():
+        if any(limits is None for limits in info["limits"]):
+            ambiguous.add(index)
+            continue
+        lowers = [low for low, _ in info["limits"] if low is not None]
+        uppers = [high for _, high in info["limits"] if high is not None]
+        if lowers:
+            lower[index] = max(lowers)
+        if uppers:
+            upper[index] = min(uppers)
+    
+    fit = fit_shelf_life(
+        np.array(series_index, dtype=np.intp),
+        np.array(months_list, dtype=float),
+        np.array(value_list, dtype=float),
+        lower,
+        upper
+    )
+    columns = {name: values.tolist() for name, values in fit.items()}
+    lower_limits = lower.tolist()
+    upper_limits = upper.tolist()
+    
+    series = []
+    summaries = {}
+    for (batch_reference, test_name, condition), index in series_keys.items():
+        batch_id = batch_reference.split("/", 1)[1]
+        if not columns["fitted"][index]:
+            status = "insufficient_data"
+        elif index in ambiguous:
+            status = "ambiguous_criteria"
+        elif np.isnan(lower_limits[index]) and np.isnan(upper_limits[index]):
+            status = "no_acceptance_criteria"
+        else:
+            status = "estimated"
+        shelf_life = finite_or_none(columns["shelf_life"][index], 2) if status == "estimated" else None
+        batch = batches.get(batch_id, {}) if batch_reference.startswith("Medication/") else {}
+        series.append({
+            "batch_id": batch_id,
+            "batch_reference": batch_reference,
+            "batch_name": batch.get("code", {}).get("text"),
+            "test": test_name,
+            "test_ids": sorted(series_tests[index]["test_ids"]),
+            "condition": condition,
+            "points": int(columns["points"][index]),
+            "slope": finite_or_none(columns["slope"][index], 6) if columns["fitted"][index] else None,
+            "intercept": finite_or_none(columns["intercept"][index], 6) if columns["fitted"][index] else None,
+            "residual_sd": finite_or_none(columns["residual_sd"][index], 6) if columns["fitted"][index] else None,
+            "lower_limit": finite_or_none(lower_limits[index], 6),
+            "upper_limit": finite_or_none(upper_limits[index], 6),
+            "shelf_life_months": shelf_life,
+            "limited_by": ("extrapolation" if columns["limited_by_extrapolation"][index] else "acceptance_criteria") if shelf_life is not None else None,
+            "status": status
+        })
+        
+        summary = summaries.setdefault((test_name, condition), {
+            "test": test_name,
+            "condition": condition,
+            "batches": 0,
+            "shelf_life_months": None,
+            "limiting_batch_id": None
+        })
+        summary["batches"] += 1
+        if shelf_life is not None and (summary["shelf_life_months"] is None or shelf_life < summary["shelf_life_months"]):
+            summary["shelf_life_months"] = shelf_life
+            summary["limiting_batch_id"] = batch_id
+    
+    # Long-term and accelerated conditions are reported apart, never merged into one figure
+    conditions = {}
+    for summary in summaries.values():
+        overall = conditions.setdefault(summary["condition"], {
+            "condition": summary["condition"],
+            "shelf_life_months": None,
+            "limiting_test": None
+        })
+        estimate = summary["shelf_life_months"]
+        if estimate is not None and (overall["shelf_life_months"] is None or estimate < overall["shelf_life_months"]):
+            overall["shelf_life_months"] = estimate
+            overall["limiting_test"] = summary["test"]
+    
+    return {
+        "protocol_id": protocol_id,
+        "protocol_title": protocol.get("title"),
+        "conditions": list(conditions.values()),
+        "tests": list(summaries.values()),
+        "series": series,
+        "excluded": excluded
+    }
+
 # Run with: uvicorn main:app --reload
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,236 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+import main
+from main import acceptance_limits, months_within_upper_limit, t_quantile
+
+
+@pytest.mark.parametrize("text", [
+    "95.0-105.0",
+    "95.0%-105.0%",
+    "95.0% - 105.0%",
+    "95.0 – 105.0 %",
+    "95 to 105",
+])
+def test_acceptance_limits_reads_ranges_with_units(text):
+    assert acceptance_limits({"assay": text}) == (95.0, 105.0)
+
+
+def test_acceptance_limits_reads_ranges_with_words_as_units():
+    assert acceptance_limits({"content": "2 mg/mL - 8 mg/mL"}) == (2.0, 8.0)
+
+
+def test_acceptance_limits_reads_single_bounds():
+    assert acceptance_limits({"Impurity": "NMT 0.5%"}) == (None, 0.5)
+    assert acceptance_limits({"Assay": "NLT 95.0%"}) == (95.0, None)
+    assert acceptance_limits({"min_value": "95", "max_value": 105}) == (95.0, 105.0)
+
+
+def test_acceptance_limits_combines_keys_naming_bounds():
+    assert acceptance_limits({"lower_limit": "2", "upper_limit": "8"}) == (2.0, 8.0)
+    assert acceptance_limits({"Assay": "95.0-105.0%", "Appearance": "Clear"}) == (95.0, 105.0)
+    assert acceptance_limits({"pH": {"min": 6.5, "max": 7.5}}) == (6.5, 7.5)
+
+
+def test_acceptance_limits_rejects_limits_for_several_attributes():
+    assert acceptance_limits({"Impurity A": "NMT 0.5%", "Total": "NMT 2.0%"}) is None
+    assert acceptance_limits({"Assay": "95-105", "Water": "NMT 3.0%"}) is None
+    assert acceptance_limits({"Related substances": {"Impurity A": "NMT 0.5%", "Total": "NMT 2.0%"}}) is None
+
+
+def test_acceptance_limits_ignores_text_criteria():
+    assert acceptance_limits({"Appearance": "Clear, colorless solution"}) == (None, None)
+
+
+def test_t_quantile_matches_student_t():
+    df = np.array([1, 3, 10, 11, 20, 60])
+    np.testing.assert_allclose(t_quantile(0.95, df), [6.3138, 2.3534, 1.8125, 1.7959, 1.7247, 1.6706], atol=2e-4)
+    np.testing.assert_allclose(t_quantile(0.975, df), [12.7062, 3.1824, 2.2281, 2.2010, 2.0860, 2.0003], atol=2e-4)
+
+
+def upper_bound_crossing(months, values, quantile, limit):
+    """Find the crossing of a single series on a fine grid, for comparison"""
+    n = len(months)
+    slope, intercept = np.polyfit(months, values, 1)
+    residual_sd = np.sqrt(np.sum((values - intercept - slope * months) ** 2) / (n - 2))
+    grid = np.arange(0, 120, 0.001)
+    bound = intercept + slope * grid + quantile * residual_sd * np.sqrt(
+        1 / n + (grid - months.mean()) ** 2 / np.sum((months - months.mean()) ** 2)
+    )
+    return grid[np.argmax(bound > limit)] if (bound > limit).any() else np.inf
+
+
+def test_months_within_upper_limit_matches_grid_search():
+    months = np.array([0, 3, 6, 9, 12, 18.0])
+    values = np.array([0.10, 0.14, 0.21, 0.24, 0.31, 0.45])
+    slope, intercept = np.polyfit(months, values, 1)
+    n = len(months)
+    sxx = np.sum((months - months.mean()) ** 2)
+    residual_sd = np.sqrt(np.sum((values - intercept - slope * months) ** 2) / (n - 2))
+    quantile = t_quantile(0.95, np.array([n - 2]))[0]
+    crossing = months_within_upper_limit(
+        np.array([intercept]), np.array([slope]), np.array([months.mean()]), np.array([sxx]),
+        np.array([float(n)]), np.array([(quantile * residual_sd) ** 2]), np.array([0.5])
+    )
+    assert crossing[0] == pytest.approx(upper_bound_crossing(months, values, quantile, 0.5), abs=2e-3)
+
+
+def test_months_within_upper_limit_edge_cases():
+    ones = np.ones(3)
+    crossing = months_within_upper_limit(
+        intercept=np.array([0.0, 2.0, 0.0]),
+        slope=np.array([1.0, 1.0, -1.0]),
+        mean_months=np.full(3, 6.0),
+        sxx=np.full(3, 100.0),
+        n=np.full(3, 5.0),
+        k=np.array([0.0, 0.0, 0.01]),
+        limit=ones,
+    )
+    # Exact line reaching the limit, already above it at release, and never reaching it
+    assert crossing.tolist() == [1.0, 0.0, np.inf]
+
+
+EXTENSION = "http://example.org/fhir/StructureDefinition/"
+
+
+def stability_test(test_id, title, criteria, condition):
+    return {
+        "resourceType": "ActivityDefinition",
+        "id": test_id,
+        "title": title,
+        "extension": [
+            {"url": EXTENSION + "stability-test-acceptance-criteria", "valueString": json.dumps(criteria)},
+            {"url": EXTENSION + "stability-test-parameters", "valueString": json.dumps({"storage_condition": condition})},
+        ],
+    }
+
+
+def observation(observation_id, subject, value, timepoint=None, condition=None, **fields):
+    extensions = []
+    if timepoint:
+        extensions.append({"url": EXTENSION + "protocol-timepoint", "valueString": timepoint})
+    if condition:
+        extensions.append({"url": EXTENSION + "storage-condition", "valueString": condition})
+    resource = {"resourceType": "Observation", "id": observation_id, "status": "final", "extension": extensions}
+    if subject:
+        resource["subject"] = {"reference": subject}
+    if isinstance(value, float):
+        resource["valueQuantity"] = {"value": value}
+    else:
+        resource["valueString"] = value
+    resource.update(fields)
+    return resource
+
+
+def series(observation_prefix, subject, values, condition=None):
+    return [
+        observation(f"{observation_prefix}-{month}", subject, value, f"T{month}", condition)
+        for month, value in zip((0, 3, 6, 9, 12), values)
+    ]
+
+
+@pytest.fixture
+def stability_results(monkeypatch):
+    """Stub the FHIR searches of the shelf-life endpoint with a small protocol"""
+    protocol = {
+        "resourceType": "PlanDefinition",
+        "id": "p1",
+        "title": "Stability",
+        "action": [
+            {"id": f"T{month}", "timingTiming": {"repeat": {"boundsDuration": {"value": month, "unit": "mo"}}}}
+            for month in (0, 3, 6, 9, 12)
+        ],
+    }
+    tests = [
+        stability_test("assay", "Assay", {"Assay": "95.0-105.0%"}, "25C/60%RH"),
+        stability_test("impurities", "Impurities", {"Impurity A": "NMT 0.5%", "Total": "NMT 2.0%"}, "25C/60%RH"),
+    ]
+    results = {
+        "assay": [
+            *series("a1", "Medication/b1", [100.1, 99.6, 99.2, 98.7, 98.3]),
+            *series("a2", "Medication/b2", [100.0, 99.0, 98.1, 97.0, 96.1]),
+            *series("a1-40", "Medication/b1", [100.0, 98.1, 96.0], "40C/75%RH"),
+            observation("withdrawn", "Medication/b1", 90.0, "T3", status="entered-in-error"),
+            observation("text", "Medication/b1", "Complies", "T3"),
+            observation("unlinked", None, 99.0, "T3"),
+            observation("untimed", "Medication/b1", 99.0, condition="30C/65%RH"),
+        ],
+        "impurities": series("i1", "Medication/b1", [0.10, 0.15, 0.21, 0.24, 0.30]),
+    }
+    cro_results = [
+        {**result, "code": {"coding": [{"system": "http://example.org/fhir/stability-tests", "code": "assay"}]}}
+        for result in series("cro", "Device/d1", [100.2, 99.9, 99.5, 99.2, 98.8])
+    ]
+    # A CRO result that was also found through its test-definition extension counts once
+    cro_results.append({**results["assay"][0], "code": cro_results[0]["code"]})
+    searches = {"running": 0, "most": 0}
+
+    async def read_definition(resource_type, resource_id):
+        return protocol
+
+    async def searched(resources):
+        searches["running"] += 1
+        searches["most"] = max(searches["most"], searches["running"])
+        await asyncio.sleep(0)
+        for resource in resources:
+            yield {"resource": resource}
+        searches["running"] -= 1
+
+    def iter_extension_search(resource_type, references, params=None):
+        if resource_type == "ActivityDefinition":
+            return searched(tests)
+        if resource_type == "Medication":
+            return searched([{"resourceType": "Medication", "id": batch_id} for batch_id in ("b1", "b2")])
+        return searched(results[references["test-definition"].split("/")[1]])
+
+    def iter_fhir_search(resource_type, params=None):
+        codes = {code.split("|")[1] for code in params["code"].split(",")}
+        return searched([result for result in cro_results if result["code"]["coding"][0]["code"] in codes])
+
+    monkeypatch.setattr(main, "read_definition", read_definition)
+    monkeypatch.setattr(main, "iter_extension_search", iter_extension_search)
+    monkeypatch.setattr(main, "iter_fhir_search", iter_fhir_search)
+    monkeypatch.setattr(main, "SEARCH_MAX_CONCURRENCY", 1)
+    return searches
+
+
+def test_shelf_life_groups_series_and_limits_per_condition(stability_results):
+    response = asyncio.run(main.get_protocol_shelf_life("p1"))
+
+    assert response["excluded"] == {"withdrawn": 1, "not_numeric": 1, "no_batch": 1, "no_time": 1}
+    assert stability_results["most"] == 1
+
+    by_series = {(item["batch_reference"], item["test"], item["condition"]): item for item in response["series"]}
+    assert set(by_series) == {
+        ("Medication/b1", "Assay", "25C/60%RH"),
+        ("Medication/b2", "Assay", "25C/60%RH"),
+        ("Device/d1", "Assay", "25C/60%RH"),
+        ("Medication/b1", "Assay", "40C/75%RH"),
+        ("Medication/b1", "Assay", "30C/65%RH"),
+        ("Medication/b1", "Impurities", "25C/60%RH"),
+    }
+    assert by_series[("Medication/b1", "Assay", "25C/60%RH")]["points"] == 5
+    assert by_series[("Device/d1", "Assay", "25C/60%RH")]["points"] == 5
+    assert by_series[("Medication/b1", "Assay", "30C/65%RH")]["status"] == "insufficient_data"
+    assert by_series[("Medication/b1", "Impurities", "25C/60%RH")]["status"] == "ambiguous_criteria"
+
+    long_term = [item for key, item in by_series.items() if key[1:] == ("Assay", "25C/60%RH")]
+    assert all(item["status"] == "estimated" and item["lower_limit"] == 95.0 for item in long_term)
+    shortest = min(long_term, key=lambda item: item["shelf_life_months"])
+    assert shortest["batch_id"] == "b2"
+
+    tests = {(item["test"], item["condition"]): item for item in response["tests"]}
+    assert tests[("Assay", "25C/60%RH")]["batches"] == 3
+    assert tests[("Assay", "25C/60%RH")]["shelf_life_months"] == shortest["shelf_life_months"]
+    assert tests[("Assay", "25C/60%RH")]["limiting_batch_id"] == "b2"
+    assert tests[("Impurities", "25C/60%RH")]["shelf_life_months"] is None
+
+    conditions = {item["condition"]: item for item in response["conditions"]}
+    assert conditions["25C/60%RH"]["shelf_life_months"] == shortest["shelf_life_months"]
+    assert conditions["25C/60%RH"]["limiting_test"] == "Assay"
+    assert conditions["40C/75%RH"]["shelf_life_months"] == by_series[("Medication/b1", "Assay", "40C/75%RH")]["shelf_life_months"]
+    assert conditions["40C/75%RH"]["shelf_life_months"] < conditions["25C/60%RH"]["shelf_life_months"]
+    assert conditions["30C/65%RH"]["shelf_life_months"] is None
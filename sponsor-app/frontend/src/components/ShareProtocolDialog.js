@@ -31,6 +31,7 @@ import ExpandMoreIcon from '@mui/icons-material/ExpandMore';
 import { 
   fetchOrganizations, 
   shareProtocol, 
+  SHARE_STATUS_UNKNOWN,
   getProtocolShares, 
   fetchBatches, 
   fetchTests,
@@ -47,6 +48,7 @@ function ShareProtocolDialog({ open, onClose, protocolId, protocolTitle, actions
   const [loading, setLoading] = useState(false);
   const [saving, setSaving] = useState(false);
   const [error, setError] = useState(null);
+  const [warning, setWarning] = useState(null);
   const [shareResults, setShareResults] = useState([]);
   const [showResults, setShowResults] = useState(false);
   const [shareMode, setShareMode] = useState('fullProtocol'); // 'fullProtocol' or 'specificTests'
@@ -158,6 +160,7 @@ function ShareProtocolDialog({ open, onClose, protocolId, protocolTitle, actions
     try {
       setSaving(true);
       setError(null);
+      setWarning(null);
       setShowResults(false);
       
       // Prepare sharing data
@@ -186,7 +189,11 @@ function ShareProtocolDialog({ open, onClose, protocolId, protocolTitle, actions
       }
     } catch (error) {
       console.error('Error sharing protocol:', error);
-      setError('Failed to share protocol. Please try again.');
+      if (error.code === SHARE_STATUS_UNKNOWN) {
+        setWarning('Share status unknown: the share was started, but its outcome could not be confirmed. Check the protocol\'s shares before sharing again.');
+      } else {
+        setError('Failed to share protocol. Please try again.');
+      }
     } finally {
       setSaving(false);
     }
@@ -228,6 +235,11 @@ function ShareProtocolDialog({ open, onClose, protocolId, protocolTitle, actions
             {error}
           </Alert>
         )}
+        {warning && (
+          <Alert severity="warning" sx={{ mb: 2 }}>
+            {warning}
+          </Alert>
+        )}
 
         {showResults ? (
           <>
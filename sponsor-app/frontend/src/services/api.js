@@ -249,13 +249,60 @@ export const shareProtocol = async (protocolId, sharingData) => {
         };
         
     const response = await api.post(`/protocols/${protocolId}/share`, requestData);
-    return response.data;
+    // Sharing runs as a background job on the server; wait for it to finish
+    return await waitForShareJob(response.data.job_id);
   } catch (error) {
     console.error(`Error sharing protocol ${protocolId}:`, error);
     throw error;
   }
 };
 
+export const getShareJob = async (jobId) => {
+  try {
+    const response = await api.get(`/share-jobs/${jobId}`);
+    return response.data;
+  } catch (error) {
+    console.error(`Error fetching share job ${jobId}:`, error);
+    throw error;
+  }
+};
+
+// Thrown when a share was started but its outcome can no longer be followed, e.g. because
+// the server restarted and forgot the job or it did not finish in time
+export const SHARE_STATUS_UNKNOWN = 'SHARE_STATUS_UNKNOWN';
+
+const shareStatusUnknown = (jobId, message) => {
+  const error = new Error(message);
+  error.code = SHARE_STATUS_UNKNOWN;
+  error.jobId = jobId;
+  return error;
+};
+
+const waitForShareJob = async (jobId, pollIntervalMs = 1000, maxWaitMs = 5 * 60 * 1000) => {
+  const deadline = Date.now() + maxWaitMs;
+  while (true) {
+    let job;
+    try {
+      job = await getShareJob(jobId);
+    } catch (error) {
+      if (error.response?.status === 404) {
+        throw shareStatusUnknown(jobId, `Share job ${jobId} is no longer known to the server`);
+      }
+      throw error;
+    }
+    if (job.status === 'completed') {
+      return job.result;
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error || `Share job ${jobId} failed`);
+    }
+    if (Date.now() + pollIntervalMs > deadline) {
+      throw shareStatusUnknown(jobId, `Share job ${jobId} did not finish within ${Math.round(maxWaitMs / 1000)} seconds`);
+    }
+    await new Promise((resolve) => setTimeout(resolve, pollIntervalMs));
+  }
+};
+
 export const getProtocolShares = async (protocolId) => {
   try {
     const response = await api.get(`/protocols/${protocolId}/shares`);